@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Sum
 from django.utils import timezone
 from django.conf import settings
 from django.core.cache import cache
@@ -11,6 +12,7 @@ from oauth2_provider.models import AccessToken, Application
 from rest_framework.authtoken.models import Token
 
 from observation_portal.proposals.models import Proposal
+from observation_portal.requestgroups.models import Request
 
 logger = logging.getLogger()
 
@@ -30,14 +32,15 @@ class Profile(models.Model):
     def time_used_in_proposal(self, proposal):
         if not proposal.current_semester:
             return 0
-        requestgroups = self.user.requestgroup_set.filter(
-            proposal=proposal, created__gte=proposal.current_semester.start, state__in=['PENDING', 'COMPLETED']
-        ).prefetch_related('requests')
-        return sum(
-            request.duration for request_group in requestgroups for request in request_group.requests.filter(
-                state__in=['PENDING', 'COMPLETED']
-            )
+        requests = Request.objects.filter(
+            request_group__submitter=self.user, request_group__proposal=proposal,
+            request_group__created__gte=proposal.current_semester.start,
+            request_group__state__in=['PENDING', 'COMPLETED'], state__in=['PENDING', 'COMPLETED']
         )
+        time_used = requests.aggregate(time_used=Sum('stored_duration'))['time_used'] or 0
+        # The few requests whose durations have not been stored yet have them calculated instead
+        missing_durations = requests.filter(stored_duration__isnull=True).prefetch_related('configurations', 'windows')
+        return time_used + sum(request.calculate_duration() for request in missing_durations)
 
     @property
     def archive_bearer_token(self):
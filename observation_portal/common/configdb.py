@@ -1,17 +1,26 @@
 import logging
+import hashlib
+import json
+import time
 from typing import Union
 from collections import namedtuple, defaultdict
 from math import sqrt
 
 import requests
-from django.core.cache import caches
+from django.core.cache import cache, caches
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
-from observation_portal.common.utils import cache_function
+from observation_portal.common.utils import (cache_function, get_cache_function_key, get_cache_dependency_version,
+                                             set_cache_dependency_version, get_http_session,
+                                             get_conditional_request_headers, get_response_validators)
 
 logger = logging.getLogger(__name__)
 
+CONFIGDB_DATA_KEY = 'configdb_data_{}'
+CONFIGDB_VALIDATORS_KEY = 'configdb_validators_{}'
+SNAPSHOT_VERSION_CHECK_INTERVAL = 5  # seconds between checks that the ConfigDB snapshot is still current
+
 
 class ConfigDBException(Exception):
     """Raise on error retrieving or processing configuration data."""
@@ -26,19 +35,82 @@ class TelescopeKey(namedtuple('TelescopeKey', ['site', 'enclosure', 'telescope']
         return '.'.join(s for s in [self.site, self.enclosure, self.telescope] if s)
 
 
+class ConfigDBSnapshot(object):
+    """Indexed view of the ConfigDB sites data.
+
+    The nested sites data is walked once when the snapshot is built, so accessors can look up sites, telescopes,
+    instruments and instrument types directly instead of walking it on every call. Snapshots are shared between
+    callers, so treat them and everything they index as read only.
+    """
+
+    def __init__(self, site_data: list, version: str = None):
+        self.version = version
+        self.site_data = site_data
+        self.sites = {}
+        self.telescopes = {}
+        self.telescope_names = {}
+        self.instruments = []
+        self.instruments_by_type = defaultdict(list)
+        self.instruments_by_name = defaultdict(list)
+        self.instruments_by_location = defaultdict(list)
+        self.instrument_types = {}
+        for site in site_data:
+            self.sites[site['code']] = site
+            for enclosure in site['enclosure_set']:
+                for telescope in enclosure['telescope_set']:
+                    telescope_key = TelescopeKey(site=site['code'], enclosure=enclosure['code'], telescope=telescope['code'])
+                    telescope_name = telescope['name'].strip()
+                    self.telescopes[telescope_key] = (site, enclosure, telescope)
+                    self.telescope_names.setdefault(telescope_name.lower(), telescope_name)
+                    for instrument in telescope['instrument_set']:
+                        instrument = dict(instrument, telescope_key=telescope_key, telescope_name=telescope_name.lower())
+                        instrument_type_code = instrument['instrument_type']['code'].upper()
+                        self.instruments.append(instrument)
+                        self.instruments_by_type[instrument_type_code].append(instrument)
+                        self.instruments_by_name[instrument['code'].upper()].append(instrument)
+                        self.instruments_by_location[self.location_key(*telescope_key)].append(instrument)
+                        self.instrument_types.setdefault(instrument_type_code, instrument['instrument_type'])
+
+    @staticmethod
+    def location_key(site_code: str, enclosure_code: str, telescope_code: str) -> TelescopeKey:
+        """Get the case insensitive key of a telescope for looking up instruments by location"""
+        return TelescopeKey(site=site_code.lower(), enclosure=enclosure_code.lower(), telescope=telescope_code.lower())
+
+
 class ConfigDB(object):
     """Class to retrieve and process configuration data."""
 
+    def __init__(self):
+        self._snapshot = None
+        self._snapshot_checked_until = 0
+
     @staticmethod
     @cache_function(duration=900)
     def _get_configdb_data(resource: str):
         """Return all configuration data.
 
         Return all data from ConfigDB at the given endpoint. Check first if the data is already cached, and
-        if so, return that.
+        if so, return that. The data is normally kept in the shared cache by the refresh_configdb task, so
+        ConfigDB itself is only queried here if the shared cache does not have it yet.
+
+        Parameters:
+            resource: ConfigDB endpoint
+        Returns:
+            Data retrieved
+        """
+        results = cache.get(CONFIGDB_DATA_KEY.format(resource))
+        if results is None:
+            results = ConfigDB.refresh_configdb_data(resource)
+        return results
+
+    @staticmethod
+    def refresh_configdb_data(resource: str):
+        """Fetch the data at a ConfigDB endpoint and publish it to the shared cache.
 
         Parameters:
             resource: ConfigDB endpoint
+        Raises:
+            ConfigDBException: If ConfigDB could not be reached or returned unexpected data
         Returns:
             Data retrieved
         """
@@ -46,21 +118,62 @@ class ConfigDB(object):
             'ConfigDB connection is currently down, please wait a few minutes and try again. If this problem '
             'persists then please contact support.'
         ))
+        data_key = CONFIGDB_DATA_KEY.format(resource)
+        validators_key = CONFIGDB_VALIDATORS_KEY.format(resource)
+        cached = cache.get_many([data_key, validators_key])
+        # Only make the request conditional if there is published data to fall back on
+        headers = get_conditional_request_headers(cached.get(validators_key)) if data_key in cached else {}
         try:
-            r = requests.get(settings.CONFIGDB_URL + f'/{resource}/')
+            r = get_http_session().get(settings.CONFIGDB_URL + f'/{resource}/', headers=headers)
             r.raise_for_status()
         except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
             msg = f'{e.__class__.__name__}: {error_message}'
             raise ConfigDBException(msg)
+        if r.status_code == 304:
+            # Unchanged, so the published data, its version and every snapshot built from it are still current
+            return cached[data_key]
         try:
-            return r.json()['results']
+            results = r.json()['results']
         except KeyError:
             raise ConfigDBException(error_message)
+        cache.set_many({data_key: results, validators_key: get_response_validators(r)}, None)
+        # Invalidate everything computed from the previous version of this resource
+        set_cache_dependency_version(resource, ConfigDB._get_data_version(results))
+        return results
+
+    @staticmethod
+    def _get_data_version(data) -> str:
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
 
     def get_site_data(self):
         """Return ConfigDB sites data."""
         return self._get_configdb_data('sites')
 
+    def get_snapshot(self) -> ConfigDBSnapshot:
+        """Return the indexed snapshot of the ConfigDB sites data.
+
+        The snapshot is kept in process and rebuilt when the published version of the sites data changes. Without a
+        published version there is nothing to check the snapshot against, so it is rebuilt on every call.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and time.time() < self._snapshot_checked_until:
+            return snapshot
+        published_version = get_cache_dependency_version('sites')
+        if published_version is None:
+            return ConfigDBSnapshot(self.get_site_data())
+        if snapshot is None or snapshot.version != published_version:
+            site_data = self.get_site_data()
+            version = self._get_data_version(site_data)
+            if version != published_version:
+                # Newer sites data was published since our local copy was cached, so get it again
+                caches['locmem'].delete(get_cache_function_key('_get_configdb_data', ('sites',), {}))
+                site_data = self.get_site_data()
+                version = self._get_data_version(site_data)
+            snapshot = ConfigDBSnapshot(site_data, version)
+            self._snapshot = snapshot
+        self._snapshot_checked_until = time.time() + SNAPSHOT_VERSION_CHECK_INTERVAL
+        return snapshot
+
     def get_sites_with_instrument_type_and_location(
         self, instrument_type: str = '', site_code: str = '', enclosure_code: str = '', telescope_code: str = '',
         only_schedulable: bool = True
@@ -90,16 +203,14 @@ class ConfigDB(object):
         return site_details
 
     def get_site_tuples(self, include_blank=False):
-        site_data = self.get_site_data()
-        sites = [(site['code'], site['code']) for site in site_data]
+        sites = [(site_code, site_code) for site_code in self.get_snapshot().sites]
         if include_blank:
             sites.append(('', ''))
         return sites
 
     def get_enclosure_tuples(self, include_blank=False):
         enclosure_set = set()
-        site_data = self.get_site_data()
-        for site in site_data:
+        for site in self.get_snapshot().sites.values():
             for enclosure in site['enclosure_set']:
                 enclosure_set.add(enclosure['code'])
 
@@ -109,12 +220,7 @@ class ConfigDB(object):
         return enclosures
 
     def get_telescope_tuples(self, include_blank=False):
-        telescope_set = set()
-        site_data = self.get_site_data()
-        for site in site_data:
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    telescope_set.add(telescope['code'])
+        telescope_set = set(telescope_key.telescope for telescope_key in self.get_snapshot().telescopes)
 
         telescopes = [(telescope, telescope) for telescope in telescope_set]
         if include_blank:
@@ -122,37 +228,19 @@ class ConfigDB(object):
         return telescopes
 
     def get_telescope_class_tuples(self):
-        telescope_classes = set()
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    telescope_classes.add(telescope['code'][:-1])
+        telescope_classes = set(telescope_key.telescope[:-1] for telescope_key in self.get_snapshot().telescopes)
         return [(telescope_class, telescope_class) for telescope_class in telescope_classes]
 
     def get_telescope_name_tuples(self):
-        telescope_names = set()
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    telescope_names.add(telescope['name'].strip().lower())
+        telescope_names = set(self.get_snapshot().telescope_names)
         return [(telescope_name, telescope_name) for telescope_name in telescope_names]
 
     def get_instrument_type_tuples(self):
-        instrument_types = set()
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        instrument_types.add(instrument['instrument_type']['code'].upper())
+        instrument_types = set(self.get_snapshot().instruments_by_type)
         return [(instrument_type, instrument_type) for instrument_type in instrument_types]
 
     def get_instrument_name_tuples(self):
-        instrument_names = set()
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        instrument_names.add(instrument['code'].lower())
+        instrument_names = set(instrument_name.lower() for instrument_name in self.get_snapshot().instruments_by_name)
         return [(instrument_name, instrument_name) for instrument_name in instrument_names]
 
     def get_configuration_type_tuples(self):
@@ -163,102 +251,80 @@ class ConfigDB(object):
         return [(config_type, config_type) for config_type in configuration_types]
 
     def get_raw_telescope_name(self, telescope_name):
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    if telescope['name'].strip().lower() == telescope_name.strip().lower():
-                        return telescope['name'].strip()
-        return telescope_name
+        return self.get_snapshot().telescope_names.get(telescope_name.strip().lower(), telescope_name)
 
     def get_instruments_at_location(self, site_code, enclosure_code, telescope_code, only_schedulable=False):
         instrument_names = set()
         instrument_types = set()
-        for site in self.get_site_data():
-            if site['code'].lower() == site_code.lower():
-                for enclosure in site['enclosure_set']:
-                    if enclosure['code'].lower() == enclosure_code.lower():
-                        for telescope in enclosure['telescope_set']:
-                            if telescope['code'].lower() == telescope_code.lower():
-                                for instrument in telescope['instrument_set']:
-                                    if (
-                                            only_schedulable and self.is_schedulable(instrument)
-                                            or (not only_schedulable and self.is_active(instrument))
-                                    ):
-                                        instrument_names.add(instrument['code'].lower())
-                                        instrument_types.add(
-                                            instrument['instrument_type']['code'].lower()
-                                        )
+        location_key = ConfigDBSnapshot.location_key(site_code, enclosure_code, telescope_code)
+        for instrument in self.get_snapshot().instruments_by_location.get(location_key, []):
+            if (
+                    only_schedulable and self.is_schedulable(instrument)
+                    or (not only_schedulable and self.is_active(instrument))
+            ):
+                instrument_names.add(instrument['code'].lower())
+                instrument_types.add(instrument['instrument_type']['code'].lower())
         return {'names': instrument_names, 'types': instrument_types}
 
     def get_telescopes_with_instrument_type_and_location(
             self, instrument_type_code='', site_code='', enclosure_code='', telescope_code='', only_schedulable=True
     ):
-        site_data = self.get_site_data()
+        snapshot = self.get_snapshot()
+        if instrument_type_code:
+            instruments = snapshot.instruments_by_type.get(instrument_type_code.upper(), [])
+        else:
+            instruments = snapshot.instruments
         telescope_details = {}
-        for site in site_data:
-            if not site_code or site_code == site['code']:
-                for enclosure in site['enclosure_set']:
-                    if not enclosure_code or enclosure_code == enclosure['code']:
-                        for telescope in enclosure['telescope_set']:
-                            if not telescope_code or telescope_code == telescope['code']:
-                                code = '.'.join([telescope['code'], enclosure['code'], site['code']])
-                                for instrument in telescope['instrument_set']:
-                                    if (self.is_schedulable(instrument) or
-                                            (not only_schedulable and self.is_active(instrument))):
-                                        instrument_type = instrument['instrument_type']['code']
-                                        if not instrument_type_code or instrument_type_code.upper() == instrument_type.upper():
-                                            if code not in telescope_details:
-                                                telescope_details[code] = {
-                                                    'latitude': telescope['lat'],
-                                                    'longitude': telescope['long'],
-                                                    'horizon': telescope['horizon'],
-                                                    'altitude': site['elevation'],
-                                                    'ha_limit_pos': telescope['ha_limit_pos'],
-                                                    'ha_limit_neg': telescope['ha_limit_neg'],
-                                                    'zenith_blind_spot': telescope['zenith_blind_spot']
-                                                }
+        for instrument in instruments:
+            telescope_key = instrument['telescope_key']
+            if (
+                    (site_code and site_code != telescope_key.site)
+                    or (enclosure_code and enclosure_code != telescope_key.enclosure)
+                    or (telescope_code and telescope_code != telescope_key.telescope)
+            ):
+                continue
+            if self.is_schedulable(instrument) or (not only_schedulable and self.is_active(instrument)):
+                code = '.'.join([telescope_key.telescope, telescope_key.enclosure, telescope_key.site])
+                if code not in telescope_details:
+                    site, _, telescope = snapshot.telescopes[telescope_key]
+                    telescope_details[code] = {
+                        'latitude': telescope['lat'],
+                        'longitude': telescope['long'],
+                        'horizon': telescope['horizon'],
+                        'altitude': site['elevation'],
+                        'ha_limit_pos': telescope['ha_limit_pos'],
+                        'ha_limit_neg': telescope['ha_limit_neg'],
+                        'zenith_blind_spot': telescope['zenith_blind_spot']
+                    }
         return telescope_details
 
     def is_valid_instrument_type(self, instrument_type_code):
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        if (
-                                instrument_type_code.upper() == instrument['instrument_type']['code'].upper()
-                                and self.is_active(instrument)
-                        ):
-                            return True
-        return False
+        instruments = self.get_snapshot().instruments_by_type.get(instrument_type_code.upper(), [])
+        return any(self.is_active(instrument) for instrument in instruments)
 
     def is_valid_instrument(self, instrument_name):
-        for site in self.get_site_data():
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        if instrument_name.upper() == instrument['code'].upper() and self.is_active(instrument):
-                            return True
-        return False
+        instruments = self.get_snapshot().instruments_by_name.get(instrument_name.upper(), [])
+        return any(self.is_active(instrument) for instrument in instruments)
 
     def get_instruments(self, exclude_states=None):
+        instruments = self.get_snapshot().instruments
         if not exclude_states:
-            exclude_states = []
-        site_data = self.get_site_data()
-        instruments = []
-        for site in site_data:
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        if instrument['state'].upper() not in exclude_states:
-                            telescope_key = TelescopeKey(
-                                site=site['code'],
-                                enclosure=enclosure['code'],
-                                telescope=telescope['code']
-                            )
-                            instrument['telescope_key'] = telescope_key
-                            instrument['telescope_name'] = telescope['name'].strip().lower()
-                            instruments.append(instrument)
-        return instruments
+            return list(instruments)
+        return [instrument for instrument in instruments if instrument['state'].upper() not in exclude_states]
+
+    def get_instruments_of_type(self, instrument_type_code: str, exclude_states=None) -> list:
+        """Get the instruments of an instrument type.
+
+        Parameters:
+            instrument_type_code: Instrument type code, in any case
+            exclude_states: Instrument states to exclude
+        Returns:
+            Instruments of that type
+        """
+        instruments = self.get_snapshot().instruments_by_type.get(instrument_type_code.upper(), [])
+        if not exclude_states:
+            return list(instruments)
+        return [instrument for instrument in instruments if instrument['state'].upper() not in exclude_states]
 
     def get_instrument_types(self) -> dict:
         """Get all instrument types on the network.
@@ -266,12 +332,7 @@ class ConfigDB(object):
         Returns:
             Dictionary of instrument type code to instrument type data
         """
-        instrument_types = {}
-        for instrument in self.get_instruments():
-            if instrument['instrument_type']['code'].upper() not in instrument_types:
-                instrument_types[instrument['instrument_type']['code'].upper()] = instrument['instrument_type']
-
-        return instrument_types
+        return dict(self.get_snapshot().instrument_types)
 
     def get_instrument_types_per_telescope(self, location: dict = None, only_schedulable: bool = False) -> dict:
         """Get a set of available instrument types per telescope.
@@ -314,11 +375,10 @@ class ConfigDB(object):
             Available instrument names
         """
         instrument_names = set()
-        for instrument in self.get_instruments(exclude_states=['DISABLED', ]):
+        location_key = ConfigDBSnapshot.location_key(site_code, enclosure_code, telescope_code)
+        for instrument in self.get_snapshot().instruments_by_location.get(location_key, []):
             if (
-                    instrument['telescope_key'].site.lower() == site_code.lower()
-                    and instrument['telescope_key'].enclosure.lower() == enclosure_code.lower()
-                    and instrument['telescope_key'].telescope.lower() == telescope_code.lower()
+                    self.is_active(instrument)
                     and instrument['instrument_type']['code'].lower() == instrument_type_code.lower()
             ):
                 instrument_names.add(instrument['code'].lower())
@@ -353,12 +413,12 @@ class ConfigDB(object):
         if only_schedulable:
             exclude_states = ['DISABLED', 'ENABLED', 'MANUAL', 'COMMISSIONING', 'STANDBY']
         instrument_telescopes = set()
-        for instrument in self.get_instruments(exclude_states=exclude_states):
-            if instrument['instrument_type']['code'].upper() == instrument_type_code:
+        for instrument in self.get_snapshot().instruments_by_type.get(instrument_type_code, []):
+            if instrument['state'].upper() not in exclude_states:
                 instrument_telescopes.add(instrument['telescope_key'])
         return instrument_telescopes
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_configuration_types(self, instrument_type_code: str) -> dict:
         """Get the available configuration types for an instrument_type.
 
@@ -372,7 +432,7 @@ class ConfigDB(object):
             return {config_type['code']: config_type for config_type in instrument_types[instrument_type_code.upper()]['configuration_types']}
         return {}
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_optical_elements(self, instrument_type_code: str) -> dict:
         """Get the available optical elements.
 
@@ -383,21 +443,20 @@ class ConfigDB(object):
         """
         optical_elements = defaultdict(list)
         optical_elements_tracker = defaultdict(set)
-        for instrument in self.get_instruments(exclude_states=['DISABLED', ]):
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                for science_camera in instrument['science_cameras']:
-                    for optical_element_group in science_camera['optical_element_groups']:
-                        for element in optical_element_group['optical_elements']:
-                            if element['code'] not in optical_elements_tracker[optical_element_group['type']]:
-                                if optical_element_group['default'].upper() == element['code'].upper():
-                                    element['default'] = True
-                                else:
-                                    element['default'] = False
-                                optical_elements_tracker[optical_element_group['type']].add(element['code'])
-                                optical_elements[optical_element_group['type']].append(element)
+        for instrument in self.get_instruments_of_type(instrument_type_code, exclude_states=['DISABLED', ]):
+            for science_camera in instrument['science_cameras']:
+                for optical_element_group in science_camera['optical_element_groups']:
+                    for element in optical_element_group['optical_elements']:
+                        if element['code'] not in optical_elements_tracker[optical_element_group['type']]:
+                            if optical_element_group['default'].upper() == element['code'].upper():
+                                element['default'] = True
+                            else:
+                                element['default'] = False
+                            optical_elements_tracker[optical_element_group['type']].add(element['code'])
+                            optical_elements[optical_element_group['type']].append(element)
         return optical_elements
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_modes_by_type(self, instrument_type_code: str, mode_type: str = '') -> dict:
         """Get the set of available modes.
 
@@ -407,20 +466,19 @@ class ConfigDB(object):
         Returns:
             Available modes by type
         """
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                if not mode_type:
-                    return {
-                        mode_group['type']: mode_group
-                        for mode_group in instrument['instrument_type']['mode_types']
-                    }
-                else:
-                    for mode_group in instrument['instrument_type']['mode_types']:
-                        if mode_group['type'] == mode_type:
-                            return {mode_type: mode_group}
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            if not mode_type:
+                return {
+                    mode_group['type']: mode_group
+                    for mode_group in instrument['instrument_type']['mode_types']
+                }
+            else:
+                for mode_group in instrument['instrument_type']['mode_types']:
+                    if mode_group['type'] == mode_type:
+                        return {mode_type: mode_group}
         return {}
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_instrument_type_by_code(self, instrument_type_code: str) -> dict:
         """Get an instrument type by its code.
 
@@ -429,13 +487,13 @@ class ConfigDB(object):
         Returns:
             intrument type dict
         """
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                return instrument['instrument_type']
+        instrument_types = self.get_snapshot().instrument_types
+        if instrument_type_code.upper() in instrument_types:
+            return instrument_types[instrument_type_code.upper()]
 
         raise ConfigDBException(f'No instrument type found for instrument type code {instrument_type_code}')
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_mode_with_code(self, instrument_type, code, mode_type=''):
         modes_by_type = self.get_modes_by_type(instrument_type, mode_type)
         for _, mode_group in modes_by_type.items():
@@ -446,15 +504,13 @@ class ConfigDB(object):
         raise ConfigDBException(f'No mode named {code} found for instrument type {instrument_type}')
 
     def get_default_acceptability_threshold(self, instrument_type_code):
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                return instrument['instrument_type']['default_acceptability_threshold']
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            return instrument['instrument_type']['default_acceptability_threshold']
 
     def get_max_rois(self, instrument_type_code):
         # TODO: This assumes the max ROIs for the science cameras of an instrument are the same
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                return instrument['science_cameras'][0]['camera_type']['max_rois']
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            return instrument['science_cameras'][0]['camera_type']['max_rois']
 
     def get_average_ccd_orientation(self, instrument_type_code):
         ''' Gets an average of the individual camera orientations for a given instrument_type. Ideally,
@@ -462,45 +518,41 @@ class ConfigDB(object):
         '''
         sum_orientation = 0.0
         orientation_count = 0
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                for camera in instrument['science_cameras']:
-                    sum_orientation += camera['orientation']
-                    orientation_count += 1
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            for camera in instrument['science_cameras']:
+                sum_orientation += camera['orientation']
+                orientation_count += 1
         return sum_orientation / orientation_count
 
     def get_diagonal_ccd_fov(self, instrument_type_code, autoguider=False):
         ''' Get the diagonal fov in arcminutes for the ccd, from the camera_type pscale and pixelsx/y in configdb
         '''
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                if autoguider:
-                    camera_type = instrument['autoguider_camera']['camera_type']
-                else:
-                    camera_type = instrument['science_cameras'][0]['camera_type']
-                pscale = camera_type['pscale']
-                pixels_x = camera_type['pixels_x']
-                pixels_y = camera_type['pixels_y']
-                fov_x = pixels_x * pscale / 60.0  # Convert from arcseconds to arcminutes
-                fov_y = pixels_y * pscale / 60.0
-                diagonal = sqrt((fov_x ** 2) + (fov_y ** 2))
-                return diagonal
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            if autoguider:
+                camera_type = instrument['autoguider_camera']['camera_type']
+            else:
+                camera_type = instrument['science_cameras'][0]['camera_type']
+            pscale = camera_type['pscale']
+            pixels_x = camera_type['pixels_x']
+            pixels_y = camera_type['pixels_y']
+            fov_x = pixels_x * pscale / 60.0  # Convert from arcseconds to arcminutes
+            fov_y = pixels_y * pscale / 60.0
+            diagonal = sqrt((fov_x ** 2) + (fov_y ** 2))
+            return diagonal
         return 0
 
     def get_ccd_size(self, instrument_type_code):
         # TODO: This assumes the pixels for the science cameras of an instrument are the same
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                return {
-                    'x': instrument['science_cameras'][0]['camera_type']['pixels_x'],
-                    'y': instrument['science_cameras'][0]['camera_type']['pixels_y']
-                }
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            return {
+                'x': instrument['science_cameras'][0]['camera_type']['pixels_x'],
+                'y': instrument['science_cameras'][0]['camera_type']['pixels_y']
+            }
 
     def get_pixel_scale(self, instrument_type_code):
         # TODO: This assumes the pixel scale for the science cameras of an instrument are the same
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                return instrument['science_cameras'][0]['camera_type']['pscale']
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            return instrument['science_cameras'][0]['camera_type']['pscale']
 
     def get_instrument_type_category(self, instrument_type_code: str) -> str:
         instrument_types = self.get_instrument_types()
@@ -515,12 +567,11 @@ class ConfigDB(object):
         return instrument_type_code
 
     def get_instrument_type_telescope_class(self, instrument_type_code: str) -> str:
-        for instrument in self.get_instruments():
-            if instrument_type_code.upper() == instrument['instrument_type']['code'].upper():
-                return instrument['__str__'].split('.')[2][0:3]
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            return instrument['__str__'].split('.')[2][0:3]
         return instrument_type_code[0:3]
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_instrument_type_codes(self, location: dict, only_schedulable: bool = False) -> set:
         """Get the available instrument_types.
 
@@ -543,28 +594,26 @@ class ConfigDB(object):
         return instrument_types
 
     def get_guider_for_instrument_name(self, instrument_name):
-        instruments = self.get_instruments(exclude_states=['DISABLED'])
-        for instrument in instruments:
-            if instrument['code'].lower() == instrument_name.lower():
+        for instrument in self.get_snapshot().instruments_by_name.get(instrument_name.upper(), []):
+            if self.is_active(instrument):
                 return instrument['autoguider_camera']['code'].lower()
         raise ConfigDBException(_(f'Instrument not found: {instrument_name}'))
 
     def is_valid_guider_for_instrument_name(self, instrument_name, guide_camera_name):
-        instruments = self.get_instruments(exclude_states=['DISABLED'])
-        for instrument in instruments:
-            if instrument['code'].upper() == instrument_name.upper():
-                if instrument['autoguider_camera']['code'].lower() == guide_camera_name.lower():
-                    return True
-                elif instrument['instrument_type']['allow_self_guiding'] and guide_camera_name.lower() == instrument_name.lower():
-                    return True
+        for instrument in self.get_snapshot().instruments_by_name.get(instrument_name.upper(), []):
+            if not self.is_active(instrument):
+                continue
+            if instrument['autoguider_camera']['code'].lower() == guide_camera_name.lower():
+                return True
+            elif instrument['instrument_type']['allow_self_guiding'] and guide_camera_name.lower() == instrument_name.lower():
+                return True
         return False
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_exposure_overhead(self, instrument_type_code, readout_mode):
         # using the instrument type code, build an instrument with the correct configdb parameters
-        for instrument in self.get_instruments():
-            if instrument['instrument_type']['code'].upper() == instrument_type_code.upper():
-                instrument_type = instrument['instrument_type']
+        for instrument in self.get_instruments_of_type(instrument_type_code):
+            instrument_type = instrument['instrument_type']
 
         modes_by_type = self.get_modes_by_type(instrument_type_code, mode_type='readout')
         if 'readout' in modes_by_type:
@@ -580,7 +629,7 @@ class ConfigDB(object):
             return default_mode['overhead'] + instrument_type['fixed_overhead_per_exposure']
         raise ConfigDBException(f'Instruments of type {instrument_type_code} not found in configdb.')
 
-    @cache_function()
+    @cache_function(depends_on='sites')
     def get_request_overheads(self, instrument_type_code: str) -> dict:
         """Get the set of overheads needed to compute the duration of a request.
 
@@ -594,36 +643,33 @@ class ConfigDB(object):
         Returns:
             Request overheads
         """
-        site_data = self.get_site_data()
+        snapshot = self.get_snapshot()
         modes_by_type = self.get_modes_by_type(instrument_type_code)
-        for site in site_data:
-            for enclosure in site['enclosure_set']:
-                for telescope in enclosure['telescope_set']:
-                    for instrument in telescope['instrument_set']:
-                        instrument_type = instrument['instrument_type']
-                        if instrument_type['code'].upper() == instrument_type_code.upper():
-                            oe_overheads_by_type = {}
-                            for science_camera in instrument['science_cameras']:
-                                for oeg in science_camera['optical_element_groups']:
-                                    oe_overheads_by_type[oeg['type']] = oeg['element_change_overhead']
-                            return {
-                                'instrument_change_overhead': telescope['instrument_change_overhead'],
-                                'slew_rate': telescope['slew_rate'],
-                                'minimum_slew_overhead': telescope['minimum_slew_overhead'],
-                                'maximum_slew_overhead': telescope.get('maximum_slew_overhead', 0.0),
-                                'default_acquisition_exposure_time': instrument_type['acquire_exposure_time'],
-                                'acquisition_overheads': {
-                                    am['code']: am['overhead']
-                                    for am in modes_by_type['acquisition']['modes']
-                                } if 'acquisition' in modes_by_type else {},
-                                'guiding_overheads': {
-                                    gm['code']: gm['overhead']
-                                    for gm in modes_by_type['guiding']['modes']
-                                } if 'guiding' in modes_by_type else {},
-                                'observation_front_padding': instrument_type['observation_front_padding'],
-                                'config_front_padding': instrument_type['config_front_padding'],
-                                'optical_element_change_overheads': oe_overheads_by_type
-                            }
+        for instrument in snapshot.instruments_by_type.get(instrument_type_code.upper(), []):
+            _, _, telescope = snapshot.telescopes[instrument['telescope_key']]
+            instrument_type = instrument['instrument_type']
+            oe_overheads_by_type = {}
+            for science_camera in instrument['science_cameras']:
+                for oeg in science_camera['optical_element_groups']:
+                    oe_overheads_by_type[oeg['type']] = oeg['element_change_overhead']
+            return {
+                'instrument_change_overhead': telescope['instrument_change_overhead'],
+                'slew_rate': telescope['slew_rate'],
+                'minimum_slew_overhead': telescope['minimum_slew_overhead'],
+                'maximum_slew_overhead': telescope.get('maximum_slew_overhead', 0.0),
+                'default_acquisition_exposure_time': instrument_type['acquire_exposure_time'],
+                'acquisition_overheads': {
+                    am['code']: am['overhead']
+                    for am in modes_by_type['acquisition']['modes']
+                } if 'acquisition' in modes_by_type else {},
+                'guiding_overheads': {
+                    gm['code']: gm['overhead']
+                    for gm in modes_by_type['guiding']['modes']
+                } if 'guiding' in modes_by_type else {},
+                'observation_front_padding': instrument_type['observation_front_padding'],
+                'config_front_padding': instrument_type['config_front_padding'],
+                'optical_element_change_overheads': oe_overheads_by_type
+            }
         raise ConfigDBException(f'Instruments of type {instrument_type_code} not found in configdb.')
 
     @staticmethod
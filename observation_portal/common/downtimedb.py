@@ -4,42 +4,100 @@ from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.utils import timezone
 import logging
-from time_intervals.intervals import Intervals
-from datetime import datetime
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+import numpy as np
+
+from observation_portal.common.utils import get_http_session
 
 logger = logging.getLogger(__name__)
 
 DOWNTIMEDB_ERROR_MSG = _(("DowntimeDB connection is currently down, cannot update downtime information. "
                           "Using the last known value."))
 DOWNTIME_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+DOWNTIMEDB_PAGE_SIZE = 1000
+DOWNTIMEDB_SYNC_OVERLAP = timedelta(minutes=5)
+DOWNTIMEDB_FULL_SYNC_INTERVAL = timedelta(days=1)
 
 
 class DowntimeDBException(Exception):
     pass
 
 
+class DowntimeIntervals(object):
+    """Downtime intervals of one resource and instrument type, indexed by time.
+
+    The intervals are merged so they do not overlap and kept as sorted arrays of start and end timestamps, so the
+    downtime overlapping a window is found with a binary search instead of touching all historical downtime.
+    """
+
+    def __init__(self, intervals: list):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = np.array([start.timestamp() for start, _ in merged])
+        self.ends = np.array([end.timestamp() for _, end in merged])
+
+    def overlapping(self, start: datetime, end: datetime) -> list:
+        """Get the downtime intervals that overlap the window from start to end
+
+        Returns:
+            List of (start, end) tuples in time order
+        """
+        first = np.searchsorted(self.ends, start.timestamp(), side='right')
+        last = np.searchsorted(self.starts, end.timestamp(), side='left')
+        return [
+            (datetime.fromtimestamp(interval_start, tz=timezone.utc), datetime.fromtimestamp(interval_end, tz=timezone.utc))
+            for interval_start, interval_end in zip(self.starts[first:last], self.ends[first:last])
+        ]
+
+
 class DowntimeDB(object):
     @staticmethod
-    def _get_downtime_data():
-        ''' Gets all the data from downtimedb
+    def _get_downtime_data(modified_after=None):
+        ''' Gets the data from downtimedb, following pagination so no downtime is dropped
+        :param modified_after: only get the downtime periods created or modified after this time
         :return: list of dictionaries of downtime periods in time order (default)
         '''
-        try:
-            r = requests.get(settings.DOWNTIMEDB_URL + 'api/?limit=10000')
-            r.raise_for_status()
-        except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
-            msg = "{}: {}".format(e.__class__.__name__, DOWNTIMEDB_ERROR_MSG)
-            raise DowntimeDBException(msg)
+        params = {'limit': DOWNTIMEDB_PAGE_SIZE}
+        if modified_after:
+            params['modified_after'] = modified_after.strftime(DOWNTIME_DATE_FORMAT)
+        url = settings.DOWNTIMEDB_URL + 'api/?' + urlencode(params)
+        results = []
+        while url:
+            try:
+                r = get_http_session().get(url)
+                r.raise_for_status()
+            except (requests.exceptions.RequestException, requests.exceptions.HTTPError) as e:
+                msg = "{}: {}".format(e.__class__.__name__, DOWNTIMEDB_ERROR_MSG)
+                raise DowntimeDBException(msg)
+            data = r.json()
+            results.extend(data['results'])
+            url = data.get('next')
 
-        return r.json()['results']
+        return results
+
+    @staticmethod
+    def _get_resource(raw_downtime_interval):
+        return '.'.join([raw_downtime_interval['telescope'], raw_downtime_interval['enclosure'], raw_downtime_interval['site']])
+
+    @staticmethod
+    def _get_entry_key(raw_downtime_interval):
+        if raw_downtime_interval.get('id') is not None:
+            return raw_downtime_interval['id']
+        return (DowntimeDB._get_resource(raw_downtime_interval), raw_downtime_interval['instrument_type'],
+                raw_downtime_interval['start'], raw_downtime_interval['end'])
 
     @staticmethod
     def _order_downtime_by_resource_and_instrument_type(raw_downtime_intervals):
-        ''' Puts the raw downtime interval sets into a dictionary by resource and then by instrument_type or "all"
+        ''' Puts the raw downtime intervals into a dictionary by resource and then by instrument_type or "all"
         '''
         downtime_intervals = {}
         for interval in raw_downtime_intervals:
-            resource = '.'.join([interval['telescope'], interval['enclosure'], interval['site']])
+            resource = DowntimeDB._get_resource(interval)
             if resource not in downtime_intervals:
                 downtime_intervals[resource] = {}
             instrument_type = interval['instrument_type'] if interval['instrument_type'] else 'all'
@@ -47,28 +105,64 @@ class DowntimeDB(object):
                 downtime_intervals[resource][instrument_type] = []
             start = datetime.strptime(interval['start'], DOWNTIME_DATE_FORMAT).replace(tzinfo=timezone.utc)
             end = datetime.strptime(interval['end'], DOWNTIME_DATE_FORMAT).replace(tzinfo=timezone.utc)
-            downtime_intervals[resource][instrument_type].append({'type': 'start', 'time': start})
-            downtime_intervals[resource][instrument_type].append({'type': 'end', 'time': end})
+            downtime_intervals[resource][instrument_type].append((start, end))
 
         for resource in downtime_intervals:
             for instrument_type, intervals in downtime_intervals[resource].items():
-                downtime_intervals[resource][instrument_type] = Intervals(intervals)
+                downtime_intervals[resource][instrument_type] = DowntimeIntervals(intervals)
+
+        return downtime_intervals
+
+    @staticmethod
+    def _sync_downtime_intervals():
+        ''' Brings the locally held downtime up to date and returns the downtime intervals
 
+            Only the downtime periods modified since the last sync are fetched and merged in, and only the resources
+            they touch are re-indexed. Deleted downtime periods can not be seen that way, so everything is fetched
+            again once the last full sync is older than DOWNTIMEDB_FULL_SYNC_INTERVAL.
+        '''
+        now = timezone.now()
+        state = caches['locmem'].get('downtime_entries.no_expire')
+        previous_intervals = caches['locmem'].get('downtime_intervals.no_expire')
+        if state is None or previous_intervals is None or now - state['full_synced_at'] > DOWNTIMEDB_FULL_SYNC_INTERVAL:
+            entries = {DowntimeDB._get_entry_key(entry): entry for entry in DowntimeDB._get_downtime_data()}
+            downtime_intervals = DowntimeDB._order_downtime_by_resource_and_instrument_type(entries.values())
+            full_synced_at = now
+        else:
+            entries = state['entries']
+            # Overlap with the previous sync a little, to not miss modifications made while it was running
+            changed_entries = DowntimeDB._get_downtime_data(modified_after=state['synced_at'] - DOWNTIMEDB_SYNC_OVERLAP)
+            changed_resources = set()
+            for entry in changed_entries:
+                key = DowntimeDB._get_entry_key(entry)
+                if key in entries:
+                    changed_resources.add(DowntimeDB._get_resource(entries[key]))
+                entries[key] = entry
+                changed_resources.add(DowntimeDB._get_resource(entry))
+            downtime_intervals = {
+                resource: intervals for resource, intervals in previous_intervals.items() if resource not in changed_resources
+            }
+            downtime_intervals.update(DowntimeDB._order_downtime_by_resource_and_instrument_type(
+                entry for entry in entries.values() if DowntimeDB._get_resource(entry) in changed_resources
+            ))
+            full_synced_at = state['full_synced_at']
+        caches['locmem'].set(
+            'downtime_entries.no_expire', {'entries': entries, 'synced_at': now, 'full_synced_at': full_synced_at}, None
+        )
         return downtime_intervals
 
     @staticmethod
     def get_downtime_intervals():
-        ''' Returns dictionary of IntervalSets of downtime intervals per telescope resource and per instrument_type or "all".
+        ''' Returns dictionary of DowntimeIntervals per telescope resource and per instrument_type or "all".
             Caches the data and will attempt to update the cache every 15 minutes, but fallback on using previous downtime list otherwise.
         '''
         downtime_intervals = caches['locmem'].get('downtime_intervals', [])
         if not downtime_intervals:
             # If the cache has expired, attempt to update the downtime intervals
             try:
-                data = DowntimeDB._get_downtime_data()
-                downtime_intervals = DowntimeDB._order_downtime_by_resource_and_instrument_type(data)
+                downtime_intervals = DowntimeDB._sync_downtime_intervals()
                 caches['locmem'].set('downtime_intervals', downtime_intervals, 900)
-                caches['locmem'].set('downtime_intervals.no_expire', downtime_intervals)
+                caches['locmem'].set('downtime_intervals.no_expire', downtime_intervals, None)
             except DowntimeDBException as e:
                 downtime_intervals = caches['locmem'].get('downtime_intervals.no_expire', [])
                 logger.warning(repr(e))
@@ -1,26 +1,51 @@
 from math import cos, radians
 from collections import defaultdict
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, time, timedelta, timezone
+from threading import Lock
 from django.core.serializers.json import DjangoJSONEncoder
 import json
 import hashlib
+import logging
+
+import numpy as np
+from pyslalib import slalib as sla
 
 from time_intervals.intervals import Intervals
 from rise_set.astrometry import (
     make_ra_dec_target, make_satellite_target, make_hour_angle_target, make_minor_planet_target, mean_to_apparent,
-    make_comet_target, make_major_planet_target, angular_distance_between, date_to_tdb
+    make_comet_target, make_major_planet_target, angular_distance_between, date_to_tdb, calculate_airmass_at_times
 )
 from rise_set.angle import Angle
 from rise_set.rates import ProperMotion
 from rise_set.visibility import Visibility
 from rise_set.exceptions import MovingViolation
+from rise_set.utils import is_moving_object
 from django.core.cache import cache, caches
+from django.conf import settings
 
 from observation_portal.common.configdb import configdb, ConfigDB
 from observation_portal.common.downtimedb import DowntimeDB
 from observation_portal.requestgroups.target_helpers import TARGET_TYPE_HELPER_MAP
 
 HOURS_PER_DEGREES = 15.0
+MOVING_VIOLATION = 'MOVING_VIOLATION'
+MJD_EPOCH = np.datetime64('1858-11-17T00:00')
+SECONDS_TO_RADIANS = 7.272205217643039903848712e-5
+# The standard atmosphere rise_set assumes when computing airmass
+STANDARD_TEMPERATURE = 273.15  # K
+STANDARD_PRESSURE = 1013.25  # mb
+STANDARD_RELATIVE_HUMIDITY = 0.3
+STANDARD_WAVELENGTH = 0.55  # microns
+TROPOSPHERIC_LAPSE_RATE = 0.0065  # K per metre
+# Below this cosine of the zenith distance slalib refines the refraction with its full atmosphere model
+REFRACTION_ZENITH_BREAK = 0.242535625
+
+_rise_set_executor = None
+_rise_set_executor_lock = Lock()
+
+logger = logging.getLogger(__name__)
 
 
 def get_largest_interval(intervals_by_site):
@@ -47,6 +72,7 @@ def get_rise_set_intervals_by_site(request: dict, only_schedulable: bool = False
         only_schedulable=only_schedulable
     )
     intervals_by_site = {}
+    sites_to_compute = []
     for site in site_details:
         intervals_by_site[site] = None
         if request.get('id'):
@@ -55,45 +81,160 @@ def get_rise_set_intervals_by_site(request: dict, only_schedulable: bool = False
         else:
             cache_key = 'rise_set_intervals_' + site + '_' + str(hashlib.sha1(json.dumps(request, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest())
             intervals_by_site[site] = caches['locmem'].get(cache_key, None)
-
         if intervals_by_site[site] is None:
-            # There is no cached rise_set intervals for this request and site, so recalculate it now
-            intervals_by_site[site] = []
-            rise_set_site = get_rise_set_site(site_details[site])
-            unique_targets_constraints = set([json.dumps((configuration['target'], configuration['constraints'])) for configuration in request['configurations']])
-
-            for window in request['windows']:
-                visibility = get_rise_set_visibility(rise_set_site, window['start'], window['end'], site_details[site])
-                target_intervals = Intervals()
-                first_target = True
-                for target_constraints in unique_targets_constraints:
-                    (target, constraints) = json.loads(target_constraints)
-                    rise_set_target = get_rise_set_target(target)
-                    try:
-                        rs_interval = visibility.get_observable_intervals(
-                            rise_set_target,
-                            airmass=constraints['max_airmass'],
-                            moon_distance=Angle(
-                                degrees=constraints['min_lunar_distance']
-                            )
-                        )
-                        # We only want times when all targets are visible to keep things simple
-                        if first_target:
-                            first_target = False
-                            target_intervals = Intervals(rs_interval)
-                        else:
-                            target_intervals = Intervals(rs_interval).intersect([target_intervals])
-                    except MovingViolation:
-                        pass
-                intervals_by_site[site].extend(target_intervals.toTupleList())
-
-            if request.get('id'):
-                cache.set(cache_key, intervals_by_site[site], 86400 * 30)  # cache for 30 days
-            else:
-                caches['locmem'].set(cache_key, intervals_by_site[site], 300) # cache for 5 minutes
+            sites_to_compute.append((site, cache_key))
+
+    if not sites_to_compute:
+        return intervals_by_site
+
+    # There are no cached rise_set intervals for this request at these sites, so recalculate them now. Every
+    # site x window x unique target is computed up front so they can be spread out over the rise_set executor.
+    unique_targets_constraints = [
+        json.loads(target_constraints) for target_constraints in
+        set([json.dumps((configuration['target'], configuration['constraints'])) for configuration in request['configurations']])
+    ]
+    observable_intervals = iter(get_many_observable_intervals([
+        (target, constraints, site_details[site], window)
+        for site, _ in sites_to_compute
+        for window in request['windows']
+        for target, constraints in unique_targets_constraints
+    ]))
+    for site, cache_key in sites_to_compute:
+        intervals_by_site[site] = []
+        for _ in request['windows']:
+            target_intervals = Intervals()
+            first_target = True
+            for _ in unique_targets_constraints:
+                rs_interval = next(observable_intervals)
+                if rs_interval is None:
+                    # The target could not be computed, so it does not restrict the intervals
+                    continue
+                # We only want times when all targets are visible to keep things simple
+                if first_target:
+                    first_target = False
+                    target_intervals = Intervals(rs_interval)
+                else:
+                    target_intervals = Intervals(rs_interval).intersect([target_intervals])
+            intervals_by_site[site].extend(target_intervals.toTupleList())
+
+        if request.get('id'):
+            cache.set(cache_key, intervals_by_site[site], 86400 * 30)  # cache for 30 days
+        else:
+            caches['locmem'].set(cache_key, intervals_by_site[site], 300) # cache for 5 minutes
     return intervals_by_site
 
 
+def get_rise_set_executor():
+    """Get the process pool used to compute rise_set intervals
+
+    The pool is created on first use and sized by the RISE_SET_PROCESSES setting.
+
+    Returns:
+        The process pool executor, or None if the intervals should be computed serially
+    """
+    global _rise_set_executor
+    if _rise_set_executor is None and settings.RISE_SET_PROCESSES > 0:
+        with _rise_set_executor_lock:
+            if _rise_set_executor is None:
+                _rise_set_executor = ProcessPoolExecutor(max_workers=settings.RISE_SET_PROCESSES)
+    return _rise_set_executor
+
+
+def reset_rise_set_executor(executor):
+    """Drop a broken process pool so that the next call to get_rise_set_executor creates a new one"""
+    global _rise_set_executor
+    with _rise_set_executor_lock:
+        if _rise_set_executor is executor:
+            _rise_set_executor = None
+    executor.shutdown(wait=False)
+
+
+def compute_observable_intervals(target: dict, constraints: dict, site_detail: dict, window: dict):
+    """Compute the observable intervals of a single target at a site within a window
+
+    This is pure CPU work with no cache or db access, so it is safe to run in the rise_set executor.
+
+    Returns:
+        List of (start, end) tuples, or MOVING_VIOLATION if the target's motion could not be computed
+    """
+    visibility = get_rise_set_visibility(get_rise_set_site(site_detail), window['start'], window['end'], site_detail)
+    try:
+        return visibility.get_observable_intervals(
+            get_rise_set_target(target),
+            airmass=constraints['max_airmass'],
+            moon_distance=Angle(
+                degrees=constraints['min_lunar_distance']
+            )
+        )
+    except MovingViolation:
+        return MOVING_VIOLATION
+
+
+def get_observable_intervals_cache_key(target: dict, constraints: dict, site_detail: dict, window: dict) -> str:
+    visibility_target = {field: value for field, value in target.items() if field not in ['name', 'extra_params']}
+    return 'observable_intervals_' + hashlib.sha1(json.dumps({
+        'target': visibility_target,
+        'max_airmass': constraints['max_airmass'],
+        'min_lunar_distance': constraints['min_lunar_distance'],
+        'site': site_detail,
+        'start': window['start'],
+        'end': window['end']
+    }, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def get_many_observable_intervals(target_constraints_site_windows: list) -> list:
+    """Get the observable intervals for many (target, constraints, site_detail, window) tuples
+
+    The intervals are stored in the shared cache keyed only by what affects visibility, so the same target with the
+    same constraints is only computed once no matter which request or worker asks for it. The intervals that are not
+    cached yet are computed in the rise_set executor if one is configured, otherwise serially.
+
+    Parameters:
+        target_constraints_site_windows: List of (target, constraints, site_detail, window) tuples
+    Returns:
+        List of the observable intervals in the same order as the input, each a list of (start, end) tuples or None
+        if the target's motion could not be computed
+    """
+    cache_keys = [get_observable_intervals_cache_key(*args) for args in target_constraints_site_windows]
+    observable_intervals = cache.get_many(cache_keys)
+    missing = {}
+    for cache_key, args in zip(cache_keys, target_constraints_site_windows):
+        if cache_key not in observable_intervals:
+            missing[cache_key] = args
+    if missing:
+        executor = get_rise_set_executor()
+        computed_intervals = None
+        if executor:
+            try:
+                computed_intervals = list(executor.map(compute_observable_intervals, *zip(*missing.values())))
+            except BrokenProcessPool:
+                # A worker died, for example by being killed for using too much memory
+                logger.exception('The rise_set process pool is broken, computing the intervals serially')
+                reset_rise_set_executor(executor)
+        if computed_intervals is None:
+            computed_intervals = [compute_observable_intervals(*args) for args in missing.values()]
+        computed_intervals = dict(zip(missing.keys(), computed_intervals))
+        cache.set_many(computed_intervals, 86400 * 30)  # cache for 30 days
+        observable_intervals.update(computed_intervals)
+
+    return [None if observable_intervals[cache_key] == MOVING_VIOLATION else observable_intervals[cache_key]
+            for cache_key in cache_keys]
+
+
+def get_observable_intervals(target: dict, constraints: dict, site_detail: dict, window: dict):
+    """Get the observable intervals of a single target at a site within a window
+
+    Parameters:
+        target: The target dict
+        constraints: The constraints dict, of which only max_airmass and min_lunar_distance are used
+        site_detail: The location details of the site
+        window: The window dict with start and end times
+    Returns:
+        List of (start, end) tuples, or None if the target's motion could not be computed
+    """
+    return get_many_observable_intervals([(target, constraints, site_detail, window)])[0]
+
+
 def get_filtered_rise_set_intervals_by_site(request_dict, site='', is_staff=False):
     intervals = {}
     site = site if site else request_dict['location'].get('site', '')
@@ -169,11 +310,18 @@ def filter_out_downtime_from_intervalsets(intervalsets_by_telescope: dict, instr
     for telescope in intervalsets_by_telescope.keys():
         filtered_intervalsets_by_telescope[telescope] = intervalsets_by_telescope[telescope]
         if telescope in downtime_intervals:
+            telescope_intervals = intervalsets_by_telescope[telescope].toTupleList()
+            if not telescope_intervals:
+                continue
+            # Only the downtime within the span of the rise_set intervals can affect them
+            window_start, window_end = telescope_intervals[0][0], telescope_intervals[-1][1]
             for instrument_type_code, intervals in downtime_intervals[telescope].items():
                 if instrument_type_code == 'all' or instrument_type_code.upper() == instrument_type.upper():
-                    filtered_intervalsets_by_telescope[telescope] = filtered_intervalsets_by_telescope[telescope].subtract(
-                        intervals
-                    )
+                    overlapping_downtime = intervals.overlapping(window_start, window_end)
+                    if overlapping_downtime:
+                        filtered_intervalsets_by_telescope[telescope] = filtered_intervalsets_by_telescope[telescope].subtract(
+                            Intervals(overlapping_downtime)
+                        )
     return filtered_intervalsets_by_telescope
 
 
@@ -323,12 +471,213 @@ def get_rise_set_visibility(rise_set_site, start, end, site_detail):
 
 
 def get_site_rise_set_intervals(start, end, site_code):
+    """Get the nautical twilight dark intervals at a site between start and end
+
+    The intervals are sliced out of the per day dark interval calendar of the site, which is extended on demand
+    for any days in the range that have not been computed yet.
+    """
     site_details = configdb.get_sites_with_instrument_type_and_location(site_code=site_code)
-    if site_code in site_details:
-        site_detail = site_details[site_code]
-        rise_set_site = get_rise_set_site(site_detail)
-        v = get_rise_set_visibility(rise_set_site, start, end, site_detail)
+    if site_code not in site_details:
+        return []
+
+    first_day = start.astimezone(timezone.utc).date()
+    last_day = (end - timedelta(microseconds=1)).astimezone(timezone.utc).date()
+    dark_intervals_by_day = get_site_dark_intervals_by_day(site_code, site_details[site_code], first_day, last_day)
+    intervals = []
+    for day in sorted(dark_intervals_by_day):
+        for dark_start, dark_end in dark_intervals_by_day[day]:
+            dark_start = max(dark_start, start)
+            dark_end = min(dark_end, end)
+            if dark_start >= dark_end:
+                continue
+            if intervals and intervals[-1][1] == dark_start:
+                # The night was split across the day boundary in the calendar, so stitch it back together
+                intervals[-1] = (intervals[-1][0], dark_end)
+            else:
+                intervals.append((dark_start, dark_end))
+    return intervals
+
 
-        return v.get_dark_intervals()
+def get_site_dark_intervals_by_day(site_code, site_detail, first_day, last_day):
+    """Get the dark interval calendar of a site for every UTC day from first_day to last_day inclusive
 
-    return []
+    The sun does not care about requests, so each day is computed once and stored. Missing days are computed in
+    contiguous runs so that a whole semester only needs one Visibility.
+
+    Returns:
+        Dict of date to list of (start, end) tuples of the dark intervals within that day
+    """
+    days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+    cache_keys = {day: get_site_dark_intervals_cache_key(site_code, site_detail, day) for day in days}
+    cached_intervals = cache.get_many(cache_keys.values())
+    dark_intervals_by_day = {}
+    missing_runs = []
+    for day in days:
+        if cache_keys[day] in cached_intervals:
+            dark_intervals_by_day[day] = cached_intervals[cache_keys[day]]
+        elif missing_runs and missing_runs[-1][1] == day - timedelta(days=1):
+            missing_runs[-1][1] = day
+        else:
+            missing_runs.append([day, day])
+
+    rise_set_site = get_rise_set_site(site_detail)
+    for run_first_day, run_last_day in missing_runs:
+        run_start = datetime.combine(run_first_day, time.min, tzinfo=timezone.utc)
+        run_end = datetime.combine(run_last_day + timedelta(days=1), time.min, tzinfo=timezone.utc)
+        computed_intervals = {run_first_day + timedelta(days=i): [] for i in range((run_last_day - run_first_day).days + 1)}
+        visibility = get_rise_set_visibility(rise_set_site, run_start, run_end, site_detail)
+        for dark_start, dark_end in visibility.get_dark_intervals():
+            while dark_start < dark_end:
+                day_end = datetime.combine(dark_start.date() + timedelta(days=1), time.min, tzinfo=timezone.utc)
+                computed_intervals[dark_start.date()].append((dark_start, min(dark_end, day_end)))
+                dark_start = day_end
+        cache.set_many({cache_keys[day]: intervals for day, intervals in computed_intervals.items()}, 86400 * 365)
+        dark_intervals_by_day.update(computed_intervals)
+    return dark_intervals_by_day
+
+
+def get_site_dark_intervals_cache_key(site_code: str, site_detail: dict, day) -> str:
+    # The site details are part of the key so that a change to the site in ConfigDB computes a new calendar
+    site_hash = hashlib.sha1(json.dumps(site_detail, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+    return 'site_dark_intervals_{}_{}_{}'.format(site_code, site_hash, day.isoformat())
+
+
+def precompute_site_dark_intervals(start, end):
+    """Fill in the dark interval calendar of every site between start and end"""
+    site_details = configdb.get_sites_with_instrument_type_and_location()
+    for site_code, site_detail in site_details.items():
+        get_site_dark_intervals_by_day(
+            site_code, site_detail, start.astimezone(timezone.utc).date(),
+            (end - timedelta(microseconds=1)).astimezone(timezone.utc).date()
+        )
+
+
+def get_airmasses_at_sites(rs_targets: list, times_by_site: dict, site_details: dict) -> dict:
+    """Compute the airmass of every target at every sample time of every site in one pass
+
+    This follows rise_set's calculate_airmass_at_times, which uses slalib's apparent to observed place routines.
+    Sidereal targets are converted to their apparent place once per UTC day of sample times, and then evaluated
+    against the sample times of all sites together as arrays. Moving targets need their orbit propagated at each
+    time, so they fall back to calculate_airmass_at_times.
+
+    Up to an airmass of 25, the largest max_airmass a request can have, the airmasses agree with
+    calculate_airmass_at_times to within 2e-5 relative over a day of sample times. calculate_airmass_at_times only
+    refreshes the sidereal time of its slalib parameters after the first time, so over longer spans it drifts from
+    slalib evaluated at each time, which this follows.
+
+    Parameters:
+        rs_targets: List of rise_set targets
+        times_by_site: Dict of site code to numpy datetime64 array of UTC sample times
+        site_details: Dict of site code to the location details of the site
+    Returns:
+        Dict of site code to a 2d array of airmasses indexed by target and then by sample time
+    """
+    sites = [site for site, times in times_by_site.items() if len(times) > 0]
+    if not sites or not rs_targets:
+        return {}
+    times = np.concatenate([times_by_site[site] for site in sites])
+    offsets = np.cumsum([0] + [len(times_by_site[site]) for site in sites])
+    latitudes = np.radians(np.repeat([site_details[site]['latitude'] for site in sites], np.diff(offsets)))
+    longitudes = np.radians(np.repeat([site_details[site]['longitude'] for site in sites], np.diff(offsets)))
+    altitudes = np.repeat([site_details[site]['altitude'] for site in sites], np.diff(offsets))
+    mjds = (times - MJD_EPOCH) / np.timedelta64(1, 'D')
+    # The apparent places and the equation of the equinoxes change slowly, so they are computed at midday of each
+    # UTC day that has sample times
+    days, day_indices = np.unique(times.astype('datetime64[D]'), return_inverse=True)
+    tdbs = [date_to_tdb((day + np.timedelta64(12, 'h')).astype(datetime)) for day in days]
+    equation_of_equinoxes = np.array([sla.sla_eqeqx(tdb) for tdb in tdbs])
+    local_sidereal_times = get_greenwich_mean_sidereal_time(mjds) + longitudes + equation_of_equinoxes[day_indices]
+
+    airmasses = np.empty((len(rs_targets), len(times)))
+    sidereal_indices = [index for index, rs_target in enumerate(rs_targets) if not is_moving_object(rs_target)]
+    if sidereal_indices:
+        apparent_places = [[mean_to_apparent(rs_targets[index], tdb) for tdb in tdbs] for index in sidereal_indices]
+        ras = np.array([[ra.in_radians() for ra, _ in places] for places in apparent_places])[:, day_indices]
+        decs = np.array([[dec.in_radians() for _, dec in places] for places in apparent_places])[:, day_indices]
+        cos_zenith_distances = (np.sin(latitudes) * np.sin(decs) +
+                                np.cos(latitudes) * np.cos(decs) * np.cos(local_sidereal_times - ras))
+        zenith_distances = np.arccos(np.clip(cos_zenith_distances, -1.0, 1.0))
+        airmasses[sidereal_indices] = zenith_distance_to_airmass(
+            refract_zenith_distances(zenith_distances, latitudes, altitudes)
+        )
+    for index, rs_target in enumerate(rs_targets):
+        if index in sidereal_indices:
+            continue
+        for site, start, end in zip(sites, offsets[:-1], offsets[1:]):
+            airmasses[index, start:end] = calculate_airmass_at_times(
+                times_by_site[site].astype('datetime64[us]').tolist(), rs_target,
+                Angle(degrees=site_details[site]['latitude']), Angle(degrees=site_details[site]['longitude']),
+                site_details[site]['altitude']
+            )
+    return {site: airmasses[:, start:end] for site, start, end in zip(sites, offsets[:-1], offsets[1:])}
+
+
+def get_greenwich_mean_sidereal_time(ut1_mjds):
+    """Greenwich mean sidereal time in radians for an array of UT1 MJDs, as slalib's sla_gmst"""
+    tu = (ut1_mjds - 51544.5) / 36525.0
+    gmst = (np.mod(ut1_mjds, 1.0) * 2 * np.pi +
+            (24110.54841 + (8640184.812866 + (0.093104 - 6.2e-6 * tu) * tu) * tu) * SECONDS_TO_RADIANS)
+    return np.mod(gmst, 2 * np.pi)
+
+
+def refract_zenith_distances(zenith_distances, latitudes, altitudes):
+    """Observed zenith distances for an array of topocentric zenith distances in radians, as slalib's sla_aopqk
+
+    The refraction coefficients of the standard atmosphere are computed with sla_refco for each site altitude and
+    applied with the model of sla_refz as arrays. Zenith distances close to the horizon are refined with the
+    full sla_refro integration, as slalib does.
+
+    Parameters:
+        zenith_distances: 2d array of zenith distances indexed by target and then by sample time
+        latitudes: Array of the site latitude in radians of each sample time
+        altitudes: Array of the site altitude in metres of each sample time
+    """
+    refraction_coefficients = {
+        (latitude, altitude): sla.sla_refco(
+            altitude, STANDARD_TEMPERATURE, STANDARD_PRESSURE, STANDARD_RELATIVE_HUMIDITY, STANDARD_WAVELENGTH,
+            latitude, TROPOSPHERIC_LAPSE_RATE, 1e-10
+        )
+        for latitude, altitude in set(zip(latitudes, altitudes))
+    }
+    refa, refb = np.array([refraction_coefficients[location] for location in zip(latitudes, altitudes)]).T
+
+    # sla_refz: the refraction is modelled on tan z up to 83 degrees and scaled by an empirical fit below that
+    c1, c2, c3, c4, c5 = 0.55445, -0.01133, 0.00202, 0.28385, 0.02390
+    ref83 = (c1 + c2 * 7.0 + c3 * 49.0) / (1.0 + c4 * 7.0 + c5 * 49.0)
+    zu1 = np.minimum(zenith_distances, np.radians(83.0))
+    tan_zu1 = np.tan(zu1)
+    zl = zu1 - (refa * tan_zu1 + refb * tan_zu1 ** 3) / (1.0 + (refa + 3.0 * refb * tan_zu1 ** 2) / np.cos(zu1) ** 2)
+    tan_zl = np.tan(zl)
+    refraction = zu1 - zl + (zl - zu1 + refa * tan_zl + refb * tan_zl ** 3) / (
+        1.0 + (refa + 3.0 * refb * tan_zl ** 2) / np.cos(zl) ** 2
+    )
+    elevations = 90.0 - np.minimum(93.0, np.degrees(zenith_distances))
+    refraction = np.where(
+        zenith_distances > zu1,
+        (refraction / ref83) * (c1 + c2 * elevations + c3 * elevations ** 2) /
+        (1.0 + c4 * elevations + c5 * elevations ** 2),
+        refraction
+    )
+    observed_zenith_distances = zenith_distances - refraction
+
+    for index in zip(*np.nonzero(np.cos(observed_zenith_distances) < REFRACTION_ZENITH_BREAK)):
+        sample = index[-1]
+        for _ in range(10):
+            delta_refraction = sla.sla_refro(
+                observed_zenith_distances[index], altitudes[sample], STANDARD_TEMPERATURE, STANDARD_PRESSURE,
+                STANDARD_RELATIVE_HUMIDITY, STANDARD_WAVELENGTH, latitudes[sample], TROPOSPHERIC_LAPSE_RATE, 1e-8
+            )
+            delta_zenith_distance = observed_zenith_distances[index] + delta_refraction - zenith_distances[index]
+            observed_zenith_distances[index] -= delta_zenith_distance
+            if abs(delta_zenith_distance) <= 1e-10:
+                break
+    return observed_zenith_distances
+
+
+def zenith_distance_to_airmass(zenith_distances):
+    """Airmass for an array of observed zenith distances in radians, as slalib's sla_airmas
+
+    The airmass is clamped at a zenith distance of 1.52 radians.
+    """
+    seczm1 = 1.0 / np.cos(np.minimum(np.abs(zenith_distances), 1.52)) - 1.0
+    return 1.0 + seczm1 * (0.9981833 - seczm1 * (0.002875 + 0.0008083 * seczm1))
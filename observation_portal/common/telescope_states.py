@@ -1,21 +1,44 @@
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from elasticsearch import Elasticsearch
 from elasticsearch import exceptions as es_exceptions
-from datetime import timedelta
+from datetime import datetime, time, timedelta
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
-from copy import deepcopy
 from collections import OrderedDict
+from threading import Lock
 import logging
+import copy
 from dateutil.parser import parse
+import numpy as np
 
 from observation_portal.common.configdb import configdb, TelescopeKey
 from observation_portal.common.rise_set_utils import get_site_rise_set_intervals
+from observation_portal.requestgroups.models import TelescopeAvailability, MaterializedAvailabilityDay
 
 logger = logging.getLogger(__name__)
 
 ES_STRING_FORMATTER = "%Y-%m-%d %H:%M:%S"
 
+# Telescope states are cached per telescope in buckets of this size, aligned to UTC midnight
+TELESCOPE_STATES_BUCKET_SIZE = timedelta(days=1)
+TELESCOPE_STATES_CACHE_KEY = 'telescope_states_{}_{}'
+# Buckets that ended longer ago than this should not receive new telemetry, so they are cached for longer. They are
+# still refreshed now and then in case telemetry was ingested late, and empty ones are not kept any longer than
+# the current buckets.
+TELESCOPE_STATES_SETTLE_TIME = timedelta(hours=1)
+TELESCOPE_STATES_SETTLED_BUCKET_TIMEOUT = 86400
+TELESCOPE_STATES_CURRENT_BUCKET_TIMEOUT = 60
+
+# Telescope states further apart than this belong to different observing nights
+NIGHT_GAP = timedelta(hours=4)
+# Observing nights that started on or before this many days ago have finished, so their availability will not change
+COMPLETED_NIGHT_AGE = timedelta(days=2)
+
+_es_client = None
+_es_client_lock = Lock()
+
 
 class ElasticSearchException(Exception):
     pass
@@ -25,6 +48,27 @@ def string_to_datetime(timestamp):
     return parse(timestamp).replace(tzinfo=timezone.utc)
 
 
+def get_es_client():
+    """Get the Elasticsearch client shared by this process, so its connection pool is reused across requests
+
+    The client is created on first use rather than at import, so forked workers do not share its connections.
+    """
+    global _es_client
+    if _es_client is None:
+        with _es_client_lock:
+            if _es_client is None:
+                if not settings.ELASTICSEARCH_URL:
+                    raise ImproperlyConfigured("ELASTICSEARCH_URL")
+                _es_client = Elasticsearch(
+                    [settings.ELASTICSEARCH_URL],
+                    maxsize=settings.ELASTICSEARCH_POOL_SIZE,
+                    timeout=settings.ELASTICSEARCH_TIMEOUT,
+                    max_retries=settings.ELASTICSEARCH_MAX_RETRIES,
+                    retry_on_timeout=True
+                )
+    return _es_client
+
+
 class TelescopeStates(object):
     EVENT_CATEGORIES = OrderedDict([
         ('Site Agent: ', 'SITE_AGENT_UNRESPONSIVE'),
@@ -36,9 +80,7 @@ class TelescopeStates(object):
 
     def __init__(self, start, end, telescopes=None, sites=None, instrument_types=None, location_dict=None, only_schedulable=True):
         try:
-            if not settings.ELASTICSEARCH_URL:
-                raise ImproperlyConfigured("ELASTICSEARCH_URL")
-            self.es = Elasticsearch([settings.ELASTICSEARCH_URL])
+            self.es = get_es_client()
         except Exception:
             self.es = None
             logger.exception('Could not connect to Elasticsearch host. Make sure ELASTICSEARCH_URL is set properly. For now, it will be ignored.')
@@ -51,9 +93,10 @@ class TelescopeStates(object):
         telescopes = list({tk.telescope for tk in self.available_telescopes if tk.site in sites}) \
             if not telescopes else telescopes
 
+        self.telescopes = [tk for tk in self.available_telescopes if tk.site in sites and tk.telescope in telescopes]
+
         self.start = start.replace(tzinfo=timezone.utc).replace(microsecond=0)
         self.end = end.replace(tzinfo=timezone.utc).replace(microsecond=0)
-        self.event_data = self._get_es_data(sites, telescopes)
 
     def _get_available_telescopes(self, location_dict=None):
         telescope_to_instruments = configdb.get_instrument_types_per_telescope(location=location_dict,
@@ -65,10 +108,10 @@ class TelescopeStates(object):
                                     any(inst in insts for inst in self.instrument_types)]
         return available_telescopes
 
-    def _get_es_data(self, sites, telescopes):
+    def _get_es_data(self, sites, telescopes, start, end):
         event_data = []
         if self.es:
-            lower_query_time = min(self.start, timezone.now())
+            lower_query_time = min(start, timezone.now())
             datum_query = {
                 "query": {
                     "bool": {
@@ -83,7 +126,7 @@ class TelescopeStates(object):
                                     "timestamp": {
                                         # Retrieve documents 1 day back to ensure you get at least one datum per telescope.
                                         "gte": (lower_query_time - timedelta(days=1)).strftime(ES_STRING_FORMATTER),
-                                        "lte": self.end.strftime(ES_STRING_FORMATTER),
+                                        "lte": end.strftime(ES_STRING_FORMATTER),
                                         "format": "yyyy-MM-dd HH:mm:ss"
                                     }
                                 }
@@ -102,37 +145,227 @@ class TelescopeStates(object):
                     }
                 }
             }
-            query_size = 10000
-
             try:
-                data = self.es.search(
-                    index="mysql-telemetry-*", body=datum_query, size=query_size, scroll='1m',  # noqa
-                    _source=['timestamp', 'telescope', 'observatory', 'site', 'value_string'],
-                    sort=['site', 'observatory', 'telescope', 'timestamp']
-                )
+                if settings.TELESCOPE_STATES_AGGREGATION_INTERVAL:
+                    event_data = self._get_es_aggregated_data(
+                        datum_query, len(sites), len(telescopes), settings.TELESCOPE_STATES_AGGREGATION_INTERVAL
+                    )
+                else:
+                    event_data = self._get_es_scrolled_data(datum_query)
             except es_exceptions.ConnectionError:
                 raise ElasticSearchException
+        return event_data
 
-            event_data.extend(data['hits']['hits'])
-            total_events = data['hits']['total']
-            events_read = min(query_size, total_events)
+    def _get_es_scrolled_data(self, datum_query):
+        event_data = []
+        query_size = 10000
+        data = self.es.search(
+            index="mysql-telemetry-*", body=datum_query, size=query_size, scroll='1m',  # noqa
+            _source=['timestamp', 'telescope', 'observatory', 'site', 'value_string'],
+            sort=['site', 'observatory', 'telescope', 'timestamp']
+        )
+        event_data.extend(data['hits']['hits'])
+        total_events = data['hits']['total']
+        events_read = min(query_size, total_events)
+        scroll_id = data.get('_scroll_id', 0)
+        while events_read < total_events:
+            data = self.es.scroll(scroll_id=scroll_id, scroll='1m') # noqa
             scroll_id = data.get('_scroll_id', 0)
-            while events_read < total_events:
-                data = self.es.scroll(scroll_id=scroll_id, scroll='1m') # noqa
-                scroll_id = data.get('_scroll_id', 0)
-                event_data.extend(data['hits']['hits'])
-                events_read += len(data['hits']['hits'])
+            event_data.extend(data['hits']['hits'])
+            events_read += len(data['hits']['hits'])
         return event_data
 
+    def _get_es_aggregated_data(self, datum_query, num_sites, num_telescopes, interval):
+        """ Retrieve the state transitions instead of every datum by letting ES aggregate them
+
+            The datums of each telescope are grouped into histogram buckets of the given interval, and only the first
+            and last timestamp of each distinct reason within a bucket come back. That is exact for buckets with a
+            single reason. The order of the reasons within a bucket with more than one is lost, so the datums of
+            those buckets are scrolled through instead.
+        """
+        timestamp_format = "yyyy-MM-dd HH:mm:ss"
+        aggregation_query = dict(datum_query)
+        aggregation_query['aggs'] = {
+            "sites": {
+                "terms": {"field": "site", "size": num_sites},
+                "aggs": {
+                    "enclosures": {
+                        # Every enclosure at a site could hold one of the requested telescopes
+                        "terms": {"field": "observatory", "size": num_sites * num_telescopes},
+                        "aggs": {
+                            "telescopes": {
+                                "terms": {"field": "telescope", "size": num_telescopes},
+                                "aggs": {
+                                    "intervals": {
+                                        "date_histogram": {
+                                            "field": "timestamp", "interval": interval, "min_doc_count": 1
+                                        },
+                                        "aggs": {
+                                            "reasons": {
+                                                "terms": {"field": "value_string", "missing": "", "size": 100},
+                                                "aggs": {
+                                                    "first": {"min": {"field": "timestamp", "format": timestamp_format}},
+                                                    "last": {"max": {"field": "timestamp", "format": timestamp_format}}
+                                                }
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        data = self.es.search(index="mysql-telemetry-*", body=aggregation_query, size=0)  # noqa
+
+        event_data = []
+        changed_ranges = []
+        for site in data['aggregations']['sites']['buckets']:
+            for enclosure in site['enclosures']['buckets']:
+                for telescope in enclosure['telescopes']['buckets']:
+                    for interval_bucket in telescope['intervals']['buckets']:
+                        reasons = interval_bucket['reasons']['buckets']
+                        if len(reasons) > 1:
+                            changed_ranges.append((
+                                site['key'], enclosure['key'], telescope['key'],
+                                min(reason['first']['value_as_string'] for reason in reasons),
+                                max(reason['last']['value_as_string'] for reason in reasons)
+                            ))
+                            continue
+                        for reason in reasons:
+                            for timestamp in {reason['first']['value_as_string'], reason['last']['value_as_string']}:
+                                event_data.append({'_source': {
+                                    'timestamp': timestamp,
+                                    'site': site['key'],
+                                    'observatory': enclosure['key'],
+                                    'telescope': telescope['key'],
+                                    'value_string': reason['key']
+                                }})
+        if changed_ranges:
+            event_data.extend(self._get_es_scrolled_data(self._get_changed_ranges_query(datum_query, changed_ranges)))
+        event_data.sort(key=lambda event: (
+            event['_source']['site'], event['_source']['observatory'], event['_source']['telescope'],
+            event['_source']['timestamp']
+        ))
+        return event_data
+
+    @staticmethod
+    def _get_changed_ranges_query(datum_query, changed_ranges):
+        """ Restrict the datum query to the datums of each telescope within its time ranges where the reason changed """
+        changed_ranges_query = copy.deepcopy(datum_query)
+        changed_ranges_query['query']['bool']['filter'].append({
+            "bool": {
+                "should": [
+                    {
+                        "bool": {
+                            "filter": [
+                                {"term": {"site": site}},
+                                {"term": {"observatory": enclosure}},
+                                {"term": {"telescope": telescope}},
+                                {"range": {"timestamp": {"gte": first, "lte": last, "format": "yyyy-MM-dd HH:mm:ss"}}}
+                            ]
+                        }
+                    }
+                    for site, enclosure, telescope, first, last in changed_ranges
+                ],
+                "minimum_should_match": 1
+            }
+        })
+        return changed_ranges_query
+
     def get(self):
+        buckets = self._get_buckets(self.start, self.end)
+        cache_keys = {
+            (telescope_key, bucket): TELESCOPE_STATES_CACHE_KEY.format(telescope_key, bucket.isoformat())
+            for telescope_key in self.telescopes for bucket in buckets
+        }
+        cached_states = cache.get_many(list(cache_keys.values()))
+        bucket_states = {
+            bucket_key: cached_states[cache_key] for bucket_key, cache_key in cache_keys.items()
+            if cache_key in cached_states
+        }
+        missing_buckets = [bucket_key for bucket_key in cache_keys if bucket_key not in bucket_states]
+        if missing_buckets:
+            computed_states = self._get_bucket_states(missing_buckets)
+            bucket_states.update(computed_states)
+            self._cache_bucket_states(computed_states, cache_keys)
+
+        telescope_states = {}
+        for telescope_key in self.telescopes:
+            lumps = []
+            for bucket in buckets:
+                for bucket_lump in bucket_states[(telescope_key, bucket)]:
+                    lump = dict(bucket_lump)
+                    lump['start'] = max(self.start, lump['start'])
+                    lump['end'] = min(self.end, lump['end'])
+                    if lump['start'] >= lump['end']:
+                        continue
+                    previous_lump = lumps[-1] if lumps else None
+                    if (previous_lump and previous_lump['end'] == lump['start'] and
+                            previous_lump['event_type'] == lump['event_type'] and
+                            previous_lump['event_reason'] == lump['event_reason']):
+                        # The same state continues across a bucket boundary
+                        previous_lump['end'] = lump['end']
+                    else:
+                        lumps.append(lump)
+            if lumps:
+                telescope_states[telescope_key] = lumps
+
+        return telescope_states
+
+    @staticmethod
+    def _get_buckets(start, end):
+        bucket = datetime.combine(start.date(), time.min, tzinfo=timezone.utc)
+        buckets = []
+        while bucket < end or not buckets:
+            buckets.append(bucket)
+            bucket += TELESCOPE_STATES_BUCKET_SIZE
+        return buckets
+
+    def _get_bucket_states(self, missing_buckets):
+        """ Compute the state lumps of each (telescope_key, bucket) in missing_buckets from a single ES query """
+        telescope_keys = {telescope_key for telescope_key, _ in missing_buckets}
+        start = min(bucket for _, bucket in missing_buckets)
+        end = max(bucket for _, bucket in missing_buckets) + TELESCOPE_STATES_BUCKET_SIZE
+        event_data = self._get_es_data(
+            sorted({tk.site for tk in telescope_keys}), sorted({tk.telescope for tk in telescope_keys}), start, end
+        )
+        telescope_states = self._get_lumps(event_data, telescope_keys, start, end)
+        bucket_states = {}
+        for telescope_key, bucket in missing_buckets:
+            bucket_end = bucket + TELESCOPE_STATES_BUCKET_SIZE
+            bucket_states[(telescope_key, bucket)] = [
+                dict(lump, start=max(bucket, lump['start']), end=min(bucket_end, lump['end']))
+                for lump in telescope_states.get(telescope_key, [])
+                if lump['start'] < bucket_end and lump['end'] > bucket
+            ]
+        return bucket_states
+
+    def _cache_bucket_states(self, bucket_states, cache_keys):
+        if not self.es:
+            # Nothing was actually retrieved, so there is nothing worth keeping
+            return
+        settled_states = {}
+        current_states = {}
+        settled_until = timezone.now() - TELESCOPE_STATES_SETTLE_TIME
+        for bucket_key, lumps in bucket_states.items():
+            if lumps and bucket_key[1] + TELESCOPE_STATES_BUCKET_SIZE <= settled_until:
+                settled_states[cache_keys[bucket_key]] = lumps
+            else:
+                current_states[cache_keys[bucket_key]] = lumps
+        cache.set_many(settled_states, TELESCOPE_STATES_SETTLED_BUCKET_TIMEOUT)
+        cache.set_many(current_states, TELESCOPE_STATES_CURRENT_BUCKET_TIMEOUT)
+
+    def _get_lumps(self, event_data, telescope_keys, start, end):
         telescope_states = {}
         current_lump = {'telescope': None}
 
-        for event in self.event_data:
+        for event in event_data:
             telcode = self._telescope(event['_source'])
-            if telcode not in self.available_telescopes:
+            if telcode not in telescope_keys:
                 if current_lump['telescope']:
-                    self._save_lump(telescope_states, current_lump, self.end)
+                    self._save_lump(telescope_states, current_lump, end, start, end)
                     current_lump = {'telescope': None}
                 continue
 
@@ -140,31 +373,33 @@ class TelescopeStates(object):
             event_type, event_reason = self._categorize(event['_source'])
 
             if current_lump['telescope'] and telcode != current_lump['telescope']:
-                telescope_states = self._save_lump(telescope_states, current_lump, self.end)
+                telescope_states = self._save_lump(telescope_states, current_lump, end, start, end)
                 current_lump = self._create_lump(telcode, event_type, event_reason, event_start)
-            elif event_start > self.end:
+            elif event_start > end:
                 if current_lump['telescope']:
-                    telescope_states = self._save_lump(telescope_states, current_lump, self.end)
+                    telescope_states = self._save_lump(telescope_states, current_lump, end, start, end)
                     current_lump = {'telescope': None}
-            elif event_start < self.start:
+            elif event_start < start:
                 current_lump = self._create_lump(telcode, event_type, event_reason, event_start)
             else:
                 if current_lump['telescope']:
                     if event_type != current_lump['event_type'] or event_reason != current_lump['event_reason']:
-                        telescope_states = self._save_lump(telescope_states, current_lump, min(self.end, event_start))
+                        telescope_states = self._save_lump(telescope_states, current_lump, min(end, event_start),
+                                                           start, end)
                         current_lump = self._create_lump(telcode, event_type, event_reason, event_start)
                 else:
                     current_lump = self._create_lump(telcode, event_type, event_reason, event_start)
 
         if current_lump['telescope']:
             # We have a final current lump we were in, so save it
-            self._save_lump(telescope_states, current_lump, self.end)
+            self._save_lump(telescope_states, current_lump, end, start, end)
 
         return telescope_states
 
-    def _save_lump(self, telescope_states, lump, end):
-        lump['end'] = min(self.end, end)
-        lump['start'] = max(self.start, lump['start'])
+    @staticmethod
+    def _save_lump(telescope_states, lump, lump_end, start, end):
+        lump['end'] = min(end, lump_end)
+        lump['start'] = max(start, lump['start'])
         telkey = lump['telescope']
         lump['telescope'] = str(lump['telescope'])
         if telkey not in telescope_states:
@@ -206,41 +441,34 @@ class TelescopeStates(object):
 
 
 def filter_telescope_states_by_intervals(telescope_states, sites_intervals, start, end):
+    """ Clip each telescope's state events to its site's intervals and to the start and end times
+
+        Both the events of a telescope and the intervals of a site are in time order and do not overlap, so they are
+        swept through together once instead of comparing every event against every interval.
+    """
     filtered_states = {}
     for telescope_key, events in telescope_states.items():
         # now loop through the events for the telescope, and tally the time the telescope is available for each 'day'
         if telescope_key.site in sites_intervals:
             site_intervals = sites_intervals[telescope_key.site]
             filtered_events = []
+            interval_index = 0
 
             for event in events:
                 event_start = max(event['start'], start)
                 event_end = min(event['end'], end)
-                for interval in site_intervals:
-                    if event_start >= interval[0] and event_end <= interval[1]:
-                        # the event is fully contained to add it and break out
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = event_start
-                        extra_event['end'] = event_end
-                        filtered_events.append(deepcopy(event))
-                    elif event_start < interval[0] and event_end > interval[1]:
-                        # start is before interval and end is after, so it spans the interval
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = interval[0]
-                        extra_event['end'] = interval[1]
-                        filtered_events.append(deepcopy(extra_event))
-                    elif event_start < interval[0] and event_end > interval[0] and event_end <= interval[1]:
-                        # start is before interval and end is in interval, so truncate start
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = interval[0]
-                        extra_event['end'] = event_end
-                        filtered_events.append(deepcopy(extra_event))
-                    elif event_start >= interval[0] and event_start < interval[1] and event_end > interval[1]:
-                        # start is within interval and end is after, so truncate end
-                        extra_event = deepcopy(event)
-                        extra_event['start'] = event_start
-                        extra_event['end'] = interval[1]
-                        filtered_events.append(deepcopy(extra_event))
+                if event_start >= event_end:
+                    continue
+                # skip the intervals that ended before this event, later events cannot overlap them either
+                while interval_index < len(site_intervals) and site_intervals[interval_index][1] <= event_start:
+                    interval_index += 1
+                overlapping_index = interval_index
+                while overlapping_index < len(site_intervals) and site_intervals[overlapping_index][0] < event_end:
+                    interval_start, interval_end = site_intervals[overlapping_index]
+                    filtered_events.append(
+                        dict(event, start=max(event_start, interval_start), end=min(event_end, interval_end))
+                    )
+                    overlapping_index += 1
 
             filtered_states[telescope_key] = filtered_events
 
@@ -259,53 +487,129 @@ def get_telescope_availability_per_day(start, end, telescopes=None, sites=None,
                                                                                  telescope_key.site)[1:]
     telescope_states = filter_telescope_states_by_intervals(telescope_states, rise_set_intervals, start, end)
     # now just compute a % available each day from the rise_set filtered set of events
-    telescope_availability = {}
-    for telescope_key, events in telescope_states.items():
-        telescope_availability[telescope_key] = []
-        time_available = timedelta(seconds=0)
-        time_total = timedelta(seconds=0)
-        if events:
-            current_day = list(events)[0]['start'].date()
-            current_end = list(events)[0]['start']
-        for event in events:
-            if (event['start'] - current_end) > timedelta(hours=4):
-                if (event['start'].date() != current_day):
-                    # we must be in a new observing day, so tally time in previous day and increment day counter
-                    telescope_availability[telescope_key].append([current_day, (
-                        time_available.total_seconds() / time_total.total_seconds())])
-                time_available = timedelta(seconds=0)
-                time_total = timedelta(seconds=0)
-                current_day = event['start'].date()
-
-            if 'AVAILABLE' == event['event_type'].upper():
-                time_available += event['end'] - event['start']
-            time_total += event['end'] - event['start']
-            current_end = event['end']
-
-        if time_total > timedelta():
-            telescope_availability[telescope_key].append([current_day, (
-                time_available.total_seconds() / time_total.total_seconds())])
+    return {
+        telescope_key: get_availability_per_night(events) for telescope_key, events in telescope_states.items()
+    }
 
+
+def get_last_completed_night():
+    return (timezone.now() - COMPLETED_NIGHT_AGE).date()
+
+
+def materialize_telescope_availability(first_day, last_day):
+    """ Store the availability of each telescope for the observing nights that started from first_day to last_day """
+    # Start a day early and end two days late so the stored nights are not cut off at the start or end time
+    start = datetime.combine(first_day - timedelta(days=1), time.min, tzinfo=timezone.utc)
+    end = datetime.combine(last_day + timedelta(days=2), time.min, tzinfo=timezone.utc)
+    telescope_availability = get_telescope_availability_per_day(start, end)
+    nightly_availabilities = [
+        TelescopeAvailability(
+            site=telescope_key.site, enclosure=telescope_key.enclosure, telescope=telescope_key.telescope,
+            day=day, availability=availability
+        )
+        for telescope_key, availabilities in telescope_availability.items()
+        for day, availability in availabilities if first_day <= day <= last_day
+    ]
+    if nightly_availabilities:
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        with transaction.atomic():
+            TelescopeAvailability.objects.filter(day__gte=first_day, day__lte=last_day).delete()
+            TelescopeAvailability.objects.bulk_create(nightly_availabilities)
+            MaterializedAvailabilityDay.objects.filter(day__in=days).delete()
+            MaterializedAvailabilityDay.objects.bulk_create([MaterializedAvailabilityDay(day=day) for day in days])
+    return len(nightly_availabilities)
+
+
+def get_materialized_telescope_availability_per_day(start, end, telescopes=None, sites=None):
+    """ Get the nightly availability of each telescope, reading completed nights from the materialized table
+
+        Days within the range that have not been materialized, such as the current nights or nights from before
+        the table was filled in, are computed from the telescope states in contiguous runs.
+    """
+    first_day = start.date()
+    last_day = (end - timedelta(microseconds=1)).date()
+    materialized_days = set(MaterializedAvailabilityDay.objects.filter(
+        day__gte=first_day, day__lte=min(last_day, get_last_completed_night())
+    ).values_list('day', flat=True))
+    telescope_availability = {}
+    materialized = TelescopeAvailability.objects.filter(day__in=materialized_days)
+    if sites:
+        materialized = materialized.filter(site__in=sites)
+    if telescopes:
+        materialized = materialized.filter(telescope__in=telescopes)
+    for site, enclosure, telescope, day, availability in materialized.values_list(
+            'site', 'enclosure', 'telescope', 'day', 'availability'):
+        telescope_availability.setdefault(TelescopeKey(site, enclosure, telescope), []).append([day, availability])
+
+    missing_runs = []
+    day = first_day
+    while day <= last_day:
+        if day not in materialized_days:
+            if missing_runs and missing_runs[-1][1] == day - timedelta(days=1):
+                missing_runs[-1][1] = day
+            else:
+                missing_runs.append([day, day])
+        day += timedelta(days=1)
+    for run_first_day, run_last_day in missing_runs:
+        # As when materializing, start a day early and end two days late so the nights are not cut off
+        live_start = max(start, datetime.combine(run_first_day - timedelta(days=1), time.min, tzinfo=timezone.utc))
+        live_end = min(end, datetime.combine(run_last_day + timedelta(days=2), time.min, tzinfo=timezone.utc))
+        live_availability = get_telescope_availability_per_day(live_start, live_end, telescopes, sites)
+        for telescope_key, availabilities in live_availability.items():
+            telescope_availability.setdefault(telescope_key, []).extend(
+                [day, availability] for day, availability in availabilities if run_first_day <= day <= run_last_day
+            )
+    for availabilities in telescope_availability.values():
+        availabilities.sort(key=lambda day_availability: day_availability[0])
     return telescope_availability
 
 
+def get_availability_per_night(events):
+    """ Get the [day, fraction available] of each observing night covered by the time ordered events
+
+        A gap of more than NIGHT_GAP between events starts a new night, which is labelled by the date its first event
+        starts on. Only the last of several nights starting on the same date is kept.
+    """
+    if not events:
+        return []
+    starts = np.array([event['start'].timestamp() for event in events])
+    ends = np.array([event['end'].timestamp() for event in events])
+    available = np.array([event['event_type'].upper() == 'AVAILABLE' for event in events])
+    durations = ends - starts
+
+    new_night = np.concatenate(([False], (starts[1:] - ends[:-1]) > NIGHT_GAP.total_seconds()))
+    night_index = np.cumsum(new_night)
+    time_total = np.bincount(night_index, weights=durations)
+    time_available = np.bincount(night_index, weights=durations * available)
+    night_days = [events[i]['start'].date() for i in np.flatnonzero(np.concatenate(([True], new_night[1:])))]
+
+    availability = []
+    for night, day in enumerate(night_days):
+        is_last_night_of_day = night == len(night_days) - 1 or night_days[night + 1] != day
+        if is_last_night_of_day and time_total[night] > 0:
+            availability.append([day, float(time_available[night] / time_total[night])])
+    return availability
+
+
 def combine_telescope_availabilities_by_site_and_class(telescope_availabilities):
-    combined_keys = {TelescopeKey(tk.site, '', tk.telescope[:-1]) for tk in telescope_availabilities.keys()}
-    combined_availabilities = {}
-    for key in combined_keys:
-        num_groups = 0
-        total_availability = []
-        for telescope_key, availabilities in telescope_availabilities.items():
-            if telescope_key.site == key.site and telescope_key.telescope[:-1] == key.telescope:
-                num_groups += 1
-                if not total_availability:
-                    total_availability = availabilities
-                else:
-                    for i, availability in enumerate(availabilities):
-                        total_availability[i][1] += availability[1]
+    """ Average the daily availabilities of the telescopes of the same class at each site
+
+        Each day is averaged over the telescopes that have an availability for that day.
+    """
+    days_and_values = {}
+    for telescope_key, availabilities in telescope_availabilities.items():
+        key = TelescopeKey(telescope_key.site, '', telescope_key.telescope[:-1])
+        days, values = days_and_values.setdefault(key, ([], []))
+        for day, value in availabilities:
+            days.append(day)
+            values.append(value)
 
-        for i, availability in enumerate(total_availability):
-            total_availability[i][1] /= num_groups
-        combined_availabilities[key] = total_availability
+    combined_availabilities = {}
+    for key, (days, values) in days_and_values.items():
+        unique_days, day_index = np.unique(np.array(days, dtype='datetime64[D]'), return_inverse=True)
+        averages = np.bincount(day_index, weights=values) / np.bincount(day_index)
+        combined_availabilities[key] = [
+            [day, average] for day, average in zip(unique_days.astype(object), averages.tolist())
+        ]
 
     return combined_availabilities
@@ -0,0 +1,74 @@
+from django.test import TestCase
+from django.core.cache import caches
+from unittest.mock import patch, MagicMock
+
+from observation_portal.common import utils, configdb
+from observation_portal.common.configdb import ConfigDB, ConfigDBException, TelescopeKey
+from observation_portal.requestgroups.tasks import refresh_configdb
+from observation_portal.common.utils import set_cache_dependency_version
+
+
+class TestConfigDBSnapshot(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_patcher = patch.object(utils, 'cache', caches.create_connection('testlocmem'))
+        self.cache_patcher.start()
+        self.configdb_cache_patcher = patch.object(configdb, 'cache', utils.cache)
+        self.configdb_cache_patcher.start()
+        utils.cache.clear()
+        utils._cache_dependency_versions.clear()
+        self.configdb = ConfigDB()
+
+    def tearDown(self):
+        super().tearDown()
+        self.cache_patcher.stop()
+        self.configdb_cache_patcher.stop()
+        utils._cache_dependency_versions.clear()
+
+    def test_snapshot_is_rebuilt_without_a_published_version(self):
+        self.assertIsNot(self.configdb.get_snapshot(), self.configdb.get_snapshot())
+
+    def test_snapshot_is_reused_while_version_is_unchanged(self):
+        site_data = self.configdb.get_site_data()
+        set_cache_dependency_version('sites', ConfigDB._get_data_version(site_data))
+        with patch.object(ConfigDB, 'get_site_data', return_value=site_data) as mock_site_data:
+            snapshot = self.configdb.get_snapshot()
+            self.assertIs(snapshot, self.configdb.get_snapshot())
+            self.assertEqual(mock_site_data.call_count, 1)
+
+    def test_snapshot_indexes_instruments(self):
+        snapshot = self.configdb.get_snapshot()
+        telescope_key = TelescopeKey(site='tst', enclosure='doma', telescope='1m0a')
+        self.assertIn(telescope_key, snapshot.telescopes)
+        for instrument in snapshot.instruments_by_type['1M0-SCICAM-SBIG']:
+            self.assertEqual(instrument['instrument_type']['code'].upper(), '1M0-SCICAM-SBIG')
+            self.assertIn(instrument, snapshot.instruments_by_name[instrument['code'].upper()])
+        self.assertEqual(
+            self.configdb.get_instruments_at_location('TST', 'DOMA', '1M0A'),
+            self.configdb.get_instruments_at_location('tst', 'doma', '1m0a')
+        )
+
+    def test_refreshed_data_is_served_without_querying_configdb(self):
+        refresh_configdb()
+        with patch.object(configdb.get_http_session(), 'get') as mock_get:
+            site_data = ConfigDB._get_configdb_data('sites')
+            mock_get.assert_not_called()
+        self.assertTrue(site_data)
+
+    def test_failed_refresh_keeps_published_data(self):
+        refresh_configdb()
+        published_data = ConfigDB._get_configdb_data('sites')
+        with patch.object(ConfigDB, 'refresh_configdb_data', side_effect=ConfigDBException('down')):
+            refresh_configdb()
+        self.assertEqual(ConfigDB._get_configdb_data('sites'), published_data)
+
+    def test_unchanged_data_is_not_parsed_again(self):
+        published_data = ConfigDB.refresh_configdb_data('sites')
+        utils.cache.set(configdb.CONFIGDB_VALIDATORS_KEY.format('sites'), {'etag': '"abc"', 'last_modified': None})
+        version = utils.get_cache_dependency_version('sites')
+        not_modified = MagicMock(status_code=304)
+        with patch.object(configdb.get_http_session(), 'get', return_value=not_modified) as mock_get:
+            self.assertEqual(ConfigDB.refresh_configdb_data('sites'), published_data)
+            self.assertEqual(mock_get.call_args[1]['headers'], {'If-None-Match': '"abc"'})
+        not_modified.json.assert_not_called()
+        self.assertEqual(utils.get_cache_dependency_version('sites'), version)
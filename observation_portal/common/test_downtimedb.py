@@ -0,0 +1,81 @@
+from datetime import datetime
+from django.test import TestCase
+from django.core.cache import caches
+from django.utils import timezone
+from unittest.mock import patch
+
+from observation_portal.common import downtimedb
+from observation_portal.common.downtimedb import DowntimeDB, DowntimeIntervals
+
+
+class TestDowntimeIntervals(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.downtime = DowntimeIntervals([
+            (datetime(2016, 10, 5, tzinfo=timezone.utc), datetime(2016, 10, 6, tzinfo=timezone.utc)),
+            (datetime(2016, 10, 1, tzinfo=timezone.utc), datetime(2016, 10, 2, tzinfo=timezone.utc)),
+            (datetime(2016, 10, 1, 12, tzinfo=timezone.utc), datetime(2016, 10, 3, tzinfo=timezone.utc)),
+        ])
+
+    def test_overlapping_intervals_are_merged(self):
+        self.assertEqual(
+            self.downtime.overlapping(datetime(2016, 9, 1, tzinfo=timezone.utc), datetime(2016, 11, 1, tzinfo=timezone.utc)),
+            [(datetime(2016, 10, 1, tzinfo=timezone.utc), datetime(2016, 10, 3, tzinfo=timezone.utc)),
+             (datetime(2016, 10, 5, tzinfo=timezone.utc), datetime(2016, 10, 6, tzinfo=timezone.utc))]
+        )
+
+    def test_only_downtime_overlapping_the_window_is_returned(self):
+        self.assertEqual(
+            self.downtime.overlapping(datetime(2016, 10, 4, tzinfo=timezone.utc), datetime(2016, 10, 5, 1, tzinfo=timezone.utc)),
+            [(datetime(2016, 10, 5, tzinfo=timezone.utc), datetime(2016, 10, 6, tzinfo=timezone.utc))]
+        )
+
+    def test_no_downtime_in_window(self):
+        self.assertEqual(
+            self.downtime.overlapping(datetime(2016, 10, 3, tzinfo=timezone.utc), datetime(2016, 10, 5, tzinfo=timezone.utc)),
+            []
+        )
+
+
+class TestDowntimeSync(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.locmem_cache = caches.create_connection('testlocmem')
+        self.locmem_cache.clear()
+        self.caches_patcher = patch.object(downtimedb, 'caches', {'locmem': self.locmem_cache})
+        self.caches_patcher.start()
+        self.downtime_patcher = patch.object(DowntimeDB, '_get_downtime_data')
+        self.mock_downtime = self.downtime_patcher.start()
+
+    def tearDown(self):
+        super().tearDown()
+        self.caches_patcher.stop()
+        self.downtime_patcher.stop()
+
+    def _downtime(self, id, enclosure, start, end):
+        return {'id': id, 'start': start, 'end': end, 'site': 'tst', 'enclosure': enclosure, 'telescope': '1m0a',
+                'instrument_type': '', 'reason': 'Whatever'}
+
+    def _sync(self, changed_entries):
+        self.mock_downtime.return_value = changed_entries
+        # Expire the downtime intervals so the next lookup syncs
+        self.locmem_cache.delete('downtime_intervals')
+        return DowntimeDB.get_downtime_intervals()
+
+    def test_only_modified_downtime_is_fetched_and_merged(self):
+        self._sync([self._downtime(1, 'doma', '2016-10-01T00:00:00Z', '2016-10-02T00:00:00Z')])
+        self.assertEqual(self.mock_downtime.call_args, ((),))
+        downtime_intervals = self._sync([self._downtime(2, 'domb', '2016-10-03T00:00:00Z', '2016-10-04T00:00:00Z')])
+        self.assertIsNotNone(self.mock_downtime.call_args[1]['modified_after'])
+        window = (datetime(2016, 9, 1, tzinfo=timezone.utc), datetime(2016, 11, 1, tzinfo=timezone.utc))
+        self.assertEqual(len(downtime_intervals['1m0a.doma.tst']['all'].overlapping(*window)), 1)
+        self.assertEqual(len(downtime_intervals['1m0a.domb.tst']['all'].overlapping(*window)), 1)
+
+    def test_modified_downtime_replaces_previous_version(self):
+        self._sync([self._downtime(1, 'doma', '2016-10-01T00:00:00Z', '2016-10-02T00:00:00Z')])
+        downtime_intervals = self._sync([self._downtime(1, 'doma', '2016-10-05T00:00:00Z', '2016-10-06T00:00:00Z')])
+        window = (datetime(2016, 9, 1, tzinfo=timezone.utc), datetime(2016, 11, 1, tzinfo=timezone.utc))
+        self.assertEqual(
+            downtime_intervals['1m0a.doma.tst']['all'].overlapping(*window),
+            [(datetime(2016, 10, 5, tzinfo=timezone.utc), datetime(2016, 10, 6, tzinfo=timezone.utc))]
+        )
@@ -1,14 +1,22 @@
 from observation_portal.common.telescope_states import (TelescopeStates, get_telescope_availability_per_day,
-                                              combine_telescope_availabilities_by_site_and_class)
+                                              combine_telescope_availabilities_by_site_and_class, get_es_client,
+                                              filter_telescope_states_by_intervals, materialize_telescope_availability,
+                                              get_materialized_telescope_availability_per_day,
+                                              TELESCOPE_STATES_CURRENT_BUCKET_TIMEOUT)
+from observation_portal.requestgroups.models import TelescopeAvailability, MaterializedAvailabilityDay
 from observation_portal.common.configdb import TelescopeKey
 from observation_portal.common import rise_set_utils
 
 from time_intervals.intervals import Intervals
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import caches
+from concurrent.futures import ProcessPoolExecutor
+from elasticsearch import Elasticsearch
 from datetime import datetime, timedelta
 from django.utils import timezone
 from unittest.mock import patch
 import json
+import os
 
 
 class TelescopeStatesFakeInput(TestCase):
@@ -136,6 +144,144 @@ class TestTelescopeStates(TelescopeStatesFakeInput):
                                           }
         self.assertIn(domb_expected_available_state2, telescope_states[self.tk2])
 
+    def _search_es_output(self, aggregated_response):
+        """ Answer the aggregation query with the recorded response, and scroll queries from the raw es_output """
+        def search(body, **kwargs):
+            if 'aggs' in body:
+                return aggregated_response
+            changed_ranges = body['query']['bool']['filter'][-1]['bool']['should']
+            hits = []
+            for event in self.es_output:
+                for changed_range in changed_ranges:
+                    site, enclosure, telescope, timestamp_range = changed_range['bool']['filter']
+                    if (event['_source']['site'] == site['term']['site'] and
+                            event['_source']['observatory'] == enclosure['term']['observatory'] and
+                            event['_source']['telescope'] == telescope['term']['telescope'] and
+                            timestamp_range['range']['timestamp']['gte'] <= event['_source']['timestamp'] <=
+                            timestamp_range['range']['timestamp']['lte']):
+                        hits.append(event)
+            return {'hits': {'hits': hits, 'total': len(hits)}}
+        return search
+
+    @staticmethod
+    def _interval_bucket(hour, reasons):
+        return {
+            'key_as_string': f'2016-10-01 {hour}:00:00',
+            'reasons': {'buckets': [
+                {'key': reason, 'first': {'value_as_string': first}, 'last': {'value_as_string': last}}
+                for reason, first, last in reasons
+            ]}
+        }
+
+    @staticmethod
+    def _aggregated_response(interval_buckets_by_enclosure):
+        return {'aggregations': {'sites': {'buckets': [{'key': 'tst', 'enclosures': {'buckets': [
+            {
+                'key': enclosure,
+                'telescopes': {'buckets': [{'key': '1m0a', 'intervals': {'buckets': interval_buckets}}]}
+            }
+            for enclosure, interval_buckets in interval_buckets_by_enclosure.items()
+        ]}}]}}}
+
+    def test_aggregated_states_match_scrolled_states(self):
+        recorded_response = self._aggregated_response({
+            'doma': [
+                self._interval_bucket(18, [('', '2016-10-01 18:24:58', '2016-10-01 18:24:58')]),
+                self._interval_bucket(19, [('', '2016-10-01 19:24:58', '2016-10-01 19:24:58')]),
+                self._interval_bucket(20, [('', '2016-10-01 20:24:58', '2016-10-01 20:24:58'),
+                                           ('Site Agent: Bad Bug', '2016-10-01 20:44:58', '2016-10-01 20:44:58')])
+            ],
+            'domb': [
+                self._interval_bucket(18, [('', '2016-10-01 18:30:00', '2016-10-01 18:30:00')]),
+                self._interval_bucket(19, [('Sequencer: Unavailable. Enclosure: Interlocked (Power)',
+                                            '2016-10-01 19:24:59', '2016-10-01 19:24:59')]),
+                self._interval_bucket(20, [('', '2016-10-01 20:24:59', '2016-10-01 20:24:59'),
+                                           ('Site Agent: Bad Bug', '2016-10-01 20:44:58', '2016-10-01 20:44:58')])
+            ]
+        })
+        start = datetime(2016, 10, 1)
+        end = datetime(2016, 10, 2)
+        scrolled_states = TelescopeStates(start, end).get()
+        self.es_patcher.stop()
+        with override_settings(TELESCOPE_STATES_AGGREGATION_INTERVAL='1h'), \
+                patch.object(Elasticsearch, 'search', side_effect=self._search_es_output(recorded_response)) as mock_search:
+            aggregated_states = TelescopeStates(start, end).get()
+            self.assertEqual(mock_search.call_args_list[0][1]['size'], 0)
+        self.es_patcher.start()
+
+        self.assertEqual(aggregated_states, scrolled_states)
+
+    def test_aggregated_states_keep_reasons_that_change_back_within_an_interval(self):
+        self.es_output = [
+            {'_source': {'timestamp': timestamp, 'site': 'tst', 'telescope': '1m0a', 'observatory': 'doma',
+                         'value_string': reason}}
+            for timestamp, reason in [
+                ('2016-10-01 19:30:00', ''), ('2016-10-01 20:05:00', ''),
+                ('2016-10-01 20:20:00', 'Site Agent: Bad Bug'), ('2016-10-01 20:35:00', ''),
+                ('2016-10-01 20:50:00', ''), ('2016-10-01 21:30:00', '')
+            ]
+        ]
+        self.mock_es.return_value = self.es_output
+        recorded_response = self._aggregated_response({'doma': [
+            self._interval_bucket(19, [('', '2016-10-01 19:30:00', '2016-10-01 19:30:00')]),
+            self._interval_bucket(20, [('', '2016-10-01 20:05:00', '2016-10-01 20:50:00'),
+                                       ('Site Agent: Bad Bug', '2016-10-01 20:20:00', '2016-10-01 20:20:00')]),
+            self._interval_bucket(21, [('', '2016-10-01 21:30:00', '2016-10-01 21:30:00')])
+        ]})
+        start = datetime(2016, 10, 1)
+        end = datetime(2016, 10, 2)
+        scrolled_states = TelescopeStates(start, end).get()
+        self.es_patcher.stop()
+        with override_settings(TELESCOPE_STATES_AGGREGATION_INTERVAL='1h'), \
+                patch.object(Elasticsearch, 'search', side_effect=self._search_es_output(recorded_response)):
+            aggregated_states = TelescopeStates(start, end).get()
+        self.es_patcher.start()
+
+        self.assertEqual(aggregated_states, scrolled_states)
+        available_after_bug = {
+            'telescope': 'tst.doma.1m0a', 'event_type': 'AVAILABLE', 'event_reason': 'Available for scheduling',
+            'start': datetime(2016, 10, 1, 20, 35, tzinfo=timezone.utc),
+            'end': datetime(2016, 10, 2, tzinfo=timezone.utc)
+        }
+        self.assertIn(available_after_bug, aggregated_states[self.tk1])
+
+    def test_elasticsearch_client_is_shared(self):
+        start = datetime(2016, 10, 1)
+        end = datetime(2016, 10, 2)
+        self.assertIs(TelescopeStates(start, end).es, get_es_client())
+        self.assertIs(TelescopeStates(start, end).es, get_es_client())
+
+    def test_filtered_states_are_clipped_to_the_end_time_and_intervals(self):
+        event = {'telescope': 'tst.doma.1m0a', 'event_type': 'AVAILABLE', 'event_reason': 'Available for scheduling',
+                 'start': datetime(2016, 10, 1, 10, tzinfo=timezone.utc),
+                 'end': datetime(2016, 10, 2, 14, tzinfo=timezone.utc)}
+        site_intervals = {'tst': [(datetime(2016, 10, 1, 9, tzinfo=timezone.utc),
+                                   datetime(2016, 10, 1, 13, tzinfo=timezone.utc)),
+                                  (datetime(2016, 10, 2, 9, tzinfo=timezone.utc),
+                                   datetime(2016, 10, 2, 13, tzinfo=timezone.utc))]}
+        filtered_states = filter_telescope_states_by_intervals(
+            {self.tk1: [event]}, site_intervals,
+            datetime(2016, 10, 1, tzinfo=timezone.utc), datetime(2016, 10, 2, 12, tzinfo=timezone.utc)
+        )
+        self.assertEqual(
+            [(e['start'], e['end']) for e in filtered_states[self.tk1]],
+            [(datetime(2016, 10, 1, 10, tzinfo=timezone.utc), datetime(2016, 10, 1, 13, tzinfo=timezone.utc)),
+             (datetime(2016, 10, 2, 9, tzinfo=timezone.utc), datetime(2016, 10, 2, 12, tzinfo=timezone.utc))]
+        )
+        self.assertEqual(event['end'], datetime(2016, 10, 2, 14, tzinfo=timezone.utc))
+
+    def test_combined_availability_averages_each_day_over_reporting_telescopes(self):
+        first_day = datetime(2016, 10, 1).date()
+        second_day = datetime(2016, 10, 2).date()
+        telescope_availabilities = {
+            self.tk1: [[first_day, 0.5], [second_day, 1.0]],
+            self.tk2: [[second_day, 0.0]]
+        }
+        combined_availability = combine_telescope_availabilities_by_site_and_class(telescope_availabilities)
+
+        self.assertEqual(combined_availability[TelescopeKey('tst', '', '1m0')], [[first_day, 0.5], [second_day, 0.5]])
+        self.assertEqual(telescope_availabilities[self.tk1], [[first_day, 0.5], [second_day, 1.0]])
+
     @patch('observation_portal.common.telescope_states.get_site_rise_set_intervals')
     def test_telescope_availability_limits_interval(self, mock_intervals):
         mock_intervals.return_value = [(datetime(2016, 9, 30, 18, 30, 0, tzinfo=timezone.utc),
@@ -191,6 +337,54 @@ class TestTelescopeStates(TelescopeStatesFakeInput):
         domb_expected_availability = 1.0
         self.assertAlmostEqual(domb_expected_availability, telescope_availability[self.tk2][0][1])
 
+    @patch('observation_portal.common.telescope_states.get_site_rise_set_intervals')
+    def test_materialized_availability_is_read_without_querying_telemetry(self, mock_intervals):
+        mock_intervals.return_value = [(datetime(2016, 9, 30, 18, 30, 0, tzinfo=timezone.utc),
+                                        datetime(2016, 9, 30, 21, 0, 0, tzinfo=timezone.utc)),
+                                       (datetime(2016, 10, 1, 18, 30, 0, tzinfo=timezone.utc),
+                                        datetime(2016, 10, 1, 21, 0, 0, tzinfo=timezone.utc)),
+                                       (datetime(2016, 10, 2, 18, 30, 0, tzinfo=timezone.utc),
+                                        datetime(2016, 10, 2, 21, 0, 0, tzinfo=timezone.utc))]
+        start = datetime(2016, 9, 30, tzinfo=timezone.utc)
+        end = datetime(2016, 10, 2, tzinfo=timezone.utc)
+        live_availability = get_telescope_availability_per_day(start, end)
+        materialize_telescope_availability(start.date(), datetime(2016, 10, 1).date())
+        self.assertEqual(TelescopeAvailability.objects.count(), 2)
+
+        self.mock_es.reset_mock()
+        materialized_availability = get_materialized_telescope_availability_per_day(start, end)
+        self.mock_es.assert_not_called()
+        self.assertEqual(materialized_availability, live_availability)
+
+    @patch('observation_portal.common.telescope_states.get_site_rise_set_intervals')
+    def test_days_that_were_not_materialized_are_computed_from_telemetry(self, mock_intervals):
+        mock_intervals.return_value = [(datetime(2016, 9, 30, 18, 30, 0, tzinfo=timezone.utc),
+                                        datetime(2016, 9, 30, 21, 0, 0, tzinfo=timezone.utc)),
+                                       (datetime(2016, 10, 1, 18, 30, 0, tzinfo=timezone.utc),
+                                        datetime(2016, 10, 1, 21, 0, 0, tzinfo=timezone.utc)),
+                                       (datetime(2016, 10, 2, 18, 30, 0, tzinfo=timezone.utc),
+                                        datetime(2016, 10, 2, 21, 0, 0, tzinfo=timezone.utc))]
+        start = datetime(2016, 9, 29, tzinfo=timezone.utc)
+        end = datetime(2016, 10, 3, tzinfo=timezone.utc)
+        live_availability = get_telescope_availability_per_day(start, end)
+        # Only the night before was materialized, so the night with telemetry has to be computed
+        MaterializedAvailabilityDay.objects.create(day=datetime(2016, 9, 30).date())
+        TelescopeAvailability.objects.create(
+            site=self.tk1.site, enclosure=self.tk1.enclosure, telescope=self.tk1.telescope,
+            day=datetime(2016, 9, 30).date(), availability=0.5
+        )
+
+        self.mock_es.reset_mock()
+        materialized_availability = get_materialized_telescope_availability_per_day(start, end)
+        self.mock_es.assert_called()
+        self.assertEqual(materialized_availability[self.tk1][0], [datetime(2016, 9, 30).date(), 0.5])
+        self.assertEqual(materialized_availability[self.tk1][1:], live_availability[self.tk1])
+        self.assertEqual(materialized_availability[self.tk2], live_availability[self.tk2])
+        self.assertEqual(
+            sum(len(availabilities) for availabilities in materialized_availability.values()),
+            sum(len(availabilities) for availabilities in live_availability.values()) + 1
+        )
+
     @patch('observation_portal.common.telescope_states.get_site_rise_set_intervals')
     def test_telescope_availability_combine(self, mock_intervals):
         mock_intervals.return_value = [(datetime(2016, 9, 30, 18, 30, 0, tzinfo=timezone.utc),
@@ -380,6 +574,31 @@ class TestTelescopeStatesFromFile(TelescopeStatesFromFile):
 
                 previous_event = event
 
+    def test_states_are_assembled_from_cached_buckets(self):
+        uncached_states = TelescopeStates(self.start + timedelta(hours=6), self.end).get()
+        locmem_cache = caches.create_connection('testlocmem')
+        locmem_cache.clear()
+        with patch('observation_portal.common.telescope_states.cache', locmem_cache):
+            TelescopeStates(self.start, self.end).get()
+            self.assertEqual(self.mock_es.call_count, 2)
+            cached_states = TelescopeStates(self.start + timedelta(hours=6), self.end).get()
+            self.assertEqual(self.mock_es.call_count, 2)
+        self.assertEqual(cached_states, uncached_states)
+
+    def test_settled_buckets_expire_and_empty_buckets_are_not_kept_long(self):
+        with patch('observation_portal.common.telescope_states.cache') as mock_cache:
+            mock_cache.get_many.return_value = {}
+            TelescopeStates(self.start, self.end).get()
+        timeouts = {}
+        for call in mock_cache.set_many.call_args_list:
+            for cache_key, lumps in call[0][0].items():
+                timeouts[cache_key] = (lumps, call[0][1])
+        self.assertTrue(timeouts)
+        for lumps, timeout in timeouts.values():
+            self.assertIsNotNone(timeout)
+            if not lumps:
+                self.assertEqual(timeout, TELESCOPE_STATES_CURRENT_BUCKET_TIMEOUT)
+
 
 class TestRiseSetUtils(TestCase):
     def setUp(self):
@@ -393,6 +612,49 @@ class TestRiseSetUtils(TestCase):
         end = timezone.datetime(year=2017, month=5, day=6, tzinfo=timezone.utc)
         self.assertTrue(rise_set_utils.get_site_rise_set_intervals(start=start, end=end, site_code='tst'))
 
+    def test_site_dark_intervals_are_only_computed_for_missing_days(self):
+        locmem_cache = caches.create_connection('testlocmem')
+        locmem_cache.clear()
+        start = timezone.datetime(year=2017, month=5, day=5, tzinfo=timezone.utc)
+        with patch.object(rise_set_utils, 'cache', locmem_cache), \
+                patch.object(rise_set_utils, 'get_rise_set_visibility',
+                             wraps=rise_set_utils.get_rise_set_visibility) as mock_visibility:
+            one_day = rise_set_utils.get_site_rise_set_intervals(start, start + timedelta(days=1), 'tst')
+            three_days = rise_set_utils.get_site_rise_set_intervals(start, start + timedelta(days=3), 'tst')
+            self.assertEqual(mock_visibility.call_count, 2)
+            rise_set_utils.get_site_rise_set_intervals(start + timedelta(hours=6), start + timedelta(days=2), 'tst')
+            self.assertEqual(mock_visibility.call_count, 2)
+        self.assertTrue(one_day)
+        for interval_start, interval_end in one_day:
+            self.assertTrue(any(s <= interval_start and interval_end <= e for s, e in three_days))
+        for interval_start, interval_end in three_days:
+            self.assertTrue(start <= interval_start < interval_end <= start + timedelta(days=3))
+
+    def test_site_dark_intervals_are_recomputed_when_the_site_changes(self):
+        locmem_cache = caches.create_connection('testlocmem')
+        locmem_cache.clear()
+        site_detail = {
+            'latitude': -30.1673833333,
+            'longitude': -70.8047888889,
+            'horizon': 15.0,
+            'altitude': 100.0,
+            'ha_limit_pos': 4.6,
+            'ha_limit_neg': -4.6,
+            'zenith_blind_spot': 0.0
+        }
+        day = datetime(2017, 5, 5).date()
+        with patch.object(rise_set_utils, 'cache', locmem_cache), \
+                patch.object(rise_set_utils, 'get_rise_set_visibility',
+                             wraps=rise_set_utils.get_rise_set_visibility) as mock_visibility:
+            intervals = rise_set_utils.get_site_dark_intervals_by_day('tst', site_detail, day, day)
+            rise_set_utils.get_site_dark_intervals_by_day('tst', dict(site_detail), day, day)
+            self.assertEqual(mock_visibility.call_count, 1)
+            moved_intervals = rise_set_utils.get_site_dark_intervals_by_day(
+                'tst', dict(site_detail, longitude=20.8101815), day, day
+            )
+            self.assertEqual(mock_visibility.call_count, 2)
+        self.assertNotEqual(intervals, moved_intervals)
+
     def test_get_largest_rise_set_interval_only_uses_one_site(self):
         configdb_patcher = patch(
             'observation_portal.common.configdb.ConfigDB.get_sites_with_instrument_type_and_location'
@@ -486,6 +748,86 @@ class TestRiseSetUtils(TestCase):
         configdb_patcher.stop()
         configdb_patcher2.stop()
 
+    def test_observable_intervals_are_shared_between_requests(self):
+        locmem_cache = caches.create_connection('testlocmem')
+        locmem_cache.clear()
+        site_detail = {
+            'latitude': -30.1673833333,
+            'longitude': -70.8047888889,
+            'horizon': 15.0,
+            'altitude': 100.0,
+            'ha_limit_pos': 4.6,
+            'ha_limit_neg': -4.6,
+            'zenith_blind_spot': 0.0
+        }
+        target = {'type': 'ICRS', 'name': 'first name', 'ra': 35.0, 'dec': -53.0, 'proper_motion_ra': 0.0,
+                  'proper_motion_dec': 0.0, 'epoch': 2000, 'parallax': 0.0}
+        constraints = {'max_airmass': 2.0, 'min_lunar_distance': 30.0, 'max_seeing': 2.0}
+        window = {'start': datetime(2016, 9, 4, tzinfo=timezone.utc), 'end': datetime(2016, 9, 5, tzinfo=timezone.utc)}
+        with patch.object(rise_set_utils, 'cache', locmem_cache), \
+                patch.object(rise_set_utils, 'get_rise_set_visibility',
+                             wraps=rise_set_utils.get_rise_set_visibility) as mock_visibility:
+            intervals = rise_set_utils.get_observable_intervals(target, constraints, site_detail, window)
+            # Fields that don't affect visibility should still hit the stored intervals
+            renamed_target = dict(target, name='second name')
+            other_constraints = dict(constraints, max_seeing=3.0)
+            shared_intervals = rise_set_utils.get_observable_intervals(renamed_target, other_constraints, site_detail,
+                                                                       window)
+            self.assertEqual(mock_visibility.call_count, 1)
+            self.assertEqual(intervals, shared_intervals)
+
+            rise_set_utils.get_observable_intervals(target, dict(constraints, max_airmass=1.5), site_detail, window)
+            self.assertEqual(mock_visibility.call_count, 2)
+
+    def test_observable_intervals_from_executor_match_serial(self):
+        site_detail = {
+            'latitude': -30.1673833333,
+            'longitude': -70.8047888889,
+            'horizon': 15.0,
+            'altitude': 100.0,
+            'ha_limit_pos': 4.6,
+            'ha_limit_neg': -4.6,
+            'zenith_blind_spot': 0.0
+        }
+        constraints = {'max_airmass': 2.0, 'min_lunar_distance': 30.0}
+        window = {'start': datetime(2016, 9, 4, tzinfo=timezone.utc), 'end': datetime(2016, 9, 6, tzinfo=timezone.utc)}
+        jobs = [
+            ({'type': 'ICRS', 'ra': ra, 'dec': -53.0, 'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0,
+              'epoch': 2000, 'parallax': 0.0}, constraints, site_detail, window)
+            for ra in [0.0, 35.0, 120.0]
+        ]
+        serial_intervals = rise_set_utils.get_many_observable_intervals(jobs)
+        with ProcessPoolExecutor(max_workers=2) as executor, \
+                patch.object(rise_set_utils, '_rise_set_executor', executor):
+            executor_intervals = rise_set_utils.get_many_observable_intervals(jobs)
+        self.assertEqual(serial_intervals, executor_intervals)
+
+    def test_broken_executor_is_reset_and_intervals_are_computed_serially(self):
+        site_detail = {
+            'latitude': -30.1673833333,
+            'longitude': -70.8047888889,
+            'horizon': 15.0,
+            'altitude': 100.0,
+            'ha_limit_pos': 4.6,
+            'ha_limit_neg': -4.6,
+            'zenith_blind_spot': 0.0
+        }
+        constraints = {'max_airmass': 2.0, 'min_lunar_distance': 30.0}
+        window = {'start': datetime(2016, 9, 4, tzinfo=timezone.utc), 'end': datetime(2016, 9, 6, tzinfo=timezone.utc)}
+        jobs = [
+            ({'type': 'ICRS', 'ra': ra, 'dec': -53.0, 'proper_motion_ra': 0.0, 'proper_motion_dec': 0.0,
+              'epoch': 2000, 'parallax': 0.0}, constraints, site_detail, window)
+            for ra in [0.0, 35.0]
+        ]
+        serial_intervals = rise_set_utils.get_many_observable_intervals(jobs)
+        executor = ProcessPoolExecutor(max_workers=1)
+        # Kill the worker process to break the pool
+        executor.submit(os._exit, 1).exception()
+        with patch.object(rise_set_utils, '_rise_set_executor', executor), \
+                override_settings(RISE_SET_PROCESSES=0):
+            self.assertEqual(rise_set_utils.get_many_observable_intervals(jobs), serial_intervals)
+            self.assertIsNone(rise_set_utils._rise_set_executor)
+
     def test_get_site_rise_set_intervals_should_not_return_an_interval(self):
         start = timezone.datetime(year=2017, month=5, day=5, tzinfo=timezone.utc)
         end = timezone.datetime(year=2017, month=5, day=6, tzinfo=timezone.utc)
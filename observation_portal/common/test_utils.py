@@ -0,0 +1,127 @@
+from django.test import TestCase
+from django.core.cache import caches
+from unittest.mock import patch, MagicMock
+
+from observation_portal.common import utils
+from observation_portal.common.utils import (cache_function, set_cache_dependency_version, get_cache_function_key,
+                                             get_cache_function_stats)
+
+
+class TestCacheFunction(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.locmem_cache = caches['testlocmem']
+        self.locmem_cache.clear()
+        self.cache_patcher = patch.object(utils, 'cache', caches.create_connection('testlocmem'))
+        self.cache_patcher.start()
+        utils._cache_dependency_versions.clear()
+        self.time_patcher = patch.object(utils.time, 'time', return_value=1000.0)
+        self.mock_time = self.time_patcher.start()
+        self.compute = MagicMock(side_effect=lambda value: value * 2)
+        self.cached_compute = cache_function(cache_name='testlocmem', duration=100, depends_on='sites')(
+            self._compute
+        )
+
+    def tearDown(self):
+        super().tearDown()
+        self.cache_patcher.stop()
+        self.time_patcher.stop()
+        utils._cache_dependency_versions.clear()
+
+    def _compute(self, value):
+        return self.compute(value)
+
+    def test_value_is_cached(self):
+        self.assertEqual(self.cached_compute(2), 4)
+        self.assertEqual(self.cached_compute(2), 4)
+        self.assertEqual(self.compute.call_count, 1)
+
+    def test_dependency_version_change_invalidates_value(self):
+        set_cache_dependency_version('sites', 'first')
+        self.cached_compute(2)
+        set_cache_dependency_version('sites', 'second')
+        self.cached_compute(2)
+        self.assertEqual(self.compute.call_count, 2)
+        self.cached_compute(2)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_dependency_version_is_read_from_the_cache_once_per_interval(self):
+        set_cache_dependency_version('sites', 'first')
+        with patch.object(utils.cache, 'get', wraps=utils.cache.get) as mock_get:
+            self.cached_compute(2)
+            self.cached_compute(2)
+            self.assertEqual(mock_get.call_count, 1)
+            self.mock_time.return_value = 1000.0 + utils.CACHE_DEPENDENCY_VERSION_CHECK_INTERVAL
+            self.cached_compute(2)
+            self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(self.compute.call_count, 1)
+
+    def test_expired_value_is_recomputed(self):
+        self.cached_compute(2)
+        self.mock_time.return_value = 1101.0
+        self.cached_compute(2)
+        self.assertEqual(self.compute.call_count, 2)
+
+    def test_stale_value_is_served_while_another_caller_refreshes(self):
+        self.cached_compute(2)
+        self.compute.side_effect = lambda value: value * 3
+        self.mock_time.return_value = 1101.0
+        lock_key = get_cache_function_key('_compute', (2,), {}) + '_refreshing'
+        self.locmem_cache.add(lock_key, True, 60)
+        self.assertEqual(self.cached_compute(2), 4)
+        self.assertEqual(self.compute.call_count, 1)
+        self.locmem_cache.delete(lock_key)
+        self.assertEqual(self.cached_compute(2), 6)
+
+    def test_stale_value_is_served_if_refresh_fails(self):
+        self.cached_compute(2)
+        self.compute.side_effect = Exception('upstream is down')
+        self.mock_time.return_value = 1101.0
+        self.assertEqual(self.cached_compute(2), 4)
+
+    def test_error_is_raised_without_a_stale_value(self):
+        self.compute.side_effect = Exception('upstream is down')
+        with self.assertRaises(Exception):
+            self.cached_compute(2)
+
+    def test_empty_values_are_cached(self):
+        self.compute.side_effect = lambda value: set()
+        self.assertEqual(self.cached_compute(2), set())
+        self.assertEqual(self.cached_compute(2), set())
+        self.assertEqual(self.compute.call_count, 1)
+
+    def test_hits_and_misses_are_counted(self):
+        stats_name = f'{__name__}.TestCacheFunction._compute'
+        before = get_cache_function_stats().get(stats_name, {})
+        self.cached_compute(2)
+        self.cached_compute(2)
+        self.cached_compute(3)
+        after = get_cache_function_stats()[stats_name]
+        self.assertEqual(after['hits'] - before.get('hits', 0), 1)
+        self.assertEqual(after['misses'] - before.get('misses', 0), 2)
+
+
+class TestCacheFunctionKey(TestCase):
+    def test_key_does_not_depend_on_ordering(self):
+        self.assertEqual(
+            get_cache_function_key('method', ({'a': 1, 'b': {3, 1, 2}},), {'first': 1, 'second': 'two'}),
+            get_cache_function_key('method', ({'b': {2, 3, 1}, 'a': 1},), {'second': 'two', 'first': 1})
+        )
+
+    def test_keyword_arguments_are_keyed_by_name(self):
+        self.assertNotEqual(
+            get_cache_function_key('method', (), {'instrument_type_code': '1M0-SCICAM-SBIG'}),
+            get_cache_function_key('method', (), {'mode_type': '1M0-SCICAM-SBIG'})
+        )
+
+    def test_list_and_string_arguments_do_not_collide(self):
+        self.assertNotEqual(
+            get_cache_function_key('method', (['a', 'b'],), {}),
+            get_cache_function_key('method', ("['a', 'b']",), {})
+        )
+
+    def test_non_value_arguments_are_ignored(self):
+        self.assertEqual(
+            get_cache_function_key('method', (object(), 'code'), {}),
+            get_cache_function_key('method', (object(), 'code'), {})
+        )
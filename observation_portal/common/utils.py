@@ -1,11 +1,32 @@
 """
 utils.py - Common utility functions
 """
-import json
+import time
 import hashlib
+import logging
+from collections import defaultdict, Counter
+from datetime import date, datetime, timedelta
 from functools import wraps
-from django.core.serializers.json import DjangoJSONEncoder
-from django.core.cache import caches
+from threading import Lock
+
+import requests
+from django.core.cache import cache, caches
+
+logger = logging.getLogger(__name__)
+
+CACHE_DEPENDENCY_VERSION_KEY = 'cache_dependency_version_{}'
+CACHE_DEPENDENCY_VERSION_CHECK_INTERVAL = 5  # seconds a dependency version is reused in process before reading it again
+CACHE_REFRESH_LOCK_DURATION = 60  # seconds a caller has to recompute a stale value before another may try
+CACHE_KEY_ARG_TYPES = (type(None), int, float, bool, str, list, tuple, set, frozenset, dict, date, datetime, timedelta)
+# Sentinel for a cache miss, so that cached falsy values such as an empty set are still hits
+CACHE_MISS = object()
+# Per function counts of cache hits, stale hits and misses in this process
+CACHE_FUNCTION_STATS = defaultdict(Counter)
+
+_http_session = None
+_http_session_lock = Lock()
+# Per resource (version, checked until time) of the dependency versions last read by this process
+_cache_dependency_versions = {}
 
 
 def get_queryset_field_values(queryset, field):
@@ -17,27 +38,133 @@ def get_queryset_field_values(queryset, field):
             values_set.update(values)
     return values_set
 
-# Decorator to cache the value of the function - defaults to the locmem cache for 5 minutes
-def cache_function(cache_name='locmem', duration=300):
+
+def get_http_session():
+    """Get the requests session shared by this process, so connections to upstream services are kept alive
+
+    The session is created on first use rather than at import, so forked workers do not share its connections.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = requests.Session()
+    return _http_session
+
+
+def get_conditional_request_headers(validators):
+    """Get the headers for a conditional GET from the validators of the last response"""
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def get_response_validators(response):
+    """Get the validators of a response to send with the next conditional GET of the same resource"""
+    return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+
+def get_cache_dependency_version(resource):
+    """Get the current version of an upstream resource that cached functions can depend on
+
+    The version is kept in process for a few seconds, so that cached functions that are called many times in a row
+    do not each read it from the shared cache.
+    """
+    local_version = _cache_dependency_versions.get(resource)
+    if local_version is not None and time.time() < local_version[1]:
+        return local_version[0]
+    version = cache.get(CACHE_DEPENDENCY_VERSION_KEY.format(resource))
+    _cache_dependency_versions[resource] = (version, time.time() + CACHE_DEPENDENCY_VERSION_CHECK_INTERVAL)
+    return version
+
+
+def set_cache_dependency_version(resource, version):
+    """Set the version of an upstream resource
+
+    Cached function values computed against a different version of the resource are treated as stale, so changing
+    the version invalidates everything that depends on the resource together.
+    """
+    cache.set(CACHE_DEPENDENCY_VERSION_KEY.format(resource), version, None)
+    # Read the version back on next use in this process, other processes pick it up within the check interval
+    _cache_dependency_versions.pop(resource, None)
+
+
+def _normalize_cache_key_arg(arg):
+    """Convert an argument into an equivalent value whose repr does not depend on dict or set ordering"""
+    if isinstance(arg, dict):
+        return tuple(sorted(((repr(key), _normalize_cache_key_arg(value)) for key, value in arg.items())))
+    if isinstance(arg, (set, frozenset)):
+        return ('set', tuple(sorted(repr(_normalize_cache_key_arg(value)) for value in arg)))
+    if isinstance(arg, (list, tuple)):
+        return tuple(_normalize_cache_key_arg(value) for value in arg)
+    return arg
+
+
+def get_cache_function_key(name, args, kwargs):
+    """Get the cache key of a call to a cached function
+
+    Arguments that are not plain values, such as self, do not take part in the key.
+    """
+    key_args = [_normalize_cache_key_arg(arg) for arg in args if isinstance(arg, CACHE_KEY_ARG_TYPES)]
+    key_kwargs = sorted(
+        (kwarg_name, _normalize_cache_key_arg(kwarg)) for kwarg_name, kwarg in kwargs.items()
+        if isinstance(kwarg, CACHE_KEY_ARG_TYPES)
+    )
+    if not key_args and not key_kwargs:
+        return name
+    return name + '_' + hashlib.sha1(repr((key_args, key_kwargs)).encode()).hexdigest()
+
+
+def get_cache_function_stats():
+    """Get the hit, stale hit and miss counts of every cached function in this process"""
+    return {name: dict(stats) for name, stats in CACHE_FUNCTION_STATS.items()}
+
+
+# Decorator to cache the value of the function - defaults to the locmem cache for 5 minutes.
+# If depends_on names an upstream resource, the value also goes stale as soon as that resource's version changes.
+# Stale values are kept for stale_duration (defaults to duration) after they expire, and are served while a single
+# caller recomputes the value, so that all callers do not recompute at once when a value goes stale.
+def cache_function(cache_name='locmem', duration=300, depends_on=None, stale_duration=None):
+    if stale_duration is None:
+        stale_duration = duration
+
     def cache_decorator(method):
+        stats = CACHE_FUNCTION_STATS[f'{method.__module__}.{method.__qualname__}']
+
         @wraps(method)
         def inner_funcion(*args, **kwargs):
-            cache_key = method.__name__
-            for arg in args:
-                if isinstance(arg, dict):
-                    cache_key += '_' + hashlib.sha1(json.dumps(arg, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
-                elif isinstance(arg, (int, float, bool, str, list, set)):
-                    cache_key += '_' + str(arg)
-            for kwarg in kwargs.values():
-                if isinstance(kwarg, dict):
-                    cache_key += '_' + hashlib.sha1(json.dumps(kwarg, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
-                elif isinstance(arg, (int, float, bool, str, list, set)):
-                    cache_key += '_' + str(kwarg)
-            cached_output = caches[cache_name].get(cache_key, None)
-            if cached_output:
-                return cached_output
-            output = method(*args, **kwargs)
-            caches[cache_name].set(cache_key, output, duration)
+            cache_key = get_cache_function_key(method.__name__, args, kwargs)
+            version = get_cache_dependency_version(depends_on) if depends_on else None
+            cached_entry = caches[cache_name].get(cache_key, CACHE_MISS)
+            if cached_entry is CACHE_MISS:
+                cached_entry = None
+            else:
+                if cached_entry['version'] == version and cached_entry['fresh_until'] > time.time():
+                    stats['hits'] += 1
+                    return cached_entry['value']
+                # The value is stale, so only recompute it if no one else is already doing so
+                if not caches[cache_name].add(cache_key + '_refreshing', True, CACHE_REFRESH_LOCK_DURATION):
+                    stats['stale_hits'] += 1
+                    return cached_entry['value']
+            stats['misses'] += 1
+            try:
+                output = method(*args, **kwargs)
+                caches[cache_name].set(
+                    cache_key, {'value': output, 'version': version, 'fresh_until': time.time() + duration},
+                    duration + stale_duration
+                )
+            except Exception:
+                if cached_entry is None:
+                    raise
+                logger.warning(f'Failed to recompute {cache_key}, serving the stale value', exc_info=True)
+                stats['stale_hits'] += 1
+                return cached_entry['value']
+            finally:
+                if cached_entry is not None:
+                    caches[cache_name].delete(cache_key + '_refreshing')
             return output
         return inner_funcion
     return cache_decorator
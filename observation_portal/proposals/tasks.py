@@ -2,7 +2,8 @@ from django.utils import timezone
 import dramatiq
 import logging
 
-from observation_portal.proposals.models import Proposal
+from observation_portal.proposals.models import Proposal, Semester
+from observation_portal.common.rise_set_utils import precompute_site_dark_intervals
 
 logger = logging.getLogger(__name__)
 
@@ -18,3 +19,10 @@ def time_allocation_reminder():
         ):
             logger.info('Sending time allocation reminder for {}'.format(proposal))
             proposal.send_time_allocation_reminder()
+
+
+@dramatiq.actor()
+def precompute_semester_dark_intervals():
+    for semester in Semester.current_semesters(future=True):
+        logger.info('Precomputing site dark intervals for semester {}'.format(semester))
+        precompute_site_dark_intervals(semester.start, semester.end)
@@ -266,6 +266,16 @@ class TestProposalUserLimits(TestCase):
                                    instrument_config=instrument_config)
         self.assertGreater(self.user.profile.time_used_in_proposal(self.proposal), 0)
 
+    def test_time_used_for_user_sums_stored_and_calculated_durations(self):
+        stored_requestgroup = create_simple_requestgroup(self.user, self.proposal)
+        calculated_requestgroup = create_simple_requestgroup(self.user, self.proposal)
+        create_simple_requestgroup(self.user, self.proposal, state='CANCELED')
+        stored_request = stored_requestgroup.requests.first()
+        stored_request.stored_duration = 1000
+        stored_request.save()
+        calculated_duration = calculated_requestgroup.requests.first().calculate_duration()
+        self.assertEqual(self.user.profile.time_used_in_proposal(self.proposal), 1000 + calculated_duration)
+
 
 class TestDefaultIPP(TestCase):
     def setUp(self):
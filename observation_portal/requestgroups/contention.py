@@ -1,14 +1,26 @@
 from datetime import timedelta
-import math
+import logging
 
+from django.core.cache import cache
+from django.db.models import F, Sum
+from django.db.models.functions import Floor
 from django.utils import timezone
+import numpy as np
 
-from observation_portal.requestgroups.models import Request
+from observation_portal.requestgroups.models import Request, Configuration
 from observation_portal.common.rise_set_utils import (
     get_filtered_rise_set_intervals_by_site, get_site_rise_set_intervals
 )
 from observation_portal.common.configdb import configdb
 
+logger = logging.getLogger(__name__)
+
+CONTENTION_SNAPSHOT_KEY = 'contention_snapshot_{}'
+PRESSURE_SNAPSHOT_KEY = 'pressure_snapshot_{}_{}'
+SNAPSHOT_REFRESH_LOCK_KEY = 'contention_and_pressure_snapshot_refresh_lock'
+# Snapshots are refreshed every few minutes, this only stops serving them for long if the refresh stops running
+SNAPSHOT_TIMEOUT = 30 * 60
+
 
 class Contention(object):
     def __init__(self, instrument_type, anonymous=True):
@@ -24,22 +36,34 @@ class Contention(object):
             state='PENDING',
             configurations__instrument_type=instrument_type,
             configurations__target__type='ICRS'
-        ).prefetch_related(
-            'configurations', 'windows', 'configurations__target', 'location', 'request_group',
-            'request_group__proposal', 'configurations__instrument_configs', 'configurations__acquisition_config',
-            'configurations__guiding_config', 'configurations__constraints'
         ).distinct()
 
+    def _configurations(self):
+        return Configuration.objects.filter(request__in=self.requests.values('id'))
+
     def _binned_durations_by_proposal_and_ra(self):
         ra_bins = [{} for x in range(0, 24)]
-        for request in self.requests:
-            for conf in request.configurations.all():
-                ra = math.floor(conf.target.ra / 15)
-                proposal_id = request.request_group.proposal.id
-                if not ra_bins[ra].get(proposal_id):
-                    ra_bins[ra][proposal_id] = conf.duration
-                else:
-                    ra_bins[ra][proposal_id] += conf.duration
+        configurations = self._configurations().filter(target__ra__isnull=False)
+        binned_durations = configurations.filter(stored_duration__isnull=False).annotate(
+            ra_bin=Floor(F('target__ra') / 15)
+        ).values(
+            'ra_bin', 'request__request_group__proposal'
+        ).annotate(
+            duration=Sum('stored_duration')
+        ).order_by()
+        for binned_duration in binned_durations:
+            ra = int(binned_duration['ra_bin']) % 24
+            ra_bins[ra][binned_duration['request__request_group__proposal']] = binned_duration['duration']
+        # Configurations whose durations have not been stored yet have them calculated instead
+        missing_durations = configurations.filter(stored_duration__isnull=True).select_related(
+            'target', 'request__request_group'
+        ).prefetch_related(
+            'instrument_configs', 'instrument_configs__rois', 'constraints', 'acquisition_config', 'guiding_config'
+        )
+        for configuration in missing_durations:
+            ra = int(configuration.target.ra // 15) % 24
+            proposal = configuration.request.request_group.proposal_id
+            ra_bins[ra][proposal] = ra_bins[ra].get(proposal, 0) + configuration.calculate_duration()
         return ra_bins
 
     @staticmethod
@@ -62,9 +86,9 @@ class Contention(object):
 
 
 class Pressure(object):
-    def __init__(self, instrument_type=None, site=None, anonymous=True):
+    def __init__(self, instrument_type=None, site=None, anonymous=True, now=None):
         self.anonymous = anonymous
-        self.now = timezone.now()
+        self.now = now or timezone.now()
         self.requests = self._requests(instrument_type, site)
         self.site = site
         self.instrument_type = instrument_type
@@ -148,39 +172,105 @@ class Pressure(object):
     def _time_bins(self):
         return [self.now + timedelta(minutes=15 * x) for x in range(0, 24 * 4)]
 
-    def _binned_pressure_by_hours_from_now(self):
-        quarter_hour_bins = [{} for x in range(0, 24 * 4)]
-        bin_start_times = self._time_bins()
+    def _site_telescope_counts(self, instrument_type):
+        """ Get the number of telescopes with the instrument type at each of self.sites """
+        counts = np.zeros(len(self.sites))
+        site_indexes = {site['code']: i for i, site in enumerate(self.sites)}
+        for telescope in self._telescopes(instrument_type):
+            if telescope.site in site_indexes:
+                counts[site_indexes[telescope.site]] += 1
+        return counts
+
+    def _site_visibility(self, site_intervals, bin_times):
+        """ Get the number of visible intervals covering each time bin at each of self.sites, as a sites x bins array """
+        visibility = np.zeros((len(self.sites), len(bin_times)))
+        for i, site in enumerate(self.sites):
+            if site['code'] in site_intervals:
+                starts = np.array([interval[0].timestamp() for interval in site_intervals[site['code']]])
+                ends = np.array([interval[1].timestamp() for interval in site_intervals[site['code']]])
+                visibility[i] = np.sum(
+                    (starts[:, np.newaxis] <= bin_times) & (bin_times < ends[:, np.newaxis]), axis=0
+                )
+        return visibility
 
+    def _request_visibilities(self):
+        """ Get the proposal, instrument types, duration and visible intervals at each of self.sites of each request """
+        request_visibilities = []
         for request in self.requests:
             site_intervals = self._visible_intervals(request)
+            if self._time_visible(site_intervals) < 1:
+                continue
+            request_visibilities.append({
+                'proposal': request.request_group.proposal.id,
+                'instrument_types': [configuration.instrument_type for configuration in request.configurations.all()],
+                'duration': request.duration,
+                'site_intervals': site_intervals
+            })
+        return request_visibilities
+
+    def _binned_pressure_by_hours_from_now(self, request_visibilities=None):
+        """ Bin the pressure of the requests, optionally reusing visibilities calculated over the same or more sites """
+        if request_visibilities is None:
+            request_visibilities = self._request_visibilities()
+        bin_times = np.array([bin_start.timestamp() for bin_start in self._time_bins()])
+        site_codes = {site['code'] for site in self.sites}
+        proposals = []
+        base_pressures = []
+        visibilities = []
+        telescope_counts = []
+        site_telescope_counts = {}
+
+        for request_visibility in request_visibilities:
+            if self.instrument_type and self.instrument_type not in request_visibility['instrument_types']:
+                continue
+            site_intervals = {
+                site: intervals for site, intervals in request_visibility['site_intervals'].items() if site in site_codes
+            }
             total_time_visible = self._time_visible(site_intervals)
-            instrument_type = request.configurations.all()[0].instrument_type
+            instrument_type = request_visibility['instrument_types'][0]
 
             if total_time_visible < 1:
                 continue
 
-            base_pressure = request.duration / total_time_visible
-            for i, bin_start in enumerate(bin_start_times):
-                n_telescopes = self._n_possible_telescopes(bin_start, site_intervals, instrument_type)
+            if instrument_type not in site_telescope_counts:
+                site_telescope_counts[instrument_type] = self._site_telescope_counts(instrument_type)
+            proposals.append(request_visibility['proposal'])
+            base_pressures.append(request_visibility['duration'] / total_time_visible)
+            visibilities.append(self._site_visibility(site_intervals, bin_times))
+            telescope_counts.append(site_telescope_counts[instrument_type])
 
-                if n_telescopes < 1:
-                    continue
+        quarter_hour_bins = [{} for x in range(0, len(bin_times))]
+        if not proposals:
+            return quarter_hour_bins
 
-                pressure = base_pressure / n_telescopes
-                proposal = request.request_group.proposal.id
-                if not quarter_hour_bins[i].get(proposal):
-                    quarter_hour_bins[i][proposal] = pressure
-                else:
-                    quarter_hour_bins[i][proposal] += pressure
+        # requests x bins number of telescopes each request could be observed on during each bin
+        n_telescopes = np.einsum('rsb,rs->rb', np.array(visibilities), np.array(telescope_counts))
+        possible = n_telescopes >= 1
+        pressures = np.divide(
+            np.array(base_pressures)[:, np.newaxis], n_telescopes, out=np.zeros_like(n_telescopes), where=possible
+        )
+
+        proposal_ids = list(dict.fromkeys(proposals))
+        proposal_positions = {proposal: i for i, proposal in enumerate(proposal_ids)}
+        proposal_indexes = np.array([proposal_positions[proposal] for proposal in proposals])
+        proposal_pressures = np.zeros((len(proposal_ids), len(bin_times)))
+        np.add.at(proposal_pressures, proposal_indexes, pressures)
+        proposal_possible = np.zeros((len(proposal_ids), len(bin_times)), dtype=bool)
+        np.logical_or.at(proposal_possible, proposal_indexes, possible)
+
+        for proposal_index, bin_index in zip(*np.nonzero(proposal_possible)):
+            quarter_hour_bins[bin_index][proposal_ids[proposal_index]] = float(
+                proposal_pressures[proposal_index, bin_index]
+            )
         return quarter_hour_bins
 
-    def _anonymize(self, data):
+    @staticmethod
+    def _anonymize(data):
         for index, time in enumerate(data):
             data[index] = {'All Proposals': sum(time.values())}
         return data
 
-    def data(self):
+    def data(self, request_visibilities=None):
         p_data = {
             'site_nights': self._site_nights(),
             'time_bins': self._time_bins(),
@@ -189,7 +279,64 @@ class Pressure(object):
             'time_calculated': self.now
         }
         if self.anonymous:
-            p_data['pressure_data'] = self._anonymize(self._binned_pressure_by_hours_from_now())
+            p_data['pressure_data'] = self._anonymize(self._binned_pressure_by_hours_from_now(request_visibilities))
         else:
-            p_data['pressure_data'] = self._binned_pressure_by_hours_from_now()
+            p_data['pressure_data'] = self._binned_pressure_by_hours_from_now(request_visibilities)
         return p_data
+
+
+def refresh_contention_snapshot(instrument_type):
+    snapshot = Contention(instrument_type, anonymous=False).data()
+    cache.set(CONTENTION_SNAPSHOT_KEY.format(instrument_type), snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def get_contention_snapshot(instrument_type, anonymous=True):
+    """ Get the most recently calculated contention, anonymized from the same snapshot the staff see
+
+    Snapshots are only calculated by refresh_contention_and_pressure_snapshots, so this returns None until it has run.
+    """
+    snapshot = cache.get(CONTENTION_SNAPSHOT_KEY.format(instrument_type))
+    if snapshot is not None and anonymous:
+        snapshot['contention_data'] = Contention._anonymize(list(snapshot['contention_data']))
+    return snapshot
+
+
+def refresh_pressure_snapshots(instrument_types, sites):
+    """ Calculate the pressure of all, and each of, the instrument types at all, and each of, the sites
+
+    The visibility of each request is calculated once, at every site, and shared by all of the snapshots.
+    """
+    pressure = Pressure(anonymous=False)
+    request_visibilities = pressure._request_visibilities()
+    for instrument_type in [None] + list(instrument_types):
+        for site in [None] + list(sites):
+            snapshot = Pressure(instrument_type, site, anonymous=False, now=pressure.now).data(request_visibilities)
+            cache.set(
+                PRESSURE_SNAPSHOT_KEY.format(instrument_type or 'all', site or 'all'), snapshot, SNAPSHOT_TIMEOUT
+            )
+
+
+def get_pressure_snapshot(instrument_type=None, site=None, anonymous=True):
+    """ Get the most recently calculated pressure, anonymized from the same snapshot the staff see
+
+    Snapshots are only calculated by refresh_contention_and_pressure_snapshots, so this returns None until it has run.
+    """
+    snapshot = cache.get(PRESSURE_SNAPSHOT_KEY.format(instrument_type or 'all', site or 'all'))
+    if snapshot is not None and anonymous:
+        snapshot['pressure_data'] = Pressure._anonymize(list(snapshot['pressure_data']))
+    return snapshot
+
+
+def refresh_contention_and_pressure_snapshots():
+    """ Recalculate the snapshots of each schedulable instrument type at each site, unless a refresh is already running """
+    if not cache.add(SNAPSHOT_REFRESH_LOCK_KEY, True, SNAPSHOT_TIMEOUT):
+        logger.info('Contention and pressure snapshots are already being refreshed')
+        return
+    try:
+        instrument_types = configdb.get_instrument_type_codes({}, only_schedulable=True)
+        for instrument_type in instrument_types:
+            refresh_contention_snapshot(instrument_type)
+        refresh_pressure_snapshots(instrument_types, [site['code'] for site in configdb.get_site_data()])
+    finally:
+        cache.delete(SNAPSHOT_REFRESH_LOCK_KEY)
@@ -9,7 +9,7 @@ import logging
 
 from observation_portal.proposals.models import TimeAllocationKey, Proposal, Semester
 from observation_portal.common.utils import cache_function
-from observation_portal.common.configdb import configdb
+from observation_portal.common.configdb import configdb, ConfigDB, ConfigDBException
 from observation_portal.common.rise_set_utils import (get_filtered_rise_set_intervals_by_site, get_largest_interval,
                                                       get_distance_between, get_rise_set_target)
 
@@ -247,7 +247,7 @@ def get_total_request_duration(request_dict):
     return total_duration
 
 
-@cache_function()
+@cache_function(depends_on='sites')
 def get_request_duration_by_instrument_type(request_dict):
     # calculate the total time needed by the request, based on its instrument and exposures
     durations_by_instrument_type = defaultdict(float)
@@ -321,3 +321,19 @@ def get_total_duration_dict(requestgroup_dict):
             for tak in all_durations_by_tak.keys():
                 total_duration[tak] = sum(all_durations_by_tak[tak])
         return total_duration
+
+
+def get_duration_overheads_version():
+    """Return a version of the ConfigDB data that request durations are calculated from.
+
+    The version only changes when an instrument type or its overheads change, and is used to decide when the
+    stored durations need to be recalculated.
+    """
+    overheads = {}
+    for instrument_type_code, instrument_type in configdb.get_instrument_types().items():
+        try:
+            request_overheads = configdb.get_request_overheads(instrument_type_code)
+        except ConfigDBException:
+            request_overheads = None
+        overheads[instrument_type_code] = [request_overheads, instrument_type]
+    return ConfigDB._get_data_version(overheads)
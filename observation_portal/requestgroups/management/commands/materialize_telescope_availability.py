@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from datetime import datetime, timedelta
+
+from observation_portal.common.telescope_states import (materialize_telescope_availability,
+                                                         get_last_completed_night)
+
+# Number of nights materialized with each query of the telescope states
+DAYS_PER_RUN = 30
+
+
+class Command(BaseCommand):
+    help = 'Stores the nightly availability of each telescope for the completed nights in a range of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--start', type=str, required=True,
+                            help='First day to materialize, as YYYY-MM-DD')
+        parser.add_argument('-e', '--end', type=str, default='',
+                            help='Last day to materialize, as YYYY-MM-DD. Defaults to the last completed night.')
+
+    def handle(self, *args, **options):
+        first_day = datetime.strptime(options['start'], '%Y-%m-%d').date()
+        last_completed_night = get_last_completed_night()
+        if options['end']:
+            last_day = min(datetime.strptime(options['end'], '%Y-%m-%d').date(), last_completed_night)
+        else:
+            last_day = last_completed_night
+        while first_day <= last_day:
+            run_last_day = min(first_day + timedelta(days=DAYS_PER_RUN - 1), last_day)
+            count = materialize_telescope_availability(first_day, run_last_day)
+            print(f'Materialized {count} telescope availabilities from {first_day} to {run_last_day}', file=self.stdout)
+            first_day = run_last_day + timedelta(days=1)
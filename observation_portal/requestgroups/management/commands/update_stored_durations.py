@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from observation_portal.requestgroups.models import RequestGroup
+from observation_portal.requestgroups.tasks import update_stored_durations
+
+
+class Command(BaseCommand):
+    help = 'Calculates and stores the durations of RequestGroups, their Requests and Configurations'
+
+    def add_arguments(self, parser):
+        states = [state[0] for state in RequestGroup.STATE_CHOICES]
+        parser.add_argument('-s', '--states', type=str, nargs='+', choices=states,
+                            help='States of the RequestGroups to update. Defaults to all states.')
+        parser.add_argument('-m', '--missing-only', dest='missing_only', action='store_true', default=False,
+                            help='Only update RequestGroups that are missing any of their stored durations.')
+
+    def handle(self, *args, **options):
+        states = options['states']
+        print(f"Updating stored durations of RequestGroups in states: {', '.join(states or ['all'])}", file=self.stdout)
+        update_stored_durations(states=states, missing_only=options['missing_only'])
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requestgroups', '0017_request_extra_params'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelescopeAvailability',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.CharField(max_length=20)),
+                ('enclosure', models.CharField(max_length=20)),
+                ('telescope', models.CharField(max_length=20)),
+                ('day', models.DateField(db_index=True, help_text='The date the observing night started on')),
+                ('availability', models.FloatField(help_text='Fraction of the observing night the telescope was available')),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'telescope availabilities',
+                'ordering': ('site', 'enclosure', 'telescope', 'day'),
+                'unique_together': {('site', 'enclosure', 'telescope', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.9 on 2026-10-17 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requestgroups', '0018_telescopeavailability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='configuration',
+            name='stored_duration',
+            field=models.FloatField(blank=True, editable=False, help_text='The duration of this Configuration in seconds, stored so it can be aggregated in the database', null=True),
+        ),
+    ]
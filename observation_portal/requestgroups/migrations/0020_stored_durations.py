@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requestgroups', '0019_configuration_stored_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='request',
+            name='stored_duration',
+            field=models.PositiveIntegerField(blank=True, editable=False, help_text='The duration of this Request in seconds, stored so it can be aggregated in the database', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestgroup',
+            name='stored_total_duration',
+            field=models.JSONField(blank=True, editable=False, help_text='The total duration of this RequestGroup in seconds as a list of [semester, instrument_type, duration]', null=True),
+        ),
+    ]
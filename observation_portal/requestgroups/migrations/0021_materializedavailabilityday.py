@@ -0,0 +1,24 @@
+# Generated by Django 3.2.9 on 2026-10-17 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('requestgroups', '0020_stored_durations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaterializedAvailabilityDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(help_text='The date the observing nights started on', unique=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ('day',),
+            },
+        ),
+    ]
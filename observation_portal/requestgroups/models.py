@@ -2,7 +2,6 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils.functional import cached_property
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.core.cache import cache
 from django.utils import timezone
 from django.urls import reverse
 from django.forms.models import model_to_dict
@@ -132,6 +131,8 @@ class RequestGroup(models.Model):
         ('MANY', 'MANY'),
     )
 
+    SERIALIZER_EXCLUDE = ('stored_total_duration',)
+
     OBSERVATION_TYPES = (
         ('NORMAL', NORMAL),
         ('RAPID_RESPONSE', RAPID_RESPONSE),
@@ -186,6 +187,10 @@ class RequestGroup(models.Model):
         auto_now=True, db_index=True,
         help_text='Time when this RequestGroup was last changed'
     )
+    stored_total_duration = models.JSONField(
+        null=True, blank=True, editable=False,
+        help_text='The total duration of this RequestGroup in seconds as a list of [semester, instrument_type, duration]'
+    )
 
     class Meta:
         ordering = ('-created',)
@@ -219,13 +224,42 @@ class RequestGroup(models.Model):
 
     @property
     def total_duration(self):
-        cached_duration = cache.get('requestgroup_duration_{}'.format(self.id))
-        if not cached_duration:
-            duration = get_total_duration_dict(self.as_dict())
-            cache.set('requestgroup_duration_{}'.format(self.id), duration, 86400 * 30 * 6)
-            return duration
-        else:
-            return cached_duration
+        if self.stored_total_duration is not None:
+            return self._total_duration_from_stored(self.stored_total_duration)
+        return get_total_duration_dict(self.as_dict())
+
+    @staticmethod
+    def _total_duration_from_stored(stored_total_duration):
+        return {
+            TimeAllocationKey(semester, instrument_type): duration
+            for semester, instrument_type, duration in stored_total_duration
+        }
+
+    @staticmethod
+    def total_durations(request_groups):
+        """Get the total_duration of many RequestGroups at once, keyed by RequestGroup id."""
+        return {request_group.id: request_group.total_duration for request_group in request_groups}
+
+    def update_stored_durations(self):
+        """Calculate and store the durations of this RequestGroup, its Requests and their Configurations.
+
+        The rows are updated without saving the models, so the modified times and state change signals are untouched.
+        """
+        for request in self.requests.all():
+            for configuration in request.configurations.all():
+                configuration.stored_duration = configuration.calculate_duration()
+                Configuration.objects.filter(pk=configuration.pk).update(
+                    stored_duration=configuration.stored_duration
+                )
+            request.stored_duration = request.calculate_duration()
+            Request.objects.filter(pk=request.pk).update(stored_duration=request.stored_duration)
+        if self.observation_type != RequestGroup.DIRECT:
+            # DIRECT RequestGroups have no windows, so their time is not allocated to a semester
+            self.stored_total_duration = [
+                [tak.semester, tak.instrument_type, duration]
+                for tak, duration in get_total_duration_dict(self.as_dict()).items()
+            ]
+            RequestGroup.objects.filter(pk=self.pk).update(stored_total_duration=self.stored_total_duration)
 
 
 class Request(models.Model):
@@ -237,7 +271,7 @@ class Request(models.Model):
         ('CANCELED', 'CANCELED'),
     )
 
-    SERIALIZER_EXCLUDE = ('request_group',)
+    SERIALIZER_EXCLUDE = ('request_group', 'stored_duration')
 
     request_group = models.ForeignKey(
         RequestGroup, related_name='requests', on_delete=models.CASCADE,
@@ -271,6 +305,11 @@ class Request(models.Model):
         verbose_name='extra parameters',
         help_text='Extra Request parameters'
     )
+    # Request durations are rounded up to whole seconds when they are calculated, so they are stored as integers
+    stored_duration = models.PositiveIntegerField(
+        null=True, blank=True, editable=False,
+        help_text='The duration of this Request in seconds, stored so it can be aggregated in the database'
+    )
 
     class Meta:
         ordering = ('id',)
@@ -286,14 +325,13 @@ class Request(models.Model):
 
     @cached_property
     def duration(self):
-        cached_duration = cache.get('request_duration_{}'.format(self.id))
-        if not cached_duration:
-            duration = get_total_request_duration({'configurations': [c.as_dict() for c in self.configurations.all()],
-                                                  'windows': [w.as_dict() for w in self.windows.all()]})
-            cache.set('request_duration_{}'.format(self.id), duration, 86400 * 30 * 6)
-            return duration
-        else:
-            return cached_duration
+        if self.stored_duration is not None:
+            return self.stored_duration
+        return self.calculate_duration()
+
+    def calculate_duration(self):
+        return get_total_request_duration({'configurations': [c.as_dict() for c in self.configurations.all()],
+                                           'windows': [w.as_dict() for w in self.windows.all()]})
 
     @property
     def min_window_time(self):
@@ -448,7 +486,7 @@ class Configuration(models.Model):
         ('DARK', 'DARK')
     )
 
-    SERIALIZER_EXCLUDE = ('request',)
+    SERIALIZER_EXCLUDE = ('request', 'stored_duration')
 
     request = models.ForeignKey(
         Request, related_name='configurations', on_delete=models.CASCADE,
@@ -489,6 +527,11 @@ class Configuration(models.Model):
         help_text='The order that the Configurations within a Request will be observed. Configurations with priorities '
                   'that are lower numbers are executed first.'
     )
+    # Configuration durations are not rounded, so the sums of them match the durations calculated from them
+    stored_duration = models.FloatField(
+        null=True, blank=True, editable=False,
+        help_text='The duration of this Configuration in seconds, stored so it can be aggregated in the database'
+    )
 
     class Meta:
         ordering = ('id',)
@@ -501,6 +544,11 @@ class Configuration(models.Model):
 
     @cached_property
     def duration(self):
+        if self.stored_duration is not None:
+            return self.stored_duration
+        return self.calculate_duration()
+
+    def calculate_duration(self):
         request_overheads = configdb.get_request_overheads(self.instrument_type)
         return get_configuration_duration(self.as_dict(), request_overheads)['duration']
 
@@ -901,3 +949,33 @@ class DraftRequestGroup(models.Model):
 
     def __str__(self):
         return 'Draft request by: {} for proposal: {}'.format(self.author, self.proposal)
+
+
+class TelescopeAvailability(models.Model):
+    """The fraction of an observing night that a telescope was available for scheduling"""
+    site = models.CharField(max_length=20)
+    enclosure = models.CharField(max_length=20)
+    telescope = models.CharField(max_length=20)
+    day = models.DateField(db_index=True, help_text='The date the observing night started on')
+    availability = models.FloatField(help_text='Fraction of the observing night the telescope was available')
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('site', 'enclosure', 'telescope', 'day')
+        unique_together = ('site', 'enclosure', 'telescope', 'day')
+        verbose_name_plural = 'telescope availabilities'
+
+    def __str__(self):
+        return '{}.{}.{} on {}: {}'.format(self.site, self.enclosure, self.telescope, self.day, self.availability)
+
+
+class MaterializedAvailabilityDay(models.Model):
+    """A day for which the nightly availability of every telescope has been stored"""
+    day = models.DateField(unique=True, help_text='The date the observing nights started on')
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('day',)
+
+    def __str__(self):
+        return str(self.day)
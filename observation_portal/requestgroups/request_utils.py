@@ -1,14 +1,16 @@
-from datetime import timedelta
-from rise_set.angle import Angle
-from rise_set.astrometry import calculate_airmass_at_times
+from datetime import timezone
+import numpy as np
 import requests
 import json
 
 from observation_portal.common.configdb import configdb, ConfigDB
 from observation_portal.common.telescope_states import TelescopeStates, filter_telescope_states_by_intervals
-from observation_portal.common.rise_set_utils import get_rise_set_target, get_filtered_rise_set_intervals_by_site
+from observation_portal.common.rise_set_utils import (get_rise_set_target, get_filtered_rise_set_intervals_by_site,
+                                                      get_airmasses_at_sites)
 from observation_portal.requestgroups.target_helpers import TARGET_TYPE_HELPER_MAP
 
+AIRMASS_SAMPLE_INTERVAL = np.timedelta64(10, 'm')
+
 
 def get_telescope_states_for_request(request_dict, is_staff=False):
     # TODO: update to support multiple instruments in a list
@@ -54,19 +56,11 @@ def get_telescope_states_for_request(request_dict, is_staff=False):
     return filtered_telescope_states
 
 
-def date_range_from_interval(start_time, end_time, dt=timedelta(minutes=15)):
-    time = start_time
-    while time < end_time:
-        yield time
-        time += dt
-
-
 def get_airmasses_for_request_at_sites(request_dict, is_staff=False):
     data = {
         'airmass_data': {},
     }
     instrument_type = request_dict['configurations'][0]['instrument_type']
-    constraints = request_dict['configurations'][0]['constraints']
     target = request_dict['configurations'][0]['target']
     target_type = str(target.get('type', '')).upper()
     only_schedulable = not (is_staff and ConfigDB.is_location_fully_set(request_dict.get('location', {})))
@@ -79,46 +73,42 @@ def get_airmasses_for_request_at_sites(request_dict, is_staff=False):
             telescope_code=request_dict['location'].get('telescope'),
             only_schedulable=only_schedulable
         )
-        rs_target = get_rise_set_target(target)
-        for site_id, site_details in site_data.items():
-            night_times = []
-            site_lat = Angle(degrees=site_details['latitude'])
-            site_lon = Angle(degrees=site_details['longitude'])
-            site_alt = site_details['altitude']
+        times_by_site = {}
+        for site_id in site_data:
             intervals = get_filtered_rise_set_intervals_by_site(request_dict, site_id, is_staff=is_staff).get(site_id, [])
-            for interval in intervals:
-                night_times.extend(
-                    [time for time in date_range_from_interval(interval[0], interval[1], dt=timedelta(minutes=10))])
-
-            if len(night_times) > 0:
-                if site_id not in data:
-                    data['airmass_data'][site_id] = {
-                        'times': [time.strftime('%Y-%m-%dT%H:%M') for time in night_times],
-                    }
-
-                # Need to average airmass values for set of unique targets in request
-                unique_targets_constraints = set([json.dumps((configuration['target'], configuration['constraints'])) for configuration in request_dict['configurations']])
-                unique_count = len(unique_targets_constraints)
-                max_airmass = 0.0
-                for target_constraints in unique_targets_constraints:
-                    (target, constraints) = json.loads(target_constraints)
-                    rs_target = get_rise_set_target(target)
-                    airmasses = calculate_airmass_at_times(
-                        night_times, rs_target, site_lat, site_lon, site_alt
-                    )
-                    if 'airmasses' in data['airmass_data'][site_id]:
-                        for index, airmass_value in enumerate(airmasses):
-                            data['airmass_data'][site_id]['airmasses'][index] += airmass_value
-                    else:
-                        data['airmass_data'][site_id]['airmasses'] = airmasses
-                    max_airmass += constraints['max_airmass']
-                # Now we need to divide out the number of unique constraints/targets
-                data['airmass_limit'] = max_airmass / unique_count
-                data['airmass_data'][site_id]['airmasses'] = [val / unique_count for val in data['airmass_data'][site_id]['airmasses']]
+            night_times = [
+                np.arange(as_utc_datetime64(interval[0]), as_utc_datetime64(interval[1]), AIRMASS_SAMPLE_INTERVAL)
+                for interval in intervals
+            ]
+            if night_times:
+                times_by_site[site_id] = np.concatenate(night_times)
+
+        # Need to average airmass values for set of unique targets in request
+        unique_targets_constraints = [
+            json.loads(target_constraints) for target_constraints in
+            set([json.dumps((configuration['target'], configuration['constraints'])) for configuration in request_dict['configurations']])
+        ]
+        unique_count = len(unique_targets_constraints)
+        rs_targets = [get_rise_set_target(target) for target, _ in unique_targets_constraints]
+        airmasses_by_site = get_airmasses_at_sites(rs_targets, times_by_site, site_data)
+        for site_id, airmasses in airmasses_by_site.items():
+            data['airmass_data'][site_id] = {
+                'times': np.datetime_as_string(times_by_site[site_id], unit='m').tolist(),
+                'airmasses': (airmasses.sum(axis=0) / unique_count).tolist()
+            }
+        if airmasses_by_site:
+            # Now we need to divide out the number of unique constraints/targets
+            data['airmass_limit'] = sum(
+                constraints['max_airmass'] for _, constraints in unique_targets_constraints
+            ) / unique_count
 
     return data
 
 
+def as_utc_datetime64(time):
+    return np.datetime64(time.astimezone(timezone.utc).replace(tzinfo=None))
+
+
 def exposure_completion_percentage(configuration_statuses):
     total_time = 0
     completed_time = 0
@@ -722,7 +722,7 @@ class RequestGroupSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = RequestGroup
-        fields = '__all__'
+        exclude = RequestGroup.SERIALIZER_EXCLUDE
         read_only_fields = (
             'id', 'created', 'state', 'modified'
         )
@@ -773,6 +773,7 @@ class RequestGroupSerializer(serializers.ModelSerializer):
                 telescope_class = location_data.get('telescope_class')
                 if telescope_class:
                     cache.set(f"observation_portal_last_change_time_{telescope_class}", now, None)
+            request_group.update_stored_durations()
 
         if validated_data['observation_type'] == RequestGroup.NORMAL:
             debit_ipp_time(request_group)
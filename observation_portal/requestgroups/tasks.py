@@ -1,12 +1,92 @@
 import dramatiq
 import logging
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Q
 
 from observation_portal.common.state_changes import update_request_states_for_window_expiration
+from observation_portal.common.configdb import ConfigDB, ConfigDBException
+from observation_portal.requestgroups.contention import refresh_contention_and_pressure_snapshots
+from observation_portal.requestgroups.duration_utils import get_duration_overheads_version
+from observation_portal.requestgroups.models import RequestGroup
+from observation_portal.common.telescope_states import (get_last_completed_night, materialize_telescope_availability,
+                                                         ElasticSearchException)
 
 logger = logging.getLogger(__name__)
 
+DURATION_OVERHEADS_VERSION_KEY = 'duration_overheads_version'
+STORED_DURATIONS_FAILED_KEY = 'stored_durations_failed_request_groups'
+
 
 @dramatiq.actor()
 def expire_requests():
     logger.info('Expiring requests')
     update_request_states_for_window_expiration()
+
+
+@dramatiq.actor()
+def refresh_configdb():
+    try:
+        ConfigDB.refresh_configdb_data('sites')
+    except ConfigDBException:
+        # The previously published sites data stays in use until ConfigDB can be reached again
+        logger.exception('Failed to refresh ConfigDB sites data')
+
+
+@dramatiq.actor()
+def refresh_stored_durations():
+    duration_overheads_version = get_duration_overheads_version()
+    previous_version = cache.get(DURATION_OVERHEADS_VERSION_KEY)
+    if previous_version is not None and duration_overheads_version != previous_version:
+        # RequestGroups that failed against the previous overheads are retried against the new ones
+        cache.delete(STORED_DURATIONS_FAILED_KEY)
+        update_stored_durations()
+    # Readers calculate the durations that are missing, so filling them in only saves them that work
+    update_stored_durations(states=None, missing_only=True)
+    cache.set(DURATION_OVERHEADS_VERSION_KEY, duration_overheads_version, None)
+
+
+def update_stored_durations(states=('PENDING',), missing_only=False):
+    """Calculate and store the durations of the RequestGroups in the given states, or in any state if states is None
+
+    RequestGroups whose durations fail to calculate, such as those with retired instrument types, are recorded and
+    skipped when only missing durations are filled in, until the duration overheads change.
+    """
+    failed_ids = cache.get(STORED_DURATIONS_FAILED_KEY, set())
+    request_groups = RequestGroup.objects.all()
+    if states is not None:
+        request_groups = request_groups.filter(state__in=states)
+    if missing_only:
+        request_groups = request_groups.filter(
+            Q(requests__stored_duration__isnull=True)
+            | Q(requests__configurations__stored_duration__isnull=True)
+            | (Q(stored_total_duration__isnull=True) & ~Q(observation_type=RequestGroup.DIRECT))
+        ).exclude(id__in=failed_ids).distinct()
+    logger.info(f'Updating stored durations of {request_groups.count()} request groups')
+    for request_group in request_groups.iterator():
+        try:
+            request_group.update_stored_durations()
+            failed_ids.discard(request_group.id)
+        except Exception:
+            logger.exception(f'Failed to update stored durations of request group {request_group.id}')
+            failed_ids.add(request_group.id)
+    cache.set(STORED_DURATIONS_FAILED_KEY, failed_ids, None)
+
+
+@dramatiq.actor()
+def materialize_completed_nights_availability(days=3):
+    # Nights before the most recent completed one are recomputed as well, in case a previous run failed
+    last_day = get_last_completed_night()
+    first_day = last_day - timedelta(days=days - 1)
+    logger.info(f'Materializing telescope availability for nights from {first_day} to {last_day}')
+    try:
+        materialize_telescope_availability(first_day, last_day)
+    except ElasticSearchException:
+        logger.exception('Failed to materialize telescope availability')
+
+
+@dramatiq.actor()
+def refresh_contention_and_pressure():
+    logger.info('Refreshing contention and pressure snapshots')
+    refresh_contention_and_pressure_snapshots()
@@ -1,5 +1,6 @@
 from django.utils import timezone
 from django.test import TestCase
+from django.core.cache import caches
 from mixer.backend.django import mixer
 from rest_framework.serializers import ValidationError
 from datetime import datetime, timedelta
@@ -17,6 +18,8 @@ from observation_portal.common.test_helpers import SetTimeMixin
 from observation_portal.requestgroups.duration_utils import PER_CONFIGURATION_STARTUP_TIME
 from observation_portal.requestgroups.serializers import InstrumentTypeValidationHelper, ModeValidationHelper
 from observation_portal.requestgroups.test.test_api import generic_payload
+from observation_portal.requestgroups import tasks
+from observation_portal.requestgroups.tasks import update_stored_durations
 from observation_portal.observations.models import Observation
 
 
@@ -102,6 +105,54 @@ class TestRequestGroupTotalDuration(SetTimeMixin, TestCase):
         taks = self.requests[0].time_allocation_keys
         self.assertEqual(sum_duration, total_duration[taks[0]])
 
+    def test_stored_durations_are_used_until_they_are_updated(self):
+        total_duration = self.rg_single.total_duration
+        self.rg_single.update_stored_durations()
+        request = Request.objects.get(pk=self.request.pk)
+        request_group = RequestGroup.objects.get(pk=self.rg_single.pk)
+        self.assertEqual(request.stored_duration, request.calculate_duration())
+        self.assertEqual(request_group.total_duration, total_duration)
+
+        self.instrument_config.exposure_count = 4
+        self.instrument_config.save()
+        request_group = RequestGroup.objects.get(pk=self.rg_single.pk)
+        self.assertEqual(request_group.total_duration, total_duration)
+        self.assertEqual(Request.objects.get(pk=self.request.pk).duration, request.stored_duration)
+
+        request_group.update_stored_durations()
+        request_group = RequestGroup.objects.get(pk=self.rg_single.pk)
+        self.assertGreater(request_group.total_duration[self.request.time_allocation_keys[0]],
+                           total_duration[self.request.time_allocation_keys[0]])
+
+    def test_missing_stored_durations_are_filled_in_for_all_states(self):
+        self.rg_single.state = 'COMPLETED'
+        self.rg_single.save()
+        self.request.state = 'COMPLETED'
+        self.request.save()
+        update_stored_durations(states=None, missing_only=True)
+
+        request = Request.objects.get(pk=self.request.pk)
+        request_group = RequestGroup.objects.get(pk=self.rg_single.pk)
+        self.assertEqual(request.stored_duration, request.calculate_duration())
+        self.assertIsNotNone(request_group.stored_total_duration)
+        for configuration in request.configurations.all():
+            self.assertEqual(configuration.stored_duration, configuration.calculate_duration())
+
+    def test_request_groups_that_fail_are_skipped_until_the_overheads_change(self):
+        locmem_cache = caches.create_connection('testlocmem')
+        locmem_cache.clear()
+        with patch.object(tasks, 'cache', locmem_cache), \
+                patch.object(RequestGroup, 'update_stored_durations', autospec=True,
+                             side_effect=ConfigDBException('retired instrument type')) as mock_update:
+            tasks.update_stored_durations(states=None, missing_only=True)
+            self.assertEqual(mock_update.call_count, 2)
+            tasks.update_stored_durations(states=None, missing_only=True)
+            self.assertEqual(mock_update.call_count, 2)
+
+            locmem_cache.set(tasks.DURATION_OVERHEADS_VERSION_KEY, 'previous version')
+            tasks.refresh_stored_durations()
+            self.assertGreater(mock_update.call_count, 2)
+
 
 class TestRequestDuration(SetTimeMixin, TestCase):
     def setUp(self):
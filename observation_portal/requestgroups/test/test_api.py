@@ -10,11 +10,13 @@ import observation_portal.requestgroups.signals.handlers  # noqa
 import observation_portal.observations.signals.handlers  # noqa
 from observation_portal.requestgroups import serializers
 from observation_portal.requestgroups import views
+from observation_portal.requestgroups import viewsets
 from observation_portal.common import state_changes
 from observation_portal.common.test_helpers import create_simple_configuration
 from observation_portal.common.configdb import configdb
 
-from observation_portal.requestgroups.contention import Pressure
+from observation_portal.requestgroups import contention
+from observation_portal.requestgroups.contention import Contention, Pressure
 from observation_portal.accounts.test_utils import blend_user
 
 from django.urls import reverse
@@ -28,6 +30,7 @@ from mixer.backend.django import mixer
 from django.utils import timezone
 from datetime import datetime, timedelta
 import copy
+import json
 import random
 from math import ceil, cos, sin, radians
 from unittest.mock import patch
@@ -2786,24 +2789,140 @@ class TestSchedulableRequestsApi(SetTimeMixin, APITestCase):
         response = self.client.get(reverse('api:request_groups-schedulable-requests'))
         self.assertEqual(response.status_code, 403)
 
+    def test_requestgroups_without_time_allocation_are_skipped(self, modify_mock):
+        self.time_allocation_1m0.delete()
+        response = self.client.get(reverse('api:request_groups-schedulable-requests'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 0)
+
+    def test_requestgroups_without_enough_time_left_are_skipped(self, modify_mock):
+        self.time_allocation_1m0.std_time_used = self.time_allocation_1m0.std_allocation
+        self.time_allocation_1m0.save()
+        response = self.client.get(reverse('api:request_groups-schedulable-requests'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 0)
+
+    def test_since_only_returns_changed_requestgroups_and_tombstones(self, modify_mock):
+        since = timezone.now() + timedelta(minutes=30)
+        self.mock_now.return_value = since + timedelta(minutes=30)
+        changed_rg = self.rgs[0]
+        changed_request = changed_rg.requests.first()
+        changed_request.observation_note = 'changed'
+        changed_request.save()
+        canceled_rg = self.rgs[1]
+        canceled_rg.state = 'CANCELED'
+        canceled_rg.save()
+
+        response = self.client.get(
+            reverse('api:request_groups-schedulable-requests'), {'since': since.isoformat()}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([rg['id'] for rg in response.json()['request_groups']], [changed_rg.id])
+        self.assertEqual(response.json()['tombstones'], [canceled_rg.id])
+        self.assertEqual(datetime_parser(response.json()['cursor']), timezone.now())
+
+    def test_since_returns_changes_saved_just_before_the_since_time(self, modify_mock):
+        since = timezone.now() + timedelta(minutes=30)
+        self.mock_now.return_value = since - timedelta(seconds=10)
+        changed_rg = self.rgs[0]
+        changed_rg.name = 'changed'
+        changed_rg.save()
+        self.mock_now.return_value = since + timedelta(minutes=30)
+
+        response = self.client.get(
+            reverse('api:request_groups-schedulable-requests'), {'since': since.isoformat()}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([rg['id'] for rg in response.json()['request_groups']], [changed_rg.id])
+
+    def test_since_tombstones_requestgroups_of_deactivated_proposals(self, modify_mock):
+        since = timezone.now() + timedelta(minutes=30)
+        self.mock_now.return_value = since + timedelta(minutes=30)
+        self.proposal.active = False
+        self.proposal.save()
+
+        response = self.client.get(
+            reverse('api:request_groups-schedulable-requests'), {'since': since.isoformat()}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['request_groups']), 0)
+        self.assertEqual(response.json()['tombstones'], sorted(rg.id for rg in self.rgs))
+
+    def test_since_with_no_changes_is_empty(self, modify_mock):
+        self.mock_now.return_value += timedelta(hours=1)
+        response = self.client.get(
+            reverse('api:request_groups-schedulable-requests'), {'since': timezone.now().isoformat()}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['request_groups']), 0)
+        self.assertEqual(len(response.json()['tombstones']), 0)
+
+    def test_since_invalid_time(self, modify_mock):
+        response = self.client.get(reverse('api:request_groups-schedulable-requests') + '?since=notatime')
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_returns_same_requestgroups(self, modify_mock):
+        response = self.client.get(reverse('api:request_groups-schedulable-requests'))
+        with patch.object(viewsets.RequestGroupViewSet, 'schedulable_requests_chunk_size', 3):
+            stream_response = self.client.get(reverse('api:request_groups-schedulable-requests') + '?stream=true')
+
+        self.assertEqual(stream_response.status_code, 200)
+        self.assertTrue(stream_response.streaming)
+        stream_data = json.loads(b''.join(stream_response.streaming_content))
+        self.assertEqual(sorted(stream_data, key=lambda rg: rg['id']), sorted(response.json(), key=lambda rg: rg['id']))
+
+    def test_stream_with_since(self, modify_mock):
+        since = timezone.now() + timedelta(minutes=30)
+        self.mock_now.return_value = since + timedelta(minutes=30)
+        canceled_rg = self.rgs[1]
+        canceled_rg.state = 'CANCELED'
+        canceled_rg.save()
+
+        response = self.client.get(
+            reverse('api:request_groups-schedulable-requests'), {'since': since.isoformat(), 'stream': 'true'}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        stream_data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(stream_data['request_groups']), 0)
+        self.assertEqual(stream_data['tombstones'], [canceled_rg.id])
+        self.assertEqual(datetime_parser(stream_data['cursor']), timezone.now())
+
 
 class TestContention(APITestCase):
     def setUp(self):
         super().setUp()
-        request = mixer.blend(Request, state='PENDING')
+        self.locmem_cache = caches.create_connection('testlocmem')
+        self.locmem_cache.clear()
+        self.cache_patch = patch.object(contention, 'cache', self.locmem_cache)
+        self.cache_patch.start()
+        # DIRECT RequestGroups need no semester for their durations to be stored
+        requestgroup = mixer.blend(RequestGroup, observation_type=RequestGroup.DIRECT)
+        request = mixer.blend(Request, request_group=requestgroup, state='PENDING')
         mixer.blend(
             Window, start=timezone.now(), end=timezone.now() + timedelta(days=30), request=request
         )
         mixer.blend(Location, request=request)
         conf = mixer.blend(Configuration, type='EXPOSE', instrument_type='1M0-SCICAM-SBIG', request=request)
         mixer.blend(Target, ra=15.0, type='ICRS', configuration=conf)
-        mixer.blend(InstrumentConfig, configuration=conf)
+        mixer.blend(InstrumentConfig, configuration=conf, exposure_count=1, exposure_time=30)
         mixer.blend(AcquisitionConfig, configuration=conf)
         mixer.blend(GuidingConfig, configuration=conf)
         mixer.blend(Constraints, configuration=conf)
+        requestgroup.update_stored_durations()
         self.request = request
 
+    def tearDown(self):
+        self.cache_patch.stop()
+
     def test_contention_no_auth(self):
+        contention.refresh_contention_snapshot('1M0-SCICAM-SBIG')
         response = self.client.get(
             reverse('api:contention', kwargs={'instrument_type': '1M0-SCICAM-SBIG'})
         )
@@ -2811,6 +2930,7 @@ class TestContention(APITestCase):
         self.assertEqual(response.json()['contention_data'][2]['All Proposals'], 0)
 
     def test_contention_staff(self):
+        contention.refresh_contention_snapshot('1M0-SCICAM-SBIG')
         user = blend_user(user_params={'is_staff': True})
         self.client.force_login(user)
         response = self.client.get(
@@ -2819,6 +2939,44 @@ class TestContention(APITestCase):
         self.assertNotEqual(response.json()['contention_data'][1][self.request.request_group.proposal.id], 0)
         self.assertNotIn(self.request.request_group.proposal.id, response.json()['contention_data'][2])
 
+    def test_contention_uses_stored_configuration_durations(self):
+        configuration = self.request.configurations.first()
+        configuration.refresh_from_db()
+        Configuration.objects.filter(pk=configuration.pk).update(stored_duration=configuration.stored_duration + 100)
+        contention.refresh_contention_snapshot('1M0-SCICAM-SBIG')
+        user = blend_user(user_params={'is_staff': True})
+        self.client.force_login(user)
+        response = self.client.get(
+           reverse('api:contention', kwargs={'instrument_type': '1M0-SCICAM-SBIG'})
+        )
+        self.assertAlmostEqual(
+            response.json()['contention_data'][1][self.request.request_group.proposal.id],
+            configuration.stored_duration + 100
+        )
+
+    def test_contention_calculates_durations_that_are_not_stored(self):
+        configuration = self.request.configurations.first()
+        Configuration.objects.filter(pk=configuration.pk).update(stored_duration=None)
+        contention.refresh_contention_snapshot('1M0-SCICAM-SBIG')
+        response = self.client.get(
+            reverse('api:contention', kwargs={'instrument_type': '1M0-SCICAM-SBIG'})
+        )
+        self.assertAlmostEqual(
+            response.json()['contention_data'][1]['All Proposals'], configuration.calculate_duration()
+        )
+
+    def test_contention_is_not_calculated_on_request(self):
+        with patch.object(Contention, 'data', autospec=True) as mock_data:
+            response = self.client.get(
+                reverse('api:contention', kwargs={'instrument_type': '1M0-SCICAM-SBIG'})
+            )
+        self.assertEqual(response.status_code, 503)
+        mock_data.assert_not_called()
+
+    def test_contention_of_unknown_instrument_type(self):
+        response = self.client.get(reverse('api:contention', kwargs={'instrument_type': 'NOT-AN-INSTRUMENT'}))
+        self.assertEqual(response.status_code, 404)
+
 
 class TestPressure(APITestCase):
     def setUp(self):
@@ -2833,6 +2991,11 @@ class TestPressure(APITestCase):
         self.site_intervals_patch = patch('observation_portal.requestgroups.contention.get_site_rise_set_intervals')
         self.mock_site_intervals = self.site_intervals_patch.start()
 
+        self.locmem_cache = caches.create_connection('testlocmem')
+        self.locmem_cache.clear()
+        self.cache_patch = patch.object(contention, 'cache', self.locmem_cache)
+        self.cache_patch.start()
+
         for i in range(24):
             requestgroup = mixer.blend(RequestGroup, observation_type=RequestGroup.NORMAL)
             request = mixer.blend(Request, request_group=requestgroup, state='PENDING')
@@ -2853,8 +3016,10 @@ class TestPressure(APITestCase):
     def tearDown(self):
         self.timezone_patch.stop()
         self.site_intervals_patch.stop()
+        self.cache_patch.stop()
 
     def test_pressure_no_auth(self):
+        contention.refresh_contention_and_pressure_snapshots()
         response = self.client.get(reverse('api:pressure'))
         self.assertEqual(len(response.json()['pressure_data']), 24 * 4)
         self.assertIn('All Proposals', response.json()['pressure_data'][0])
@@ -2864,11 +3029,72 @@ class TestPressure(APITestCase):
         self.assertIn('instrument_type', response.json())
 
     def test_pressure_auth(self):
+        contention.refresh_contention_and_pressure_snapshots()
         user = blend_user(user_params={'is_staff': True})
         self.client.force_login(user)
         response = self.client.get(reverse('api:pressure'))
         self.assertNotIn('All Proposals', response.json()['pressure_data'][0])
 
+    def test_pressure_is_served_from_snapshot(self):
+        contention.refresh_contention_and_pressure_snapshots()
+        user = blend_user(user_params={'is_staff': True})
+        with patch.object(Pressure, 'data', autospec=True) as mock_data:
+            anonymous_response = self.client.get(reverse('api:pressure'))
+            self.client.force_login(user)
+            staff_response = self.client.get(reverse('api:pressure'))
+            mock_data.assert_not_called()
+        self.assertIn('All Proposals', anonymous_response.json()['pressure_data'][0])
+        self.assertEqual(anonymous_response.json()['time_calculated'], staff_response.json()['time_calculated'])
+
+    def test_pressure_is_not_calculated_on_request(self):
+        with patch.object(Pressure, 'data', autospec=True) as mock_data:
+            response = self.client.get(reverse('api:pressure'), {'instrument': '1M0-SCICAM-SBIG', 'site': 'tst'})
+        self.assertEqual(response.status_code, 503)
+        mock_data.assert_not_called()
+
+    def test_pressure_of_unknown_instrument_type_or_site(self):
+        response = self.client.get(reverse('api:pressure'), {'instrument': 'NOT-AN-INSTRUMENT'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('api:pressure'), {'site': 'notasite'})
+        self.assertEqual(response.status_code, 400)
+
+    @patch('observation_portal.requestgroups.contention.get_filtered_rise_set_intervals_by_site')
+    def test_pressure_snapshots_share_request_visibilities(self, mock_intervals):
+        # The requests of setUp have windows around the real time rather than the patched one, so they are not pending
+        pending_requests = []
+        for ra in [30.0, 200.0]:
+            requestgroup = mixer.blend(RequestGroup, observation_type=RequestGroup.NORMAL)
+            request = mixer.blend(Request, request_group=requestgroup, state='PENDING')
+            mixer.blend(Window, start=self.now - timedelta(hours=1), end=self.now + timedelta(days=2), request=request)
+            conf = mixer.blend(Configuration, type='EXPOSE', instrument_type='1M0-SCICAM-SBIG', request=request)
+            mixer.blend(Target, ra=ra, dec=-20.0, proper_motion_ra=0.0, proper_motion_dec=0.0, type='ICRS',
+                        configuration=conf)
+            mixer.blend(Location, request=request, site='')
+            mixer.blend(Constraints, configuration=conf)
+            mixer.blend(InstrumentConfig, configuration=conf, exposure_count=1, exposure_time=30)
+            mixer.blend(AcquisitionConfig, configuration=conf)
+            mixer.blend(GuidingConfig, configuration=conf)
+            pending_requests.append(request)
+        mock_intervals.side_effect = lambda request_dict, site: {site: [
+            [self.now + timedelta(hours=2), self.now + timedelta(hours=6)]
+        ]}
+        contention.refresh_contention_and_pressure_snapshots()
+        # Each request's visibility is calculated once per site, whatever the number of snapshots
+        n_sites = len(configdb.get_site_data())
+        self.assertEqual(mock_intervals.call_count, len(pending_requests) * n_sites)
+
+        snapshot = contention.get_pressure_snapshot('1M0-SCICAM-SBIG', 'tst', anonymous=False)
+        expected = Pressure('1M0-SCICAM-SBIG', 'tst', anonymous=False).data()
+        self.assertEqual(snapshot, expected)
+        self.assertGreater(sum(sum(time.values()) for time in snapshot['pressure_data']), 0)
+
+    def test_refresh_does_not_overlap_a_running_refresh(self):
+        self.locmem_cache.set(contention.SNAPSHOT_REFRESH_LOCK_KEY, True)
+        with patch.object(Pressure, 'data', autospec=True) as mock_data:
+            contention.refresh_contention_and_pressure_snapshots()
+        mock_data.assert_not_called()
+        self.assertIsNone(contention.get_pressure_snapshot())
+
     def test_get_site_data_should_get_one_site(self):
         pressure = Pressure(site='tst')
         self.assertEqual(len(pressure.sites), 1)
@@ -3032,6 +3258,31 @@ class TestPressure(APITestCase):
         sum_of_pressure = sum(sum(time.values()) for i, time in enumerate(p._binned_pressure_by_hours_from_now()))
         self.assertGreater(sum_of_pressure, 0)
 
+    @patch('observation_portal.requestgroups.contention.get_filtered_rise_set_intervals_by_site')
+    def test_binned_pressure_is_split_between_possible_telescopes(self, mock_intervals):
+        requestgroup = mixer.blend(RequestGroup, observation_type=RequestGroup.NORMAL)
+        request = mixer.blend(Request, request_group=requestgroup, state='PENDING', duration=120*60)  # 2 hour duration.
+        mixer.blend(Window, request=request)
+        mixer.blend(Location, request=request, site='tst')
+        conf = mixer.blend(Configuration, request=request, type='EXPOSE', instrument_type='1M0-SCICAM-SBIG')
+        mixer.blend(InstrumentConfig, configuration=conf)
+        mixer.blend(AcquisitionConfig, configuration=conf)
+        mixer.blend(GuidingConfig, configuration=conf)
+        mixer.blend(Constraints, configuration=conf)
+        mixer.blend(Target, configuration=conf)
+
+        mock_intervals.return_value = {'tst': [
+            [self.now + timedelta(hours=2), self.now + timedelta(hours=6)],
+        ]}
+        p = Pressure()
+        p.requests = [request]
+        binned_pressure = p._binned_pressure_by_hours_from_now()
+        pressured_bins = [i for i, time in enumerate(binned_pressure) if time]
+        self.assertEqual(pressured_bins, list(range(2 * 4, 6 * 4)))
+        # 2 hours over 4 hours visible, split between the 2 telescopes with the instrument type at tst
+        for i in pressured_bins:
+            self.assertAlmostEqual(binned_pressure[i][requestgroup.proposal.id], 0.25)
+
     def test_binned_pressure_by_hours_from_now_should_be_zero_pressure(self):
         p = Pressure()
         p.requests = []
@@ -1,10 +1,13 @@
 from django.utils import timezone
 from django.test import TestCase
 from mixer.backend.django import mixer
-from datetime import datetime
+from datetime import datetime, timedelta
 from copy import deepcopy
 from unittest.mock import patch
 
+import numpy as np
+from rise_set.angle import Angle
+from rise_set.astrometry import calculate_airmass_at_times
 from time_intervals.intervals import Intervals
 
 from observation_portal.requestgroups.request_utils import (get_airmasses_for_request_at_sites, get_telescope_states_for_request,
@@ -14,6 +17,7 @@ from observation_portal.requestgroups.models import (Request, Configuration, Tar
 from observation_portal.proposals.models import Proposal, TimeAllocation, Semester
 from observation_portal.common.test_telescope_states import TelescopeStatesFakeInput
 from observation_portal.common.test_helpers import SetTimeMixin
+from observation_portal.common.rise_set_utils import get_rise_set_target, get_airmasses_at_sites
 
 
 class BaseSetupRequest(SetTimeMixin, TestCase):
@@ -522,6 +526,34 @@ class TestRequestAirmass(BaseSetupRequest):
             if atime > expected_null_range[0] and atime < expected_null_range[1]:
                 self.fail("Should not get airmass ({}) within range {}".format(atime, expected_null_range))
 
+    def test_vectorized_airmass_matches_rise_set(self):
+        site_details = {
+            'tst': {'latitude': -30.1673833333, 'longitude': -70.8047888889, 'altitude': 2198.0},
+            'ogg': {'latitude': 20.7069444444, 'longitude': -156.2575, 'altitude': 3055.0},
+            'sea': {'latitude': 52.0, 'longitude': 5.0, 'altitude': 0.0}
+        }
+        rs_targets = [
+            get_rise_set_target({'type': 'ICRS', 'name': 'target', 'ra': ra, 'dec': dec, 'proper_motion_ra': 0.0,
+                                 'proper_motion_dec': 0.0, 'epoch': 2000, 'parallax': 0.0})
+            for ra, dec in [(83.8, -5.4), (250.0, 36.5), (10.0, -70.0)]
+        ]
+        # Samples over whole days months apart, so the targets are followed from the zenith down past the horizon
+        for start in [datetime(2016, 1, 10), datetime(2016, 10, 1)]:
+            times = [start + timedelta(minutes=20 * i) for i in range(72)]
+            airmasses = get_airmasses_at_sites(
+                rs_targets, {site: np.array(times, dtype='datetime64[us]') for site in site_details}, site_details
+            )
+            for site, site_detail in site_details.items():
+                for rs_target, target_airmasses in zip(rs_targets, airmasses[site]):
+                    # rise_set only refreshes the sidereal time of its slalib parameters after the first time,
+                    # so it is compared one day at a time, up to the largest max airmass a request can have
+                    expected_airmasses = np.array(calculate_airmass_at_times(
+                        times, rs_target, Angle(degrees=site_detail['latitude']),
+                        Angle(degrees=site_detail['longitude']), site_detail['altitude']
+                    ))
+                    usable = expected_airmasses <= 25.0
+                    np.testing.assert_allclose(target_airmasses[usable], expected_airmasses[usable], rtol=2e-5)
+
     def test_airmass_calculation_empty(self):
         self.location.site = 'cpt'
         self.location.save()
@@ -15,11 +15,11 @@ import logging
 from observation_portal import settings
 from observation_portal.common.configdb import configdb
 from observation_portal.common.telescope_states import (
-    TelescopeStates, get_telescope_availability_per_day, combine_telescope_availabilities_by_site_and_class,
-    ElasticSearchException
+    TelescopeStates, get_materialized_telescope_availability_per_day,
+    combine_telescope_availabilities_by_site_and_class, ElasticSearchException
 )
 from observation_portal.requestgroups.request_utils import get_airmasses_for_request_at_sites
-from observation_portal.requestgroups.contention import Contention, Pressure
+from observation_portal.requestgroups.contention import get_contention_snapshot, get_pressure_snapshot
 from observation_portal.requestgroups.filters import InstrumentsInformationFilter, LastChangedFilter
 from observation_portal.common.doc_examples import EXAMPLE_RESPONSES
 from observation_portal.common.schema import ObservationPortalSchema
@@ -77,7 +77,7 @@ class TelescopeAvailabilityView(APIView):
         sites = request.query_params.getlist('site')
         telescopes = request.query_params.getlist('telescope')
         try:
-            telescope_availability = get_telescope_availability_per_day(
+            telescope_availability = get_materialized_telescope_availability_per_day(
                 start, end, sites=sites, telescopes=telescopes
             )
         except ElasticSearchException:
@@ -166,16 +166,23 @@ class InstrumentsInformationView(APIView):
         return 'getInstruments'
 
 
+def snapshot_response(snapshot):
+    if snapshot is None:
+        return Response(
+            {'errors': ['This data has not been calculated yet, please try again later']},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return Response(snapshot)
+
+
 class ContentionView(APIView):
     permission_classes = (AllowAny,)
     schema = None
 
     def get(self, request, instrument_type):
-        if request.user.is_staff:
-            contention = Contention(instrument_type, anonymous=False)
-        else:
-            contention = Contention(instrument_type)
-        return Response(contention.data())
+        if instrument_type not in configdb.get_instrument_type_codes({}, only_schedulable=True):
+            return Response({'errors': [f'Unknown instrument type {instrument_type}']}, status=status.HTTP_404_NOT_FOUND)
+        return snapshot_response(get_contention_snapshot(instrument_type, anonymous=not request.user.is_staff))
 
 
 class PressureView(APIView):
@@ -185,11 +192,14 @@ class PressureView(APIView):
     def get(self, request):
         instrument_type = request.GET.get('instrument')
         site = request.GET.get('site')
-        if request.user.is_staff:
-            pressure = Pressure(instrument_type, site, anonymous=False)
-        else:
-            pressure = Pressure(instrument_type, site)
-        return Response(pressure.data())
+        errors = []
+        if instrument_type and instrument_type not in configdb.get_instrument_type_codes({}, only_schedulable=True):
+            errors.append(f'Unknown instrument type {instrument_type}')
+        if site and site not in [site_data['code'] for site_data in configdb.get_site_data()]:
+            errors.append(f'Unknown site {site}')
+        if errors:
+            return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+        return snapshot_response(get_pressure_snapshot(instrument_type, site, anonymous=not request.user.is_staff))
 
 
 class ObservationPortalLastChangedView(APIView):
@@ -1,12 +1,16 @@
 import logging
+from datetime import timedelta
+from itertools import islice
 
 from rest_framework import viewsets, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser, IsAuthenticated
 from rest_framework import status
 from django.utils import timezone
-from django.db.models import Prefetch
+from django.db.models import Prefetch, Q
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from dateutil.parser import parse
 from django.contrib.auth.models import User
@@ -45,6 +49,8 @@ class RequestGroupViewSet(ListAsDictMixin, viewsets.ModelViewSet):
     )
     ordering = ('-id',)
     undocumented_actions = ['schedulable_requests']
+    schedulable_requests_chunk_size = 500
+    schedulable_requests_since_margin = timedelta(minutes=1)
 
     def get_throttles(self):
         actions_to_throttle = ['cancel', 'validate', 'create']
@@ -79,11 +85,110 @@ class RequestGroupViewSet(ListAsDictMixin, viewsets.ModelViewSet):
             Gets the set of schedulable User requests for the scheduler, should be called right after isDirty finishes
             Needs a start and end time specified as the range of time to get requests in. Usually this is the entire
             semester for a scheduling run.
+
+            If a since time is specified, only the RequestGroups that were added or changed after that time are
+            returned, along with a list of tombstones (ids of changed RequestGroups that are no longer schedulable)
+            and a cursor to pass in as since on the next call. Changes are read from a margin before the since time,
+            since rows saved just before the cursor may be committed after it was taken, so the same RequestGroup
+            can be returned by consecutive calls and the scheduler should replace its copy by id. RequestGroups that
+            stop being schedulable without a change to themselves, their requests or their proposal, such as when
+            their time allocation runs out or the start and end times move past them, are not tombstoned, so the
+            scheduler still needs to do a periodic full sync without a since time.
+
+            If stream is specified, the RequestGroups are read from the db in chunks and written out as they are
+            produced, so the memory used does not grow with the number of RequestGroups returned.
         """
         current_semester = Semester.current_semesters().first()
         start = parse(request.query_params.get('start', str(current_semester.start))).replace(tzinfo=timezone.utc)
         end = parse(request.query_params.get('end', str(current_semester.end))).replace(tzinfo=timezone.utc)
         telescope_classes = request.query_params.getlist('telescope_class')
+        stream = request.query_params.get('stream', '').lower() in ['true', '1']
+        since = request.query_params.get('since')
+        cursor = None
+        if since:
+            try:
+                since = parse(since).replace(tzinfo=timezone.utc)
+            except (ValueError, OverflowError):
+                return Response({'errors': ['Invalid since time {}'.format(since)]}, status=status.HTTP_400_BAD_REQUEST)
+            # Take the cursor before querying so that changes made while this call runs are picked up by the next one
+            cursor = timezone.now()
+
+        queryset = self._schedulable_requestgroups(start, end, telescope_classes)
+        if since:
+            queryset = queryset.filter(self._changed_since(since))
+        time_allocations = self._time_allocations_by_key(start, end)
+        if stream:
+            return StreamingHttpResponse(
+                self._stream_schedulable_requests(queryset, time_allocations, start, end, telescope_classes, since,
+                                                  cursor),
+                content_type='application/json'
+            )
+
+        request_group_data = list(self._requestgroups_with_time_available(list(queryset.all()), time_allocations))
+        if not since:
+            return Response(request_group_data)
+
+        schedulable_ids = {request_group_dict['id'] for request_group_dict in request_group_data}
+        return Response({
+            'request_groups': request_group_data,
+            'tombstones': self._tombstones(start, end, telescope_classes, since, schedulable_ids),
+            'cursor': cursor
+        })
+
+    def _stream_schedulable_requests(self, queryset, time_allocations, start, end, telescope_classes, since, cursor):
+        encoder = JSONEncoder()
+        schedulable_ids = set()
+        yield '{"request_groups": [' if since else '['
+        for request_groups in self._chunked_requestgroups(queryset):
+            for request_group_dict in self._requestgroups_with_time_available(request_groups, time_allocations):
+                yield (',' if schedulable_ids else '') + encoder.encode(request_group_dict)
+                schedulable_ids.add(request_group_dict['id'])
+        if since:
+            yield '], "tombstones": {}, "cursor": {}}}'.format(
+                encoder.encode(self._tombstones(start, end, telescope_classes, since, schedulable_ids)),
+                encoder.encode(cursor)
+            )
+        else:
+            yield ']'
+
+    def _chunked_requestgroups(self, queryset):
+        # iterator() skips prefetch_related, so walk the ids with a server side cursor and then
+        # load and prefetch each chunk of RequestGroups separately
+        id_iterator = queryset.prefetch_related(None).values_list('id', flat=True).iterator(
+            chunk_size=self.schedulable_requests_chunk_size
+        )
+        while True:
+            ids = list(islice(id_iterator, self.schedulable_requests_chunk_size))
+            if not ids:
+                return
+            yield list(queryset.filter(id__in=ids))
+
+    def _tombstones(self, start, end, telescope_classes, since, schedulable_ids):
+        # Any RequestGroup in the time range that changed since the last call but was not returned is no longer
+        # schedulable, so tell the scheduler to drop it from its copy
+        changed_ids = set(self._requestgroups_in_range(start, end, telescope_classes).filter(
+            self._changed_since(since)
+        ).values_list('id', flat=True))
+        return sorted(changed_ids - schedulable_ids)
+
+    def _changed_since(self, since):
+        changed_after = since - self.schedulable_requests_since_margin
+        return (
+            Q(modified__gte=changed_after) | Q(requests__modified__gte=changed_after)
+            | Q(proposal__modified__gte=changed_after)
+        )
+
+    @staticmethod
+    def _requestgroups_in_range(start, end, telescope_classes):
+        queryset = RequestGroup.objects.filter(
+            requests__windows__start__lte=end,
+            requests__windows__start__gte=start,
+        )
+        if telescope_classes:
+            queryset = queryset.filter(requests__location__telescope_class__in=telescope_classes)
+        return queryset.distinct()
+
+    def _schedulable_requestgroups(self, start, end, telescope_classes):
         # Schedulable requests are not in a terminal state, are part of an active proposal,
         # and have a window within this semester
         instrument_config_query = InstrumentConfig.objects.prefetch_related('rois')
@@ -94,38 +199,44 @@ class RequestGroupViewSet(ListAsDictMixin, viewsets.ModelViewSet):
         request_query = Request.objects.select_related('location').prefetch_related(
             'windows', Prefetch('configurations', queryset=configuration_query)
         )
-        queryset = RequestGroup.objects.exclude(
+        return self._requestgroups_in_range(start, end, telescope_classes).exclude(
             state__in=TERMINAL_REQUEST_STATES
         ).exclude(
             observation_type=RequestGroup.DIRECT
         ).filter(
-            requests__windows__start__lte=end,
-            requests__windows__start__gte=start,
             proposal__active=True
         ).prefetch_related(
             Prefetch('requests', queryset=request_query),
             Prefetch('proposal', queryset=Proposal.objects.only('id').all()),
             Prefetch('submitter', queryset=User.objects.only('username', 'is_staff').all())
-        ).distinct()
-        if telescope_classes:
-            queryset = queryset.filter(requests__location__telescope_class__in=telescope_classes)
+        )
 
-        # queryset now contains all the schedulable URs and their associated requests and data
+    @staticmethod
+    def _time_allocations_by_key(start, end):
+        # Load every active TimeAllocation in the semesters overlapping the time range in one query, indexed by
+        # (semester, instrument_type, proposal) so the time left checks don't need to hit the db per RequestGroup
+        time_allocations = {}
+        for time_allocation in TimeAllocation.objects.filter(
+            semester__start__lte=end, semester__end__gte=start, proposal__active=True
+        ):
+            for instrument_type in time_allocation.instrument_types:
+                key = (time_allocation.semester_id, instrument_type, time_allocation.proposal_id)
+                time_allocations[key] = time_allocation
+        return time_allocations
+
+    @staticmethod
+    def _requestgroups_with_time_available(request_groups, time_allocations):
+        # request_groups now contains the schedulable URs and their associated requests and data
         # Check that each request time available in its proposal still
-        request_group_data = []
-        tas = {}
-        for request_group in queryset.all():
-            total_duration_dict = request_group.total_duration
-            for tak, duration in total_duration_dict.items():
-                if (tak, request_group.proposal.id) in tas:
-                    time_allocation = tas[(tak, request_group.proposal.id)]
-                else:
-                    time_allocation = TimeAllocation.objects.get(
-                        semester=tak.semester,
-                        instrument_types__contains=[tak.instrument_type],
-                        proposal=request_group.proposal.id,
-                    )
-                    tas[(tak, request_group.proposal.id)] = time_allocation
+        total_durations = RequestGroup.total_durations(request_groups)
+        for request_group in request_groups:
+            for tak, duration in total_durations[request_group.id].items():
+                time_allocation = time_allocations.get((tak.semester, tak.instrument_type, request_group.proposal.id))
+                if time_allocation is None:
+                    logger.warning('no time allocation for {0} in proposal {1} for ur {2}, skipping'.format(
+                        tak, request_group.proposal.id, request_group.id
+                    ))
+                    continue
                 if request_group.observation_type == RequestGroup.NORMAL:
                     time_left = time_allocation.std_allocation - time_allocation.std_time_used
                 elif request_group.observation_type == RequestGroup.RAPID_RESPONSE:
@@ -141,7 +252,7 @@ class RequestGroupViewSet(ListAsDictMixin, viewsets.ModelViewSet):
                 if time_left * settings.PROPOSAL_TIME_OVERUSE_ALLOWANCE >= (duration / 3600.0):
                     request_group_dict = request_group.as_dict()
                     request_group_dict['is_staff'] = request_group.submitter.is_staff
-                    request_group_data.append(request_group_dict)
+                    yield request_group_dict
                     break
                 else:
                     logger.warning(
@@ -149,7 +260,6 @@ class RequestGroupViewSet(ListAsDictMixin, viewsets.ModelViewSet):
                             time_left, request_group.proposal.id, request_group.id, (duration / 3600.0)
                         )
                     )
-        return Response(request_group_data)
 
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
@@ -236,6 +236,10 @@ DEFAULT_FROM_EMAIL = ORGANIZATION_EMAIL
 SERVER_EMAIL = ORGANIZATION_EMAIL
 
 ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost')
+ELASTICSEARCH_POOL_SIZE = int(os.getenv('ELASTICSEARCH_POOL_SIZE', 10))  # number of connections kept open to each elasticsearch node
+ELASTICSEARCH_TIMEOUT = int(os.getenv('ELASTICSEARCH_TIMEOUT', 30))  # seconds to wait for an elasticsearch response
+ELASTICSEARCH_MAX_RETRIES = int(os.getenv('ELASTICSEARCH_MAX_RETRIES', 3))  # times a failed or timed out elasticsearch request is retried
+TELESCOPE_STATES_AGGREGATION_INTERVAL = os.getenv('TELESCOPE_STATES_AGGREGATION_INTERVAL', '')  # e.g. 10m to aggregate telescope states in elasticsearch, intervals where the state changed are still scrolled through. Empty scrolls through every datum
 CONFIGDB_URL = os.getenv('CONFIGDB_URL', 'http://localhost')
 DOWNTIMEDB_URL = os.getenv('DOWNTIMEDB_URL', 'http://localhost')
 
@@ -307,6 +311,7 @@ LOGGING = {
 MAX_IPP_VALUE = float(os.getenv('MAX_IPP_VALUE', 2.0))  # the maximum allowed value of ipp
 MIN_IPP_VALUE = float(os.getenv('MIN_IPP_VALUE', 0.5))  # the minimum allowed value of ipp
 PROPOSAL_TIME_OVERUSE_ALLOWANCE = float(os.getenv('PROPOSAL_TIME_OVERUSE_ALLOWANCE', 1.1))  # amount of leeway in a proposals timeallocation before rejecting that request
+RISE_SET_PROCESSES = int(os.getenv('RISE_SET_PROCESSES', 0))  # number of processes used to compute rise_set intervals, 0 computes them in the calling process
 ## Serializer setup - used to allow overriding of serializers
 SERIALIZERS = {
     'observations': {
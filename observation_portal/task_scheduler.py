@@ -1,10 +1,12 @@
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 
-from observation_portal.requestgroups.tasks import expire_requests
+from observation_portal.requestgroups.tasks import (expire_requests, refresh_configdb,
+                                                   materialize_completed_nights_availability,
+                                                   refresh_contention_and_pressure, refresh_stored_durations)
 from observation_portal.observations.tasks import delete_old_observations
 from observation_portal.accounts.tasks import expire_access_tokens
-from observation_portal.proposals.tasks import time_allocation_reminder
+from observation_portal.proposals.tasks import time_allocation_reminder, precompute_semester_dark_intervals
 
 
 def run():
@@ -13,6 +15,10 @@ def run():
         expire_requests.send,
         CronTrigger.from_crontab('*/5 * * * *')
     )
+    scheduler.add_job(
+        refresh_configdb.send,
+        CronTrigger.from_crontab('* * * * *')
+    )
     scheduler.add_job(
         delete_old_observations.send,
         CronTrigger.from_crontab('0 * * * *')
@@ -25,4 +31,20 @@ def run():
         time_allocation_reminder.send,
         CronTrigger.from_crontab('0 0 1 * *')  # monthly
     )
+    scheduler.add_job(
+        precompute_semester_dark_intervals.send,
+        CronTrigger.from_crontab('0 12 * * *')
+    )
+    scheduler.add_job(
+        materialize_completed_nights_availability.send,
+        CronTrigger.from_crontab('0 18 * * *')
+    )
+    scheduler.add_job(
+        refresh_contention_and_pressure.send,
+        CronTrigger.from_crontab('*/5 * * * *')
+    )
+    scheduler.add_job(
+        refresh_stored_durations.send,
+        CronTrigger.from_crontab('*/10 * * * *')
+    )
     scheduler.start()